@@ -0,0 +1,239 @@
+import argparse
+import time
+from functools import partial
+from pathlib import Path
+from typing import Callable, Tuple
+import torch
+from torch import nn
+
+# Inference backends:
+# - eager: the PyTorch model as trained
+# - frozen: traced with TorchScript, frozen (weights as constants) and optimised for inference
+#   (operator fusion, ex: convolution + relu)
+# - frozen_channels_last: frozen, with the weights and inputs in the channels_last memory format
+# - int8: quantised model created by quantise.py
+BACKENDS = ["eager", "frozen", "frozen_channels_last", "int8"]
+DEFAULT_BACKEND = "eager"
+
+
+class ChannelsLast(nn.Module):
+    """
+    Give the inputs to the model in the channels_last memory format, so the conversion is part of
+    the traced model.
+    """
+
+    def __init__(self, model: nn.Module):
+        super().__init__()
+        self.model = model.to(memory_format=torch.channels_last)
+
+    def forward(self, x):
+        return self.model(x.contiguous(memory_format=torch.channels_last))
+
+
+def set_threads(intra_op: int = None, inter_op: int = None) -> None:
+    """
+    Set the number of threads used by torch, must be called before running any model.
+    :param intra_op: Number of threads used inside an operator (ex: a convolution), None to keep the default
+    :param inter_op: Number of threads running independent operators, None to keep the default
+    :return: None
+    """
+    if intra_op is not None:
+        torch.set_num_threads(intra_op)
+    if inter_op is not None:
+        try:
+            torch.set_num_interop_threads(inter_op)
+        except RuntimeError as error:
+            # Can only be set once, before any inter op parallel work
+            print(f"The number of inter op threads was not changed: {error}")
+
+
+def optimised_model_path(checkpoint: Path, backend: str) -> Path:
+    """
+    Path of the optimised model created from a checkpoint, saved next to it.
+    :param checkpoint: Path to the weights of the model
+    :param backend: Name of the backend (see BACKENDS)
+    :return: Path of the TorchScript file
+    """
+    checkpoint = Path(checkpoint)
+    return checkpoint.with_name(f"{checkpoint.stem}.{backend}.ts")
+
+
+def freeze_model(
+    model: nn.Module, input_size: Tuple[int, int], channels_last: bool = False
+) -> torch.jit.ScriptModule:
+    """
+    Trace a model with TorchScript and freeze it (the weights become constants).
+    :param model: the model in eval mode
+    :param input_size: (height, width) of the input images
+    :param channels_last: If True, the weights and inputs are in the channels_last memory format
+    :return: torch.jit.ScriptModule
+    """
+    model.eval()
+    if channels_last:
+        model = ChannelsLast(model)
+    example = torch.zeros(1, 3, *input_size)
+    with torch.no_grad():
+        traced = torch.jit.trace(model, example)
+    return torch.jit.freeze(traced.eval())
+
+
+def load_backend(
+    build: Callable[[], nn.Module],
+    checkpoint: Path,
+    input_size: Tuple[int, int],
+    backend: str = DEFAULT_BACKEND,
+    quantised: Path = None,
+) -> nn.Module:
+    """
+    Give the model to use for a backend. The frozen models are saved next to the checkpoint and
+    created again when the checkpoint is more recent, then optimised for the CPU inference
+    (operator fusion).
+    :param build: Function building the eager model from the checkpoint
+    :param checkpoint: Path to the weights of the model
+    :param input_size: (height, width) of the input images
+    :param backend: Name of the backend (see BACKENDS)
+    :param quantised: With the int8 backend, path of the quantised model (see load_quantised)
+    :return: model to call on a batch of images
+    """
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown backend {backend}, expected one of {BACKENDS}")
+    if backend == "eager":
+        return build()
+    if backend == "int8":
+        return load_quantised(checkpoint, quantised)
+
+    optimised = optimised_model_path(checkpoint, backend)
+    if (
+        optimised.is_file()
+        and optimised.stat().st_mtime >= Path(checkpoint).stat().st_mtime
+    ):
+        model = torch.jit.load(str(optimised), map_location=torch.device("cpu"))
+    else:
+        model = freeze_model(build(), input_size, backend == "frozen_channels_last")
+        torch.jit.save(model, str(optimised))
+    # The fusions are applied after loading, the optimised graph can not be saved
+    return torch.jit.optimize_for_inference(model.eval())
+
+
+def load_quantised(checkpoint: Path, quantised: Path = None) -> torch.jit.ScriptModule:
+    """
+    Load the quantised model created from a checkpoint by quantise.py.
+    :param checkpoint: Path to the weights of the float model
+    :param quantised: Path of the quantised model (quantise.py -o), by default next to the checkpoint
+    :return: torch.jit.ScriptModule
+    """
+    quantised = Path(quantised or optimised_model_path(checkpoint, "int8"))
+    if not quantised.is_file():
+        raise FileNotFoundError(
+            f"{quantised} not found, create it with: python quantise.py -i <folder of cropped images> "
+            f"-o {quantised}"
+        )
+    if quantised.stat().st_mtime < Path(checkpoint).stat().st_mtime:
+        print(f"{quantised} is older than {checkpoint}, it should be created again")
+    extra_files = {"engine": ""}
+    model = torch.jit.load(
+        str(quantised), map_location=torch.device("cpu"), _extra_files=extra_files
+    )
+    # The model must run with the quantised engine it was created for
+    torch.backends.quantized.engine = extra_files["engine"].decode()
+    return model.eval()
+
+
+def check_parity(
+    reference: nn.Module,
+    model: nn.Module,
+    input_size: Tuple[int, int],
+    batch_sizes=(1, 8),
+) -> float:
+    """
+    Compare the probabilities given by a backend to the ones of the eager model.
+    :param reference: the eager model
+    :param model: the model of the backend
+    :param input_size: (height, width) of the input images
+    :param batch_sizes: batch sizes tested, the optimised model must work for any batch size
+    :return: maximum absolute difference of the probabilities
+    """
+    generator = torch.Generator().manual_seed(0)
+    difference = 0.0
+    with torch.no_grad():
+        for batch_size in batch_sizes:
+            inputs = torch.randn(batch_size, 3, *input_size, generator=generator)
+            expected = torch.nn.functional.softmax(reference(inputs), dim=1)
+            probabilities = torch.nn.functional.softmax(model(inputs), dim=1)
+            difference = max(difference, (expected - probabilities).abs().max().item())
+    return difference
+
+
+def throughput(
+    model: nn.Module, input_size: Tuple[int, int], batch_size: int, repeat: int = 10
+) -> float:
+    """
+    Measure the number of images classified per second.
+    :param model: the model
+    :param input_size: (height, width) of the input images
+    :param batch_size: Number of images per forward pass
+    :param repeat: Number of forward passes measured (after 2 warm up passes)
+    :return: images per second
+    """
+    inputs = torch.randn(batch_size, 3, *input_size)
+    with torch.no_grad():
+        for i in range(2):
+            model(inputs)
+        start = time.perf_counter()
+        for i in range(repeat):
+            model(inputs)
+    return batch_size * repeat / (time.perf_counter() - start)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Create the optimised models, check their parity with the eager model and "
+        "compare their throughput."
+    )
+    parser.add_argument(
+        "--model",
+        default="v1",
+        help="Name of the model (see models.MODELS), v1: SqueezeNet, v2: ImageClassifier",
+    )
+    parser.add_argument(
+        "--batch-size", type=int, default=32, help="Images per forward pass"
+    )
+    parser.add_argument(
+        "--repeat", type=int, default=10, help="Number of forward passes measured"
+    )
+    parser.add_argument(
+        "--threads", type=int, default=None, help="Number of intra op threads"
+    )
+    parser.add_argument(
+        "--interop_threads", type=int, default=None, help="Number of inter op threads"
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=1e-4,
+        help="Maximum difference of the probabilities accepted",
+    )
+    args = parser.parse_args()
+
+    set_threads(args.threads, args.interop_threads)
+    # Imported here, models imports this module
+    from models import build_model, get_spec
+
+    spec = get_spec(args.model)
+    input_size = spec.input_size
+    build = partial(build_model, args.model)
+
+    eager = build()
+    print(f"{'backend':<24}{'images/s':>12}{'max difference':>18}")
+    for backend in BACKENDS:
+        if (
+            backend == "int8"
+            and not optimised_model_path(spec.checkpoint, backend).is_file()
+        ):
+            # Created by quantise.py
+            continue
+        model = load_backend(build, spec.checkpoint, input_size, backend)
+        difference = check_parity(eager, model, input_size)
+        speed = throughput(model, input_size, args.batch_size, args.repeat)
+        status = "" if difference <= args.tolerance else "  above tolerance!"
+        print(f"{backend:<24}{speed:>12.1f}{difference:>18.2e}{status}")
@@ -1,10 +1,423 @@
 import argparse
+from collections import OrderedDict
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
 from pathlib import Path
-from part_extraction import part_extraction
-from predicte import create_pretrain_model, batch_classify
-from tqdm import tqdm
+from typing import Dict, Iterable, Iterator, List, Tuple, Union
+from PIL import Image
+from part_extraction import (
+    DEFAULT_EXTREMA_SCALE,
+    extract_part,
+    extract_parts,
+    load_regions,
+    part_extraction,
+    save,
+)
+from inference import (
+    DEFAULT_BATCH_SIZE,
+    DEFAULT_DECODE_WORKERS,
+    DEFAULT_PREFETCH,
+    chunked,
+)
+from discovery import DEFAULT_ORDER, IMAGE_EXTENSIONS, ORDERS, scan_images
+from backend import BACKENDS, DEFAULT_BACKEND, set_threads
+from cache import ResultCache, hash_file, make_context
+from change_detection import ChangeDetector
+import metrics
+from metrics import count, span
+from models import DEFAULT_MODEL, MODELS, get_spec, model_version
+from predicte import batch_classify
+from results import DATABASE_SUFFIXES, ResultSink, open_sink, read_results
+from roi_detection import DEFAULT_DETECT_LAYERS, build_regions
+from tensor_store import TensorStore, TensorStoreWriter, storing_loader
 from utils import generate_html_report
 
+# Number of images cropped at once by the pool of processes
+CROP_CHUNK_SIZE = 256
+
+
+def cropped_name(
+    img: Path, processing_folder: Path, part: str = None, input_folder: Path = None
+) -> Path:
+    """
+    Path of the cropped image of an input image (with the .jpg extension).
+    :param img: Path of the input image
+    :param processing_folder: Where the cropped images are saved
+    :param part: If not None, name of the part, saved in a sub folder of processing_folder
+    :param input_folder: If not None, the sub folders of the image in input_folder are kept, so the
+        images of the same name of different sub folders (--recursive) do not overwrite each other
+    :return: Path
+    """
+    folder = Path(processing_folder) if part is None else Path(processing_folder) / part
+    name = Path(img.name)
+    if input_folder is not None and Path(img).is_relative_to(input_folder):
+        name = Path(img).relative_to(input_folder)
+    return folder / name.with_suffix(".jpg")
+
+
+def expected_rows(
+    img: Path,
+    crop: bool,
+    fused: bool,
+    processing_folder: Path,
+    regions: Dict[str, Tuple[Tuple[int, int], Tuple[int, int]]] = None,
+    input_folder: Path = None,
+) -> List[Tuple[str, str]]:
+    """
+    Identifiers of the results rows of an input image, as named by main.
+    :param img: Path of the input image
+    :param crop: Flag if the images are cropped
+    :param fused: Flag if the images are cropped in memory
+    :param processing_folder: Where the cropped images are saved
+    :param regions: dictionary {part name: (left_up, right_down)} if the parts are extracted
+    :param input_folder: Folder of the input images (see cropped_name)
+    :return: list of (image_path, part name or None)
+    """
+    if crop and regions is not None:
+        if processing_folder is None:
+            return [(str(img), part) for part in regions]
+        return [
+            (str(cropped_name(img, processing_folder, part, input_folder)), part)
+            for part in regions
+        ]
+    if crop and (processing_folder is not None or not fused):
+        return [
+            (str(cropped_name(img, processing_folder, input_folder=input_folder)), None)
+        ]
+    return [(str(img), None)]
+
+
+def row_id(row: dict) -> Tuple[str, str]:
+    """
+    Identifier of a results row.
+    :param row: dictionary with the image name and the classification probability.
+    :return: (image_path, part name or None)
+    """
+    return str(row["image_path"]), row.get("part") or None
+
+
+def extract_one(
+    task: Tuple[Path, Path],
+    left_up,
+    right_down,
+    normalise: bool,
+    smooth: int,
+    roi_first: bool = False,
+    extrema_scale: int = DEFAULT_EXTREMA_SCALE,
+    decode_size: int = None,
+) -> Tuple[Path, str]:
+    """
+    Crop one image, errors are caught so one corrupt image does not stop the whole batch.
+    :param task: (path of the image to crop, path where to save the cropped image)
+    :param left_up: X,Y position of the left up corner
+    :param right_down: X,Y position of the right down corner
+    :param normalise: Flag to normalise of not the images.
+    :param smooth: Number of times images must be smoothed
+    :param roi_first: If True, only the cropped regions are smoothed and normalised
+    :param extrema_scale: With roi_first, reduction factor of the image used to compute the
+        normalisation extrema
+    :param decode_size: If not None, the image is decoded at a reduced resolution when the region
+        stays larger than decode_size pixels (see part_extraction.load_scaled)
+    :return: (path of the cropped image, None) or (path of the input image, error message)
+    """
+    img, output_img = task
+    try:
+        part_extraction(
+            img=img,
+            left_up=left_up,
+            right_down=right_down,
+            output_img=output_img,
+            normalise_flag=normalise,
+            smooth=smooth,
+            roi_first=roi_first,
+            extrema_scale=extrema_scale,
+            decode_size=decode_size,
+        )
+    except Exception as error:
+        return img, f"{type(error).__name__}: {error}"
+    return output_img, None
+
+
+def crop_images(
+    all_images: Iterable[Path],
+    processing_folder: Path,
+    left_up,
+    right_down,
+    normalise: bool,
+    smooth: int,
+    roi_first: bool = False,
+    extrema_scale: int = DEFAULT_EXTREMA_SCALE,
+    workers: int = 1,
+    decode_size: int = None,
+    chunk_size: int = CROP_CHUNK_SIZE,
+    input_folder: Path = None,
+) -> Iterator[Path]:
+    """
+    Crop all images, in a pool of processes if workers > 1.
+    The cropped images keep the name of their input image (with the .jpg extension), and its sub
+    folder in input_folder if it is given.
+    The images are cropped by chunks while the previous chunk is being classified, so the
+    classification starts after the first chunk and the list of images is never built.
+    :param all_images: iterable of path of images to crop
+    :param processing_folder: Where to save the cropped images
+    :param left_up: X,Y position of the left up corner
+    :param right_down: X,Y position of the right down corner
+    :param normalise: Flag to normalise of not the images.
+    :param smooth: Number of times images must be smoothed
+    :param roi_first: If True, only the cropped regions are smoothed and normalised
+    :param extrema_scale: With roi_first, reduction factor of the image used to compute the
+        normalisation extrema
+    :param workers: Number of processes cropping images
+    :param decode_size: If not None, the images are decoded at a reduced resolution when the region
+        stays larger than decode_size pixels
+    :param chunk_size: Number of images sent to the processes at once
+    :param input_folder: Folder of the input images (see cropped_name)
+    :return: Iterator of path of the cropped images, in the same order as all_images
+    """
+    tasks = (
+        (img, cropped_name(img, processing_folder, input_folder=input_folder))
+        for img in all_images
+    )
+    extract = partial(
+        extract_one,
+        left_up=left_up,
+        right_down=right_down,
+        normalise=normalise,
+        smooth=smooth,
+        roi_first=roi_first,
+        extrema_scale=extrema_scale,
+        decode_size=decode_size,
+    )
+
+    def cropped(results):
+        for output_img, error in results:
+            if error is None:
+                yield output_img
+            else:
+                count("failures")
+                print(f"Failed to crop {output_img}: {error}")
+
+    if workers <= 1:
+        yield from cropped(map(extract, tasks))
+        return
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        pending = None
+        for chunk in chunked(tasks, chunk_size):
+            # Send the images by chunks to limit the inter process communications
+            chunksize = max(1, min(16, len(chunk) // (workers * 4)))
+            # The next chunk is submitted before the previous one is given to the classifier
+            results = pool.map(extract, chunk, chunksize=chunksize)
+            if pending is not None:
+                yield from cropped(pending)
+            pending = results
+        if pending is not None:
+            yield from cropped(pending)
+
+
+def report_save_error(future: Future) -> None:
+    """
+    Print the error of a failed background save of a cropped image.
+    :param future: Future of the save
+    :return: None
+    """
+    if future.exception() is not None:
+        count("failures")
+        print(f"Failed to save a cropped image: {future.exception()}")
+
+
+def crop_in_memory(
+    name: Path,
+    sources: Dict[Path, Path],
+    left_up,
+    right_down,
+    normalise: bool,
+    smooth: int,
+    roi_first: bool = False,
+    extrema_scale: int = DEFAULT_EXTREMA_SCALE,
+    writer: ThreadPoolExecutor = None,
+    processing_folder: Path = None,
+    decode_size: int = None,
+    input_folder: Path = None,
+):
+    """
+    Crop one image and give it directly to the classifier, without the JPEG encoding and decoding.
+    :param name: Name of the image in the csv, the path of the cropped image if it is saved
+        with sources, the path of the input image otherwise
+    :param sources: Dictionary giving the input image of each name, or None
+    :param left_up: X,Y position of the left up corner
+    :param right_down: X,Y position of the right down corner
+    :param normalise: Flag to normalise of not the images.
+    :param smooth: Number of times images must be smoothed
+    :param roi_first: If True, only the cropped regions are smoothed and normalised
+    :param extrema_scale: With roi_first, reduction factor of the image used to compute the
+        normalisation extrema
+    :param writer: If not None, the cropped image is saved at name in the background by this executor
+    :param processing_folder: Without sources, the cropped image is saved in this folder (by writer)
+    :param decode_size: If not None, the image is decoded at a reduced resolution when the region
+        stays larger than decode_size pixels
+    :param input_folder: Folder of the input images (see cropped_name)
+    :return: PIL.Image cropped and resized for the classifier, or {path of the cropped image: PIL.Image}
+        if it is saved in processing_folder
+    """
+    img = extract_part(
+        name if sources is None else sources[name],
+        left_up,
+        right_down,
+        normalise,
+        smooth,
+        roi_first,
+        extrema_scale,
+        decode_size,
+    )
+    if processing_folder is not None:
+        output_img = cropped_name(
+            Path(name), processing_folder, input_folder=input_folder
+        )
+        writer.submit(save, img, output_img).add_done_callback(report_save_error)
+        return {output_img: img}
+    if writer is not None:
+        writer.submit(save, img, Path(name)).add_done_callback(report_save_error)
+    return img
+
+
+def crop_regions_in_memory(
+    img: Path,
+    regions: Dict[str, Tuple[Tuple[int, int], Tuple[int, int]]],
+    normalise: bool,
+    smooth: int,
+    roi_first: bool = False,
+    extrema_scale: int = DEFAULT_EXTREMA_SCALE,
+    processing_folder: Path = None,
+    writer: ThreadPoolExecutor = None,
+    decode_size: int = None,
+    input_folder: Path = None,
+) -> Dict[Tuple[Path, str], Image]:
+    """
+    Crop all the parts of one layer image for the classifier, the image is only loaded once.
+    :param img: Path to the layer image
+    :param regions: dictionary {part name: (left_up, right_down)}
+    :param normalise: Flag to normalise of not the images.
+    :param smooth: Number of times images must be smoothed
+    :param roi_first: If True, only the cropped regions are smoothed and normalised
+    :param extrema_scale: With roi_first, reduction factor of the image used to compute the
+        normalisation extrema
+    :param processing_folder: If not None, the parts are saved in processing_folder/part name/
+    :param writer: Executor saving the cropped images in the background (with processing_folder)
+    :param decode_size: If not None, the image is decoded at a reduced resolution when all the parts
+        stay larger than decode_size pixels
+    :param input_folder: Folder of the input images (see cropped_name)
+    :return: dictionary {(image path in the csv, part name): PIL.Image}
+    """
+    parts = extract_parts(
+        img, regions, normalise, smooth, roi_first, extrema_scale, decode_size
+    )
+    cropped_images = {}
+    for name, part in parts.items():
+        if processing_folder is None:
+            cropped_images[(img, name)] = part
+        else:
+            output_img = cropped_name(img, processing_folder, name, input_folder)
+            writer.submit(save, part, output_img).add_done_callback(report_save_error)
+            cropped_images[(output_img, name)] = part
+    return cropped_images
+
+
+class CacheLookup(ResultSink):
+    """
+    Give the images to classify while their results are looked for in the cache (see not_cached): each
+    image is hashed when it is reached, and only the images not found are given to the classifier.
+    The classifier writes its results in this sink, which writes them in the results file with the
+    results found in the cache, in the order of the input images. The classified results are added
+    to the cache as soon as all the rows of an image are classified, so they are kept if the batch
+    is stopped.
+    """
+
+    def __init__(
+        self, result_cache: ResultCache, context: str, rows_of, sink: ResultSink
+    ):
+        """
+        :param result_cache: the cache
+        :param context: Description of the model and preprocessing (see cache.make_context)
+        :param rows_of: function giving the identifiers of the rows of an input image (see expected_rows)
+        :param sink: results.ResultSink of the results file
+        """
+        super().__init__()
+        self.result_cache = result_cache
+        self.context = context
+        self.rows_of = rows_of
+        self.sink = sink
+        # Input image and cache key of the rows being classified
+        self.sources = {}
+        # Rows already classified of the images with several rows (parts)
+        self.classified = {}
+        # Rows found in the cache before each image given to the classifier, and after the last one
+        self.waiting = OrderedDict()
+        self.cached_rows = []
+
+    def not_cached(self, images: Iterable[Path]) -> Iterator[Path]:
+        """
+        :param images: iterable of path of input images
+        :return: Iterator of the images not in the cache, in the same order
+        """
+        for img in images:
+            key = self.result_cache.key(img, self.context)
+            rows = self.result_cache.get(key)
+            if rows is None:
+                for identifier in self.rows_of(img):
+                    self.sources[identifier] = (img, key)
+                self.waiting[img] = self.cached_rows
+                self.cached_rows = []
+                yield img
+                continue
+            # The same image can have another name
+            for row, (name, _) in zip(rows, self.rows_of(img)):
+                self.cached_rows.append({**row, "image_path": name})
+
+    def write(self, row: dict) -> None:
+        """
+        Write a classified row after the cached rows of the images before it, its input image is added
+        to the cache once all its rows are classified.
+        :param row: dictionary with the image name and the classification probability.
+        :return: None
+        """
+        source = self.sources.pop(row_id(row), None)
+        if source is None:
+            self.sink.write(row)
+            return
+        img, key = source
+        # The classifier keeps the order of the images, the ones before img without results failed
+        while img in self.waiting:
+            waiting_img, cached_rows = self.waiting.popitem(last=False)
+            for cached_row in cached_rows:
+                self.sink.write(cached_row)
+            if waiting_img == img:
+                break
+        self.sink.write(row)
+        rows = self.classified.setdefault(img, [])
+        rows.append(row)
+        expected = self.rows_of(img)
+        # Only complete results are cached, in the order of the expected rows
+        if len(rows) == len(expected):
+            del self.classified[img]
+            rows.sort(key=lambda row: expected.index(row_id(row)))
+            self.result_cache.put(key, rows)
+
+    def flush(self) -> None:
+        self.sink.flush()
+
+    def close(self) -> None:
+        """
+        Write the cached rows left (after the last classified image) and close the results file.
+        :return: None
+        """
+        for cached_rows in [*self.waiting.values(), self.cached_rows]:
+            for cached_row in cached_rows:
+                self.sink.write(cached_row)
+        self.waiting.clear()
+        self.cached_rows = []
+        self.sink.close()
+
 
 def main(
     input_folder: Path,
@@ -16,6 +429,37 @@ def main(
     normalise: bool,
     html: bool,
     smooth: int,
+    batch_size: int = DEFAULT_BATCH_SIZE,
+    ready_model: Path = None,
+    decode_workers: int = DEFAULT_DECODE_WORKERS,
+    prefetch: int = DEFAULT_PREFETCH,
+    workers: int = 1,
+    fused: bool = False,
+    regions: Path = None,
+    roi_first: bool = False,
+    extrema_scale: int = DEFAULT_EXTREMA_SCALE,
+    cache: Path = None,
+    cache_max_mb: float = None,
+    cache_max_days: float = None,
+    resume: bool = False,
+    backend: str = DEFAULT_BACKEND,
+    threads: int = None,
+    interop_threads: int = None,
+    metrics_file: Path = None,
+    verbosity: int = 0,
+    model_name: Union[str, List[str]] = DEFAULT_MODEL,
+    extensions: Tuple[str] = IMAGE_EXTENSIONS,
+    recursive: bool = False,
+    order: str = DEFAULT_ORDER,
+    reduced_decode: bool = False,
+    store: Path = None,
+    from_store: Path = None,
+    skip_unchanged: float = None,
+    validate_skip: bool = False,
+    ensemble: bool = False,
+    inference_workers: int = 1,
+    detect_regions: Path = None,
+    detect_layers: int = DEFAULT_DETECT_LAYERS,
 ) -> None:
     """
     Process a batch of inputs
@@ -28,43 +472,277 @@ def main(
     :param normalise:
     :param html:
     :param smooth:
+    :param batch_size: Number of images classified in one forward pass
+    :param ready_model: Optional path to a serialized ready to run model
+    :param decode_workers: Number of threads decoding images while the model is running
+    :param prefetch: Maximum number of images decoded in advance
+    :param workers: Number of processes cropping images
+    :param fused: If True with crop, the cropped images are classified in memory and
+        only saved (in background) if a processing_folder is given
+    :param regions: Optional .json or .csv file of named parts to extract from each image
+        (replace left_up and right_down), the images are then cropped in memory as with fused
+    :param roi_first: If True, only the cropped regions are smoothed and normalised
+    :param extrema_scale: With roi_first, reduction factor of the image used to compute the
+        normalisation extrema
+    :param cache: Optional path of a results cache (see cache.ResultCache), the images already
+        classified with the same model and preprocessing are not processed again
+    :param cache_max_mb: Maximum size of the cache
+    :param cache_max_days: Maximum number of days a result is kept in the cache without being used
+    :param resume: If True, the output_csv is kept and only the images not in it are processed
+    :param backend: Inference backend (see backend.BACKENDS)
+    :param threads: Number of intra op threads used by torch, None to keep the default
+    :param interop_threads: Number of inter op threads used by torch, None to keep the default
+    :param metrics_file: If not None, the duration of each stage and the counters (images, failures,
+        cache hits) are saved in this file (.json summary, Prometheus text format otherwise).
+        The stages run in the cropping processes (workers > 1) are not measured.
+    :param verbosity: 0: only the progress, 1: result of each image, 2: also the scores and probabilities
+    :param model_name: Name of the classification model (see models.MODELS), or list of names: each image
+        is then decoded and preprocessed once for all the models, and their results are in one row
+        (columns prefixed by the model name, see models.MultiModel)
+    :param extensions: Extensions of the images to classify
+    :param recursive: If True, the images of the sub folders of input_folder are also classified
+    :param order: Order of the images (see discovery.ORDERS)
+    :param reduced_decode: If True with crop, the images are decoded at a reduced resolution when the
+        cropped regions stay larger than the model input (see part_extraction.load_scaled)
+    :param store: If not None with crop, the crops given to the classifier are also saved in this
+        tensor store folder (see tensor_store.TensorStoreWriter)
+    :param from_store: If not None, the crops of this tensor store are classified instead of the
+        images of input_folder, without decoding them (ex: to evaluate a new checkpoint)
+    :param skip_unchanged: If not None, a crop whose mean difference (grey levels) with the last classified
+        layer of its region is below this threshold reuses its results (see change_detection.ChangeDetector)
+    :param validate_skip: With skip_unchanged, all the crops are classified and the drift of the results
+        that would have been reused is measured
+    :param ensemble: With several models, add the mean probability of the classes shared by the models
+    :param inference_workers: Number of processes decoding and classifying the images, each one on its
+        own slice of cores (see parallel.predict_parallel). The images can then only be saved by the
+        classic crop (without fused or regions)
+    :param detect_regions: If not None with crop, the parts are found in the first layers instead of being
+        given by regions, and saved in this .json file, reused while the layout of the build is the same
+        (see roi_detection.build_regions)
+    :param detect_layers: Number of layers accumulated to find the parts
     :return:
     """
+    metrics.set_verbosity(verbosity)
+    metrics.enable(metrics_file is not None)
+    set_threads(threads, interop_threads)
     output_csv = Path(output_csv)
-    if output_csv.exists():
+    # A database keeps the results of the other runs, the results classified again replace the old ones
+    if (
+        output_csv.exists()
+        and not resume
+        and output_csv.suffix not in DATABASE_SUFFIXES
+    ):
         output_csv.unlink()
-    # List all image in a folder
-    all_images = list(Path(input_folder).glob("*.jpg"))
+    if store is not None and not crop:
+        raise ValueError("Only the cropped images can be saved in a tensor store")
+    if inference_workers > 1 and (
+        store is not None or (crop and processing_folder and (fused or regions))
+    ):
+        # The background writers of the parent process do not run in the inference workers
+        raise ValueError(
+            "The parallel inference does not save the images cropped in memory or a tensor store"
+        )
+    if from_store is not None and (crop or cache is not None or resume):
+        raise ValueError(
+            "The crops of a tensor store are classified without crop, cache or resume"
+        )
+    # The images of the folder are found while they are processed
+    if from_store is None:
+        all_images = scan_images(input_folder, extensions, recursive, order)
+    else:
+        all_images = []
+    if detect_regions is not None:
+        if not crop or regions is not None:
+            raise ValueError("The parts are detected with crop and without regions")
+        # Only the first layers are read, the images are found again to be classified
+        build_regions(
+            scan_images(input_folder, extensions, recursive, order),
+            detect_regions,
+            detect_layers,
+        )
+        regions = detect_regions
+    parts = load_regions(regions) if crop and regions is not None else None
+    model_names = [model_name] if isinstance(model_name, str) else list(model_name)
+    if len(model_names) == 1:
+        model_name = model_names[0]
+    decode_size = None
+    if reduced_decode:
+        decode_size = min(min(get_spec(name).input_size) for name in model_names)
+
+    def rows_of(img: Path) -> List[Tuple[str, str]]:
+        return expected_rows(img, crop, fused, processing_folder, parts, input_folder)
+
+    # Skip the images already in the results
+    if resume and output_csv.exists():
+        done = {row_id(row) for row in read_results(output_csv)}
+        all_images = (img for img in all_images if not set(rows_of(img)) <= done)
+        print(f"Resume: {len(done)} results already in {output_csv}")
+
+    # Take the results of the unchanged images from the cache
+    result_cache = None
+    if cache is not None:
+        result_cache = ResultCache(cache, cache_max_mb, cache_max_days)
+        context = make_context(
+            "-".join(hash_file(get_spec(name).checkpoint) for name in model_names),
+            model_name=model_name,
+            ensemble=ensemble,
+            crop=crop,
+            processing_folder=processing_folder,
+            left_up=left_up,
+            right_down=right_down,
+            normalise=normalise,
+            smooth=smooth,
+            fused=fused,
+            regions=parts,
+            roi_first=roi_first,
+            extrema_scale=extrema_scale,
+            backend=backend,
+            decode_size=decode_size,
+            skip_unchanged=skip_unchanged,
+        )
+        # The images are looked for in the cache while they are classified, only the images not
+        # in the cache are given to the classifier
+        version = "+".join(model_version(name) for name in model_names)
+        cache_lookup = CacheLookup(
+            result_cache, context, rows_of, open_sink(output_csv, model=version)
+        )
+        all_images = cache_lookup.not_cached(all_images)
+
+    # Function used to load the images to classify
+    loader = Image.open
+    writer = None
 
     # If we where asked to crop them, we crop them and create a list of images to classify,
     # Otherwise, all_images is used to define the list of images to classify.
-    if crop:
-        image_to_classify = []
-        # We must crop all images
-        print("Crop images")
-        for img in tqdm(all_images):
-            output_img = Path(processing_folder) / Path(img.name).with_suffix(".jpg")
-
-            part_extraction(
-                img=img,
+    if crop and regions is not None:
+        # Each image is loaded once and all its parts are classified
+        if processing_folder is not None:
+            writer = ThreadPoolExecutor(max_workers=1)
+        image_to_classify = all_images
+        loader = partial(
+            crop_regions_in_memory,
+            regions=parts,
+            normalise=normalise,
+            smooth=smooth,
+            roi_first=roi_first,
+            extrema_scale=extrema_scale,
+            processing_folder=processing_folder,
+            writer=writer,
+            decode_size=decode_size,
+            input_folder=input_folder,
+        )
+    elif crop and fused:
+        # The images are cropped in memory when the classifier needs them
+        if processing_folder is not None:
+            writer = ThreadPoolExecutor(max_workers=1)
+        image_to_classify = all_images
+        loader = partial(
+            crop_in_memory,
+            sources=None,
+            left_up=left_up,
+            right_down=right_down,
+            normalise=normalise,
+            smooth=smooth,
+            roi_first=roi_first,
+            extrema_scale=extrema_scale,
+            writer=writer,
+            processing_folder=processing_folder,
+            decode_size=decode_size,
+            input_folder=input_folder,
+        )
+    elif crop:
+        # We must crop all images, they are cropped by chunks while being classified
+        image_to_classify = crop_images(
+            all_images,
+            processing_folder,
+            left_up,
+            right_down,
+            normalise,
+            smooth,
+            roi_first,
+            extrema_scale,
+            workers,
+            decode_size,
+            input_folder=input_folder,
+        )
+    else:
+        image_to_classify = all_images
+
+    # Save the crops given to the classifier
+    store_writer = None
+    if store is not None:
+        store_writer = TensorStoreWriter(
+            store,
+            params=dict(
+                input_folder=input_folder,
                 left_up=left_up,
                 right_down=right_down,
-                output_img=output_img,
-                normalise_flag=normalise,
+                normalise=normalise,
                 smooth=smooth,
-            )
-            image_to_classify.append(output_img)
-    else:
-        image_to_classify = all_images
+                regions=parts,
+                roi_first=roi_first,
+                extrema_scale=extrema_scale,
+                decode_size=decode_size,
+            ),
+        )
+        loader = storing_loader(
+            loader,
+            store_writer,
+            lambda part: (left_up, right_down) if part is None else parts[part],
+        )
+        image_to_classify = store_writer.ordered(image_to_classify)
+    if from_store is not None:
+        image_to_classify = TensorStore(from_store)
+        print(f"{len(image_to_classify)} crops in the tensor store {from_store}")
+
+    change_detector = None
+    if skip_unchanged is not None:
+        # The inputs of several models are only converted to tensors (values in [0, 1])
+        std = get_spec(model_name).std if len(model_names) == 1 else None
+        change_detector = ChangeDetector(skip_unchanged, std, validate_skip)
 
     # Classify all the images
 
     print("Images classification")
-    batch_classify(image_to_classify, output_csv)
+    try:
+        with span("classification"):
+            batch_classify(
+                image_to_classify,
+                output_csv if result_cache is None else cache_lookup,
+                batch_size,
+                ready_model,
+                decode_workers,
+                prefetch,
+                loader,
+                backend,
+                model_name,
+                change_detector,
+                ensemble,
+                inference_workers,
+            )
+    finally:
+        # Wait for the cropped images to be saved
+        if writer is not None:
+            writer.shutdown()
+        if store_writer is not None:
+            store_writer.close()
+        if result_cache is not None:
+            # Closed by the classification, unless it failed before
+            cache_lookup.close()
+            result_cache.close()
+            count("cache_hits", result_cache.hits)
+            count("cache_misses", result_cache.misses)
+            print(f"{result_cache.hits} images found in the cache")
+        # Saved even if the classification failed
+        if metrics_file is not None:
+            metrics.export(metrics_file)
 
     # Generate html report
     if html:
-        generate_html_report(output_csv, output_csv.with_suffix(".html"))
+        with span("html_report"):
+            generate_html_report(output_csv, output_csv.with_suffix(".html"))
+        if metrics_file is not None:
+            metrics.export(metrics_file)
 
 
 if __name__ == "__main__":
@@ -123,6 +801,191 @@ if __name__ == "__main__":
         default=0,
         help="Number of times images must be smoothed",
     )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=DEFAULT_BATCH_SIZE,
+        help="Number of images classified in one forward pass",
+    )
+    parser.add_argument(
+        "--ready_model",
+        type=Path,
+        default=None,
+        help="Path of a serialized ready to run model, created from the checkpoint if missing "
+        "(with --backend int8, path of the model created by quantise.py -o)",
+    )
+    parser.add_argument(
+        "--decode_workers",
+        type=int,
+        default=DEFAULT_DECODE_WORKERS,
+        help="Number of threads decoding images while the model is running (0 to disable)",
+    )
+    parser.add_argument(
+        "--prefetch",
+        type=int,
+        default=DEFAULT_PREFETCH,
+        help="Maximum number of images decoded in advance",
+    )
+    parser.add_argument(
+        "-w",
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of processes cropping images",
+    )
+    parser.add_argument(
+        "--fused",
+        action="store_true",
+        help="With --crop, classify the cropped images in memory, they are only saved if a processing_folder is given",
+    )
+    parser.add_argument(
+        "--regions",
+        type=Path,
+        default=None,
+        help="With --crop, .json or .csv file of the named parts to extract from each image",
+    )
+    parser.add_argument(
+        "--detect_regions",
+        type=Path,
+        default=None,
+        help="With --crop, find the parts in the first layers instead of --regions, and save them in this "
+        ".json file, reused while the layout of the build is the same",
+    )
+    parser.add_argument(
+        "--detect_layers",
+        type=int,
+        default=DEFAULT_DETECT_LAYERS,
+        help="Number of layers accumulated to find the parts",
+    )
+    parser.add_argument(
+        "--roi_first",
+        action="store_true",
+        help="Only smooth and normalise the cropped regions instead of the whole images",
+    )
+    parser.add_argument(
+        "--extrema_scale",
+        type=int,
+        default=DEFAULT_EXTREMA_SCALE,
+        help="With --roi_first and --smooth, reduction factor of the images used to compute the "
+        "normalisation extrema (1 to smooth the whole images for the exact extrema)",
+    )
+    parser.add_argument(
+        "--cache",
+        type=Path,
+        default=None,
+        help="Path of a results cache, unchanged images are not processed again",
+    )
+    parser.add_argument(
+        "--cache_max_mb",
+        type=float,
+        default=None,
+        help="Maximum size of the cache, the least recently used results are removed",
+    )
+    parser.add_argument(
+        "--cache_max_days",
+        type=float,
+        default=None,
+        help="Results not used for this number of days are removed from the cache",
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Keep the output csv and only process the images that are not in it",
+    )
+    parser.add_argument(
+        "--backend",
+        choices=BACKENDS,
+        default=DEFAULT_BACKEND,
+        help="Inference backend, the optimised models are saved next to the checkpoint",
+    )
+    parser.add_argument(
+        "--threads", type=int, default=None, help="Number of intra op threads"
+    )
+    parser.add_argument(
+        "--interop_threads", type=int, default=None, help="Number of inter op threads"
+    )
+    parser.add_argument(
+        "--model",
+        dest="model_name",
+        nargs="+",
+        choices=list(MODELS),
+        default=DEFAULT_MODEL,
+        help="Classification model (v1: SqueezeNet 3 classes, v2: ImageClassifier 5 classes), "
+        "several models classify the same decoded images (ex: --model v1 v2)",
+    )
+    parser.add_argument(
+        "--inference_workers",
+        type=int,
+        default=1,
+        help="Number of processes decoding and classifying the images, each one on its own slice of cores",
+    )
+    parser.add_argument(
+        "--ensemble",
+        action="store_true",
+        help="With several models, add the mean probability of the classes shared by the models",
+    )
+    parser.add_argument(
+        "--extensions",
+        nargs="+",
+        default=list(IMAGE_EXTENSIONS),
+        help="Extensions of the images to classify",
+    )
+    parser.add_argument(
+        "--recursive",
+        action="store_true",
+        help="Also classify the images of the sub folders of the input folder",
+    )
+    parser.add_argument(
+        "--order",
+        choices=ORDERS,
+        default=DEFAULT_ORDER,
+        help="Order of the images: natural (by name, numbers by value), mtime (acquisition time) "
+        "or none (file system order, nothing kept in memory)",
+    )
+    parser.add_argument(
+        "--reduced_decode",
+        action="store_true",
+        help="With --crop, decode the images at a reduced resolution (1/2, 1/4 or 1/8) when the "
+        "cropped regions stay larger than the model input",
+    )
+    parser.add_argument(
+        "--store",
+        type=Path,
+        default=None,
+        help="With --crop, also save the crops given to the classifier in this tensor store folder",
+    )
+    parser.add_argument(
+        "--from_store",
+        type=Path,
+        default=None,
+        help="Classify the crops of a tensor store folder instead of the images of the input folder",
+    )
+    parser.add_argument(
+        "--skip_unchanged",
+        type=float,
+        default=None,
+        help="Reuse the results of the last classified layer of a region when the mean difference of "
+        "the crops is below this threshold (grey levels, ex: 2)",
+    )
+    parser.add_argument(
+        "--validate_skip",
+        action="store_true",
+        help="With --skip_unchanged, classify all the crops and measure the drift of the reused results",
+    )
+    parser.add_argument(
+        "--metrics",
+        dest="metrics_file",
+        type=Path,
+        default=None,
+        help="Save the duration of each stage and the counters in this file (.json summary, "
+        "Prometheus text format otherwise)",
+    )
+    parser.add_argument(
+        "--verbosity",
+        type=int,
+        default=0,
+        help="0: only the progress, 1: print the result of each image, 2: also the scores and probabilities",
+    )
 
     args = parser.parse_args()
 
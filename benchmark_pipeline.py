@@ -0,0 +1,399 @@
+import argparse
+import json
+import platform
+import shutil
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Callable, Dict, List, Tuple
+import numpy as np
+import torch
+from PIL import Image
+from backend import BACKENDS, DEFAULT_BACKEND, set_threads
+from inference import chunked, forward_batch
+from part_extraction import crop, load_image, save, smooth_image
+from predicte import create_pretrain_model, get_preprocess, probabilities_to_dict
+from results import open_sink
+from utils import generate_html_report, normalise
+
+# Size (width, height) of the synthetic layer images
+IMAGE_SIZE = (1500, 1500)
+# Part cropped from the synthetic layer images
+LEFT_UP = (600, 600)
+RIGHT_DOWN = (824, 824)
+
+
+def make_synthetic_images(folder: Path, count: int, seed: int = 0) -> List[Path]:
+    """
+    Create ELO like layer images: a low contrast grey powder bed with noise, brighter
+    rectangular parts and dark pores, saved in jpg like the camera images.
+    The images already in the folder are reused.
+    :param folder: Folder where the images are saved
+    :param count: Number of images
+    :param seed: Seed of the random generator, the images are the same for a seed
+    :return: list of path of images
+    """
+    folder.mkdir(parents=True, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    width, height = IMAGE_SIZE
+    images = []
+    for i in range(count):
+        img_path = folder / f"layer_{i:05d}.jpg"
+        images.append(img_path)
+        # The random state is consumed for every image, so an image does not depend on the cache
+        noise = rng.normal(0, 1.5, (height, width, 1))
+        pores = rng.integers(0, [width, height], (20, 2))
+        if img_path.is_file():
+            continue
+        arr = np.full((height, width, 3), [138.0, 139.0, 141.0]) + noise
+        for x in range(100, width - 300, 350):
+            for y in range(100, height - 300, 350):
+                arr[y : y + 224, x : x + 224] += 4
+        for x, y in pores:
+            arr[max(y - 2, 0) : y + 2, max(x - 2, 0) : x + 2] -= 6
+        Image.fromarray(np.clip(arr, 0, 255).astype("uint8")).save(img_path, quality=90)
+    return images
+
+
+def measure(function: Callable, repeat: int):
+    """
+    Run a function several times and keep the best time.
+    :param function: Function without argument
+    :param repeat: Number of runs
+    :return: (best time in s, result of the last run)
+    """
+    best = float("inf")
+    result = None
+    for i in range(max(repeat, 1)):
+        start = time.perf_counter()
+        result = function()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def run_pipeline(
+    images: List[Path],
+    smooth: int,
+    batch_sizes: List[int],
+    model,
+    work_folder: Path,
+    repeat: int,
+) -> List[Dict]:
+    """
+    Run each stage of the classification pipeline on a list of images and measure it.
+    :param images: list of path of images
+    :param smooth: Number of smoothing iterations
+    :param batch_sizes: Batch sizes of the forward pass
+    :param model: the pretrained model
+    :param work_folder: Folder where the crops, results and report are written
+    :param repeat: Number of runs of each stage, the best time is kept
+    :return: list of measures (stage, batch_size, seconds)
+    """
+    work_folder.mkdir(parents=True, exist_ok=True)
+    preprocess = get_preprocess()
+    measures = []
+
+    def add(stage: str, function: Callable, batch_size: int = None):
+        seconds, result = measure(function, repeat)
+        measures.append({"stage": stage, "batch_size": batch_size, "seconds": seconds})
+        return result
+
+    imgs = add("decode", lambda: [load_image(img, 0) for img in images])
+    imgs = add("smooth", lambda: [smooth_image(img, smooth) for img in imgs])
+    imgs = add("normalise", lambda: [normalise(img) for img in imgs])
+    crops = add("crop", lambda: [crop(img, LEFT_UP, RIGHT_DOWN) for img in imgs])
+    add(
+        "resize_save",
+        lambda: [
+            save(img, work_folder / f"{i:05d}.png") for i, img in enumerate(crops)
+        ],
+    )
+    tensors = add("preprocess", lambda: [preprocess(img) for img in crops])
+
+    def forward(batch_size):
+        probabilities = []
+        for batch in chunked(tensors, batch_size):
+            output = forward_batch(model, batch)
+            probabilities.extend(torch.nn.functional.softmax(output, dim=1))
+        return probabilities
+
+    for batch_size in batch_sizes:
+        probabilities = add("forward", lambda: forward(batch_size), batch_size)
+    rows = [
+        probabilities_to_dict(img, probability)
+        for img, probability in zip(images, probabilities)
+    ]
+
+    results_csv = work_folder / "results.csv"
+
+    def write_results():
+        results_csv.unlink(missing_ok=True)
+        with open_sink(results_csv) as sink:
+            for row in rows:
+                sink.write(row)
+
+    add("write_results", write_results)
+
+    report = work_folder / "results.html"
+
+    def html_report():
+        # The thumbnails are created again, as for a new report
+        shutil.rmtree(work_folder / "results_thumbnails", ignore_errors=True)
+        generate_html_report(results_csv, report)
+
+    add("html_report", html_report)
+    return measures
+
+
+def benchmark(
+    counts: List[int],
+    smooth_levels: List[int],
+    batch_sizes: List[int],
+    repeat: int = 3,
+    backend: str = DEFAULT_BACKEND,
+    work_folder: Path = None,
+) -> Dict:
+    """
+    Measure each stage of the pipeline for every number of images and smoothing level.
+    :param counts: Numbers of images
+    :param smooth_levels: Numbers of smoothing iterations
+    :param batch_sizes: Batch sizes of the forward pass
+    :param repeat: Number of runs of each stage, the best time is kept
+    :param backend: Inference backend (see backend.BACKENDS)
+    :param work_folder: Folder of the synthetic images and outputs, a temporary folder by default
+    :return: dictionary with the environment, the parameters and the measures
+    """
+    model = create_pretrain_model(backend=backend)
+    temporary = None
+    if work_folder is None:
+        temporary = tempfile.TemporaryDirectory()
+        work_folder = Path(temporary.name)
+    work_folder = Path(work_folder)
+    images = make_synthetic_images(work_folder / "images", max(counts))
+
+    results = []
+    try:
+        for count in counts:
+            for smooth in smooth_levels:
+                print(f"{count} images, smooth {smooth}")
+                measures = run_pipeline(
+                    images[:count],
+                    smooth,
+                    batch_sizes,
+                    model,
+                    work_folder / f"{count}_{smooth}",
+                    repeat,
+                )
+                for measure_ in measures:
+                    measure_.update(
+                        images=count,
+                        smooth=smooth,
+                        ms_per_image=1000 * measure_["seconds"] / count,
+                    )
+                results.extend(measures)
+    finally:
+        if temporary is not None:
+            temporary.cleanup()
+
+    return {
+        "environment": {
+            "python": platform.python_version(),
+            "torch": torch.__version__,
+            "platform": platform.platform(),
+            "processor": platform.processor(),
+            "threads": torch.get_num_threads(),
+        },
+        "parameters": {
+            "image_size": IMAGE_SIZE,
+            "left_up": LEFT_UP,
+            "right_down": RIGHT_DOWN,
+            "repeat": repeat,
+            "backend": backend,
+        },
+        "results": results,
+    }
+
+
+def case_key(measure_: Dict) -> Tuple:
+    """
+    Identify a measure, to find the same measure in a baseline.
+    :param measure_: one of the measures given by benchmark
+    :return: (stage, images, smooth, batch_size)
+    """
+    return (
+        measure_["stage"],
+        measure_["images"],
+        measure_["smooth"],
+        measure_["batch_size"],
+    )
+
+
+def compare(
+    results: Dict, baseline: Dict, threshold: float, min_difference: float
+) -> List[Dict]:
+    """
+    Compare the measures to a baseline, the measures missing from the baseline are ignored.
+    :param results: results given by benchmark
+    :param baseline: results of a previous run
+    :param threshold: Relative slow down accepted, ex: 0.2 for 20%
+    :param min_difference: Minimum slow down (s) considered as a regression, the shortest stages
+        are dominated by the noise of the measure
+    :return: list of the regressions (measure with the baseline time and the ratio)
+    """
+    reference = {case_key(measure_): measure_ for measure_ in baseline["results"]}
+    regressions = []
+    for measure_ in results["results"]:
+        previous = reference.get(case_key(measure_))
+        if previous is None:
+            continue
+        ratio = measure_["seconds"] / max(previous["seconds"], 1e-9)
+        if (
+            ratio > 1 + threshold
+            and measure_["seconds"] - previous["seconds"] > min_difference
+        ):
+            regressions.append(
+                dict(measure_, baseline_seconds=previous["seconds"], ratio=ratio)
+            )
+    return regressions
+
+
+def print_results(results: Dict, baseline: Dict = None) -> None:
+    """
+    Print the time of each stage, and the ratio to the baseline if given.
+    :param results: results given by benchmark
+    :param baseline: results of a previous run
+    :return: None
+    """
+    reference = {}
+    if baseline is not None:
+        reference = {case_key(measure_): measure_ for measure_ in baseline["results"]}
+    print(
+        f"{'stage':<16}{'images':>8}{'smooth':>8}{'batch':>7}"
+        f"{'time (ms)':>12}{'ms/image':>10}{'vs baseline':>13}"
+    )
+    for measure_ in results["results"]:
+        previous = reference.get(case_key(measure_))
+        ratio = ""
+        if previous is not None:
+            ratio = f"x{measure_['seconds'] / max(previous['seconds'], 1e-9):.2f}"
+        batch_size = measure_["batch_size"] or ""
+        print(
+            f"{measure_['stage']:<16}{measure_['images']:>8}{measure_['smooth']:>8}"
+            f"{batch_size:>7}{1000 * measure_['seconds']:>12.1f}"
+            f"{measure_['ms_per_image']:>10.2f}{ratio:>13}"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark each stage of the classification pipeline on synthetic ELO images "
+        "(offline, on the CPU) and compare it to a baseline."
+    )
+    parser.add_argument(
+        "--counts",
+        type=int,
+        nargs="+",
+        default=[8, 32],
+        help="Numbers of images",
+    )
+    parser.add_argument(
+        "--smooth",
+        type=int,
+        nargs="+",
+        default=[0, 10],
+        help="Numbers of smoothing iterations",
+    )
+    parser.add_argument(
+        "--batch_sizes",
+        type=int,
+        nargs="+",
+        default=[1, 8, 32],
+        help="Batch sizes of the forward pass",
+    )
+    parser.add_argument(
+        "--repeat", type=int, default=3, help="Number of runs of each stage"
+    )
+    parser.add_argument(
+        "--backend",
+        choices=BACKENDS,
+        default=DEFAULT_BACKEND,
+        help="Inference backend",
+    )
+    parser.add_argument(
+        "--threads",
+        type=int,
+        default=1,
+        help="Number of intra op threads, fixed so the measures are comparable",
+    )
+    parser.add_argument(
+        "--work_folder",
+        type=Path,
+        default=None,
+        help="Folder of the synthetic images and outputs, kept to be reused (default: temporary folder)",
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
+        type=Path,
+        default=Path("benchmark_results.json"),
+        help="json file where the results are saved",
+    )
+    parser.add_argument(
+        "--baseline",
+        type=Path,
+        default=None,
+        help="json results of a previous run, the script fails if a stage is slower",
+    )
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.2,
+        help="Relative slow down accepted compared to the baseline (0.2: 20%%)",
+    )
+    parser.add_argument(
+        "--min_difference_ms",
+        type=float,
+        default=5.0,
+        help="Minimum slow down (ms) considered as a regression",
+    )
+    parser.add_argument(
+        "--save_baseline",
+        action="store_true",
+        help="Also save the results as the baseline (--baseline path)",
+    )
+    args = parser.parse_args()
+
+    set_threads(args.threads)
+    results = benchmark(
+        args.counts,
+        args.smooth,
+        args.batch_sizes,
+        args.repeat,
+        args.backend,
+        args.work_folder,
+    )
+    args.output.write_text(json.dumps(results, indent=2))
+    print(f"Results saved in {args.output}")
+
+    baseline = None
+    if args.baseline is not None and args.baseline.is_file():
+        baseline = json.loads(args.baseline.read_text())
+    print_results(results, baseline)
+
+    regressions = []
+    if baseline is not None:
+        regressions = compare(
+            results, baseline, args.threshold, args.min_difference_ms / 1000
+        )
+        for regression in regressions:
+            print(
+                f"Regression: {regression['stage']} ({regression['images']} images, "
+                f"smooth {regression['smooth']}, batch {regression['batch_size']}) "
+                f"{1000 * regression['baseline_seconds']:.1f} ms -> "
+                f"{1000 * regression['seconds']:.1f} ms (x{regression['ratio']:.2f})"
+            )
+    if args.save_baseline and args.baseline is not None:
+        args.baseline.write_text(json.dumps(results, indent=2))
+        print(f"Baseline saved in {args.baseline}")
+    sys.exit(1 if regressions else 0)
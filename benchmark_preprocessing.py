@@ -0,0 +1,269 @@
+import argparse
+import time
+from multiprocessing import get_context
+from pathlib import Path
+import numpy as np
+from PIL import Image, ImageFilter
+from part_extraction import extract_part
+from utils import normalise, normalise_batch, smooth
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+
+def reference_normalise(arr: Image) -> Image:
+    """
+    Previous implementation of utils.normalise (float copies of the whole image), used as reference.
+    :param arr: Image to normalise
+    :return: PIL.Image normalised
+    """
+    arr = np.array(arr)
+    arr = arr.astype("float")
+    for i in range(3):
+        minval = arr[..., i].min()
+        maxval = arr[..., i].max()
+        if minval != maxval:
+            arr[..., i] -= minval
+            arr[..., i] *= 255.0 / (maxval - minval)
+
+    arr = Image.fromarray(arr.astype("uint8"), "RGB")
+    return arr
+
+
+def reference_smooth(img: Image, iterations: int) -> Image:
+    """
+    Previous smoothing, one PIL filter call per iteration, used as reference.
+    :param img: PIL.Image to smooth
+    :param iterations: Number of times the image is smoothed
+    :return: PIL.Image smoothed
+    """
+    for i in range(iterations):
+        img = img.filter(ImageFilter.SMOOTH_MORE)
+    return img
+
+
+def reference_normalise_batch(arr: np.ndarray) -> np.ndarray:
+    """
+    Normalise a stack of crops one by one with the previous implementation.
+    :param arr: uint8 array of shape (N, H, W, 3)
+    :return: uint8 array of shape (N, H, W, 3)
+    """
+    return np.stack([np.asarray(reference_normalise(crop)) for crop in arr])
+
+
+def max_rss_mb() -> float:
+    """
+    Peak resident memory of the current process.
+    :return: peak memory in MB, 0 if it can not be measured
+    """
+    # On Linux ru_maxrss can be inherited from the parent process, VmHWM is not
+    status = Path("/proc/self/status")
+    if status.is_file():
+        for line in status.read_text().splitlines():
+            if line.startswith("VmHWM:"):
+                return int(line.split()[1]) / 1024
+    if resource is None:
+        return 0.0
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def run_case(
+    case: str,
+    img_path: Path,
+    iterations: int,
+    repeat: int,
+    crops: int,
+    decode_size: int = 224,
+):
+    """
+    Run one benchmark case, called in a new process to measure its own peak memory.
+    :param case: name of the function to measure
+    :param img_path: Path of the image used for the benchmark
+    :param iterations: Number of smoothing iterations
+    :param repeat: Number of runs, the best time is kept
+    :param crops: Number of 224x224 crops of the batch cases
+    :param decode_size: Minimum size of the region of the reduced decoding case
+    :return: (best time in s, peak memory increase in MB)
+    """
+    if case.startswith("decode and crop"):
+        # The image is not decoded in advance, the decoding is measured
+        with Image.open(img_path) as img:
+            roi = ((0, 0), img.size)
+        size = decode_size if case == "decode and crop (reduced)" else None
+        function = lambda: extract_part(
+            img_path, *roi, True, iterations, decode_size=size
+        )
+        return measure(function, repeat)
+
+    img = Image.open(img_path).convert("RGB")
+    arr = np.asarray(img)
+    batch = np.stack(
+        [np.asarray(img.crop((i, i, i + 224, i + 224))) for i in range(crops)]
+    )
+    functions = {
+        "normalise (previous)": lambda: reference_normalise(img),
+        "normalise (lookup table)": lambda: normalise(img),
+        "normalise batch (previous)": lambda: reference_normalise_batch(batch),
+        "normalise batch (lookup table)": lambda: normalise_batch(batch),
+        "smooth (previous)": lambda: reference_smooth(img, iterations),
+        "smooth (fused)": lambda: smooth(arr, iterations),
+    }
+    return measure(functions[case], repeat)
+
+
+def measure(function, repeat: int):
+    """
+    Measure the best time and the peak memory increase of a function.
+    :param function: Function called without argument
+    :param repeat: Number of runs, the best time is kept
+    :return: (best time in s, peak memory increase in MB)
+    """
+    start_rss = max_rss_mb()
+    best = float("inf")
+    for i in range(repeat):
+        start = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - start)
+    return best, max_rss_mb() - start_rss
+
+
+def check_parity(img_path: Path, iterations: int) -> None:
+    """
+    Print the differences between the previous and the new implementations.
+    :param img_path: Path of the image used for the benchmark
+    :param iterations: Number of smoothing iterations
+    :return: None
+    """
+    img = Image.open(img_path).convert("RGB")
+    normalised = np.asarray(normalise(img)).astype("int16")
+    reference = np.asarray(reference_normalise(img)).astype("int16")
+    print(f"normalise max difference: {np.abs(normalised - reference).max()}")
+    batch = np.stack(
+        [np.asarray(img.crop((i, i, i + 224, i + 224))) for i in range(0, 640, 10)]
+    )
+    normalised = normalise_batch(batch).astype("int16")
+    reference = reference_normalise_batch(batch).astype("int16")
+    print(f"normalise batch max difference: {np.abs(normalised - reference).max()}")
+    smoothed = smooth(np.asarray(img), iterations).astype("int16")
+    reference = np.asarray(reference_smooth(img, iterations)).astype("int16")
+    difference = np.abs(smoothed - reference)
+    print(
+        f"smooth max difference: {difference.max()}, "
+        f"pixels with a difference: {100 * (difference > 0).mean():.3f}%"
+    )
+
+
+def check_classification_parity(
+    folder: Path, iterations: int, decode_size: int, model_name: str = "v1"
+) -> None:
+    """
+    Classify the whole images of a folder decoded at full and at reduced resolution, and print
+    the differences of the classification (probabilities, model outputs and predicted class).
+    :param folder: Folder of images
+    :param iterations: Number of smoothing iterations
+    :param decode_size: Minimum size of the region of the reduced decoding
+    :param model_name: Name of the model used (see models.MODELS)
+    :return: None
+    """
+    import torch
+    from models import get_preprocess, load_model
+
+    model = load_model(model_name)
+    preprocess = get_preprocess(model_name)
+    differences = []
+    output_differences = []
+    same_class = 0
+    paths = sorted(folder.glob("*.jpg")) + sorted(folder.glob("*.png"))
+    for path in paths:
+        with Image.open(path) as img:
+            roi = ((0, 0), img.size)
+        inputs = [
+            preprocess(extract_part(path, *roi, True, iterations, decode_size=size))
+            for size in (None, decode_size)
+        ]
+        with torch.no_grad():
+            outputs = model(torch.stack(inputs))
+        probabilities = torch.softmax(outputs, dim=1)
+        # The probabilities of a confident model are saturated, the outputs show smaller changes
+        output_differences.append((outputs[0] - outputs[1]).abs().max().item())
+        differences.append((probabilities[0] - probabilities[1]).abs().max().item())
+        same_class += int(probabilities[0].argmax() == probabilities[1].argmax())
+    print(
+        f"classification of {len(paths)} images, max probability difference: {max(differences):.4f}, "
+        f"mean: {np.mean(differences):.4f}, max output difference: {max(output_differences):.3f}, "
+        f"same class: {same_class}/{len(paths)}"
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark the normalisation and smoothing against their previous implementation."
+    )
+    parser.add_argument(
+        "-i",
+        "--input_img",
+        type=Path,
+        default=Path("imgs/demo_full_powder_bed.png"),
+        help="Image used for the benchmark",
+    )
+    parser.add_argument(
+        "-s",
+        "--smooth",
+        type=int,
+        default=10,
+        help="Number of smoothing iterations",
+    )
+    parser.add_argument(
+        "--repeat", type=int, default=3, help="Number of runs of each case"
+    )
+    parser.add_argument(
+        "--crops", type=int, default=64, help="Number of crops of the batch cases"
+    )
+    parser.add_argument(
+        "--decode_size",
+        type=int,
+        default=224,
+        help="Minimum size of the region of the reduced resolution decoding case",
+    )
+    parser.add_argument(
+        "--parity_folder",
+        type=Path,
+        default=None,
+        help="If given, the images of this folder are classified with the full and the reduced "
+        "resolution decoding and the differences are printed",
+    )
+    args = parser.parse_args()
+
+    check_parity(args.input_img, args.smooth)
+    if args.parity_folder is not None:
+        check_classification_parity(args.parity_folder, args.smooth, args.decode_size)
+
+    cases = [
+        "normalise (previous)",
+        "normalise (lookup table)",
+        "normalise batch (previous)",
+        "normalise batch (lookup table)",
+        "smooth (previous)",
+        "smooth (fused)",
+        "decode and crop (full resolution)",
+        "decode and crop (reduced)",
+    ]
+    print(f"{'case':<36}{'time (ms)':>12}{'peak memory (MB)':>20}")
+    # Each case run in a new process, so the peak memory of a case is not hidden by the previous ones
+    context = get_context("spawn")
+    for case in cases:
+        with context.Pool(1) as pool:
+            best, memory = pool.apply(
+                run_case,
+                (
+                    case,
+                    args.input_img,
+                    args.smooth,
+                    args.repeat,
+                    args.crops,
+                    args.decode_size,
+                ),
+            )
+        print(f"{case:<36}{1000 * best:>12.1f}{memory:>20.1f}")
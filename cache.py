@@ -0,0 +1,229 @@
+import hashlib
+import json
+import sqlite3
+import time
+from pathlib import Path
+from typing import List, Optional
+import numpy as np
+
+# Size of the blocks read to hash a file
+HASH_BLOCK_SIZE = 1 << 20
+# Number of changes (hashes and results) after which the cache is committed
+DEFAULT_COMMIT_EVERY = 256
+# Maximum time (s) a change stays uncommitted
+DEFAULT_COMMIT_INTERVAL = 5.0
+
+
+class ResultCache:
+    """
+    Persistent cache of the classification results, stored in a SQLite file.
+    The results of an image are indexed by the hash of its content, the hash of the model weights and
+    the preprocessing parameters, so an image is only classified again if one of them changed.
+    The hash of a file is only computed again if its path, size or modification time changed.
+    The changes are committed every commit_every changes, when a change is made more than
+    commit_interval seconds after the last commit and when the cache is closed, so a crash only
+    loses the last results (as results.ResultSink).
+    """
+
+    def __init__(
+        self,
+        cache_path: Path,
+        max_size_mb: float = None,
+        max_age_days: float = None,
+        commit_every: int = DEFAULT_COMMIT_EVERY,
+        commit_interval: float = DEFAULT_COMMIT_INTERVAL,
+    ):
+        """
+        :param cache_path: Path of the SQLite file of the cache (created if missing)
+        :param max_size_mb: If not None, the least recently used results are removed above this size
+        :param max_age_days: If not None, the results not used for this number of days are removed
+        :param commit_every: Number of changes (file hashes and results) before a commit
+        :param commit_interval: Maximum time (s) a change stays uncommitted
+        """
+        self.cache_path = Path(cache_path)
+        self.cache_path.parent.mkdir(parents=True, exist_ok=True)
+        self.max_size_mb = max_size_mb
+        self.max_age_days = max_age_days
+        self.commit_every = commit_every
+        self.commit_interval = commit_interval
+        self.changes = 0
+        self.last_commit = time.monotonic()
+        self.connection = sqlite3.connect(str(self.cache_path))
+        self.connection.executescript("""
+            CREATE TABLE IF NOT EXISTS files (
+                path TEXT PRIMARY KEY, size INTEGER, mtime INTEGER, hash TEXT
+            );
+            CREATE TABLE IF NOT EXISTS results (
+                key TEXT PRIMARY KEY, rows TEXT, size INTEGER, accessed REAL
+            );
+            CREATE INDEX IF NOT EXISTS results_accessed ON results (accessed);
+            """)
+        self.hits = 0
+        self.misses = 0
+
+    def file_hash(self, path: Path) -> str:
+        """
+        Hash of the content of a file, reused while the path, size and modification time are the same.
+        :param path: Path of the file
+        :return: sha256 hexdigest
+        """
+        path = Path(path)
+        stat = path.stat()
+        known = self.connection.execute(
+            "SELECT hash FROM files WHERE path = ? AND size = ? AND mtime = ?",
+            (str(path.resolve()), stat.st_size, stat.st_mtime_ns),
+        ).fetchone()
+        if known is not None:
+            return known[0]
+
+        digest = hash_file(path)
+        self.connection.execute(
+            "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)",
+            (str(path.resolve()), stat.st_size, stat.st_mtime_ns, digest),
+        )
+        self.changed()
+        return digest
+
+    def key(self, image: Path, context: str) -> str:
+        """
+        Key of the results of an image.
+        :param image: Path of the input image
+        :param context: Description of the model and preprocessing (see make_context)
+        :return: sha256 hexdigest
+        """
+        return hashlib.sha256((self.file_hash(image) + context).encode()).hexdigest()
+
+    def get(self, key: str) -> Optional[List[dict]]:
+        """
+        Results of an image, if they are in the cache.
+        :param key: Key of the image (see key)
+        :return: list of rows (dictionary with the image name and the classification probability) or None
+        """
+        found = self.connection.execute(
+            "SELECT rows FROM results WHERE key = ?", (key,)
+        ).fetchone()
+        if found is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.connection.execute(
+            "UPDATE results SET accessed = ? WHERE key = ?", (time.time(), key)
+        )
+        return [from_json(row) for row in json.loads(found[0])]
+
+    def put(self, key: str, rows: List[dict]) -> None:
+        """
+        Store the results of an image.
+        :param key: Key of the image (see key)
+        :param rows: list of rows (dictionary with the image name and the classification probability)
+        :return: None
+        """
+        data = json.dumps([to_json(row) for row in rows])
+        self.connection.execute(
+            "INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?)",
+            (key, data, len(data), time.time()),
+        )
+        self.changed()
+
+    def changed(self) -> None:
+        """
+        Count one change, and commit if commit_every changes are waiting or if the last commit is
+        older than commit_interval seconds.
+        :return: None
+        """
+        self.changes += 1
+        if (
+            self.changes >= self.commit_every
+            or time.monotonic() - self.last_commit >= self.commit_interval
+        ):
+            self.commit()
+
+    def commit(self) -> None:
+        """
+        Save the changes in the cache file.
+        :return: None
+        """
+        self.connection.commit()
+        self.changes = 0
+        self.last_commit = time.monotonic()
+
+    def evict(self) -> None:
+        """
+        Remove the results older than max_age_days, then the least recently used ones above max_size_mb.
+        :return: None
+        """
+        if self.max_age_days is not None:
+            self.connection.execute(
+                "DELETE FROM results WHERE accessed < ?",
+                (time.time() - self.max_age_days * 86400,),
+            )
+        if self.max_size_mb is not None:
+            max_size = self.max_size_mb * 1024 * 1024
+            total = 0
+            for key, size in self.connection.execute(
+                "SELECT key, size FROM results ORDER BY accessed DESC"
+            ).fetchall():
+                total += size
+                if total > max_size:
+                    self.connection.execute(
+                        "DELETE FROM results WHERE accessed <= "
+                        "(SELECT accessed FROM results WHERE key = ?)",
+                        (key,),
+                    )
+                    break
+
+    def close(self) -> None:
+        """
+        Apply the eviction rules and save the cache.
+        :return: None
+        """
+        self.evict()
+        self.commit()
+        self.connection.close()
+
+
+def hash_file(path: Path) -> str:
+    """
+    Hash of the content of a file.
+    :param path: Path of the file
+    :return: sha256 hexdigest
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def make_context(model_hash: str, **parameters) -> str:
+    """
+    Description of everything, other than the image, that change the classification results.
+    :param model_hash: Hash of the model weights
+    :param parameters: Preprocessing parameters (crop box, normalise, smooth, ...)
+    :return: str
+    """
+    return json.dumps({"model": model_hash, **parameters}, sort_keys=True, default=str)
+
+
+def to_json(row: dict) -> dict:
+    """
+    Convert the numpy values of a row for json, the float32 text is kept so it is written as before.
+    :param row: dictionary with the image name and the classification probability.
+    :return: dictionary
+    """
+    return {
+        key: {"float32": str(value)} if isinstance(value, np.float32) else value
+        for key, value in row.items()
+    }
+
+
+def from_json(row: dict) -> dict:
+    """
+    Inverse of to_json.
+    :param row: dictionary from the cache
+    :return: dictionary with the image name and the classification probability.
+    """
+    return {
+        key: np.float32(value["float32"]) if isinstance(value, dict) else value
+        for key, value in row.items()
+    }
@@ -0,0 +1,115 @@
+from typing import Any, Dict, List, Tuple
+import torch
+
+# Size of the signature of a crop: the crop is averaged on a grid of SIGNATURE_SIZE x SIGNATURE_SIZE cells
+SIGNATURE_SIZE = 16
+
+
+class ChangeDetector:
+    """
+    Skip the classification of a crop nearly identical to the previous layer of the same region.
+    Each crop gets a cheap signature (the preprocessed crop averaged on a 16x16 grid, without its mean
+    brightness that changes with the normalisation of noisy images). It is compared
+    with the signature of the last classified crop of the same region (the anchor), and if the mean
+    difference is below the threshold the results of the anchor are reused.
+    Comparing with the anchor instead of the previous layer avoids a slow drift never being classified.
+    In validation mode every crop is classified, and the drift between the results that would have
+    been reused and the ones of the full inference is measured.
+    """
+
+    def __init__(
+        self,
+        threshold: float,
+        std: List[float] = None,
+        validate: bool = False,
+        signature_size: int = SIGNATURE_SIZE,
+    ):
+        """
+        :param threshold: Maximum mean difference (grey levels, 0-255) of the signatures of a
+            reused crop and its anchor
+        :param std: Standard deviation used to normalise each channel of the model inputs, to give
+            the differences in grey levels (see models.ModelSpec), None for inputs in [0, 1]
+        :param validate: If True, the crops are always classified and the drift is measured
+        :param signature_size: Size of the grid of the signatures
+        """
+        self.threshold = threshold
+        self.std = torch.tensor(std or [1.0] * 3).view(3, 1, 1)
+        self.validate = validate
+        self.signature_size = signature_size
+        # Anchor of each region {part name: {"signature": Tensor, "result": (output, probabilities)}}
+        self.anchors = {}
+        self.reused = set()
+        self.checked = 0
+        self.skipped = 0
+        self.drifts = []
+        self.same_class = 0
+
+    def signature(self, tensor: torch.Tensor) -> torch.Tensor:
+        """
+        Signature of a preprocessed crop, in grey levels, the mean of each channel is removed.
+        :param tensor: Model input (3, H, W)
+        :return: Tensor (3, signature_size, signature_size)
+        """
+        pooled = torch.nn.functional.adaptive_avg_pool2d(tensor, self.signature_size)
+        pooled = pooled - pooled.mean(dim=(1, 2), keepdim=True)
+        return pooled * self.std * 255
+
+    def check(self, name: Any, tensor: torch.Tensor) -> Tuple[Dict, bool]:
+        """
+        Compare a crop with the anchor of its region.
+        :param name: Name of the crop, (image path, part name) for a part of a layer image
+        :param tensor: Model input (3, H, W)
+        :return: (anchor, True) if the results of the anchor can be reused, otherwise
+            (new anchor, False) and the results of the crop must be given to the new anchor
+        """
+        region = name[1] if isinstance(name, tuple) else None
+        signature = self.signature(tensor)
+        self.checked += 1
+        anchor = self.anchors.get(region)
+        if (
+            anchor is not None
+            and (signature - anchor["signature"]).abs().mean().item() <= self.threshold
+        ):
+            self.skipped += 1
+            self.reused.add(name)
+            return anchor, True
+        anchor = {"signature": signature, "result": None}
+        self.anchors[region] = anchor
+        return anchor, False
+
+    def record_drift(self, result: Tuple, reused: Tuple) -> None:
+        """
+        Measure the drift of a reused result (validation mode).
+        :param result: (output, probabilities) of the full inference
+        :param reused: (output, probabilities) that would have been reused
+        :return: None
+        """
+        self.drifts.append((result[1] - reused[1]).abs().max().item())
+        self.same_class += int(result[1].argmax() == reused[1].argmax())
+
+    def is_reused(self, name: Any) -> bool:
+        """
+        Tell if the results of a crop are the ones of its anchor (or would be, in validation mode).
+        :param name: Name of the crop
+        :return: bool
+        """
+        if name in self.reused:
+            self.reused.discard(name)
+            return True
+        return False
+
+    def summary(self) -> Dict[str, float]:
+        """
+        Skip rate and, in validation mode, drift of the reused results.
+        :return: dictionary
+        """
+        summary = {
+            "checked": self.checked,
+            "skipped": self.skipped,
+            "skip_rate": self.skipped / self.checked if self.checked else 0.0,
+        }
+        if self.validate and self.drifts:
+            summary["max_drift"] = max(self.drifts)
+            summary["mean_drift"] = sum(self.drifts) / len(self.drifts)
+            summary["same_class"] = self.same_class / len(self.drifts)
+        return summary
@@ -0,0 +1,82 @@
+import os
+import re
+from pathlib import Path
+from typing import Iterable, Iterator
+
+# Extensions of the images found by default
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png")
+# Orders of the images:
+# - natural: by name, the numbers compared by value (14-9-41.jpg before 14-10-2.jpg)
+# - mtime: by modification time, the acquisition order of the layers
+# - none: as given by the file system, without holding the names of a folder
+ORDERS = ["natural", "mtime", "none"]
+DEFAULT_ORDER = "natural"
+
+_DIGITS = re.compile(r"(\d+)")
+
+
+def _number_key(match) -> str:
+    # The number of digits is put before the number, so a longer number is sorted after
+    digits = match.group().lstrip("0") or "0"
+    return chr(len(digits)) + digits
+
+
+def natural_key(name: str) -> str:
+    """
+    Sort key of a file name where the numbers are compared by value, ex: the layer images
+    named by their acquisition time (14-25-41.jpg) or their number (layer_2.jpg before layer_10.jpg).
+    The key is a string a bit longer than the name, cheaper to keep than a tuple for large folders.
+    :param name: file name
+    :return: str
+    """
+    return _DIGITS.sub(_number_key, name.lower())
+
+
+def scan_images(
+    folder: Path,
+    extensions: Iterable[str] = IMAGE_EXTENSIONS,
+    recursive: bool = False,
+    order: str = DEFAULT_ORDER,
+) -> Iterator[Path]:
+    """
+    Find the images of a folder lazily with os.scandir, so the first images can be processed
+    before the whole folder is read and no list of Path is built.
+    The images are given in layer order: the images of a folder first, then its sub folders
+    (with recursive) in natural order. To sort a folder, only the names of its images are kept
+    in memory, with order="none" the images are given as they are read.
+    :param folder: Folder of the images
+    :param extensions: Extensions of the images to find (case insensitive)
+    :param recursive: If True, the images of the sub folders are also found
+    :param order: natural, mtime or none (see ORDERS)
+    :return: Iterator of path of images
+    """
+    if order not in ORDERS:
+        raise ValueError(f"Unknown order {order}, expected one of {ORDERS}")
+    extensions = tuple(extension.lower() for extension in extensions)
+    folder = Path(folder)
+    files = []
+    subfolders = []
+    with os.scandir(folder) as entries:
+        for entry in entries:
+            if entry.is_file() and entry.name.lower().endswith(extensions):
+                if order == "none":
+                    yield folder / entry.name
+                elif order == "mtime":
+                    files.append((entry.stat().st_mtime, entry.name))
+                else:
+                    files.append(entry.name)
+            elif recursive and entry.is_dir():
+                subfolders.append(entry.name)
+
+    if order == "mtime":
+        files.sort(key=lambda file: (file[0], natural_key(file[1])))
+        files = [name for _, name in files]
+    else:
+        files.sort(key=natural_key)
+    # The names are removed once given, so the memory is released while the images are processed
+    files.reverse()
+    while files:
+        yield folder / files.pop()
+
+    for subfolder in sorted(subfolders, key=natural_key):
+        yield from scan_images(folder / subfolder, extensions, recursive, order)
@@ -1,8 +1,8 @@
 import matplotlib.pyplot as plt
-import matplotlib.image as mpimg
 from pathlib import Path
-from typing import Tuple
+from typing import List, Tuple
 import argparse
+from PIL import Image
 from part_extraction import part_extraction
 from utils import normalise
 
@@ -17,6 +17,10 @@ global right_down_point
 left_up = (0, 0)
 right_down = (0, 0)
 
+# Largest side of the displayed image, the layer images of large machines are shown through
+# reduced levels and the finer levels are only used for the zoomed area
+PREVIEW_SIZE = 1024
+
 
 def onclick(event) -> None:
     """
@@ -58,6 +62,48 @@ def onclick(event) -> None:
     plt.draw()
 
 
+def build_pyramid(img: Image, preview_size: int = PREVIEW_SIZE) -> List[Image]:
+    """
+    Reduce an image by 2 until it is not larger than preview_size.
+    :param img: PIL.Image at full resolution
+    :param preview_size: Largest side of the most reduced level
+    :return: list of PIL.Image, from the full resolution to the most reduced level
+    """
+    levels = [img]
+    while max(levels[-1].size) > preview_size:
+        levels.append(levels[-1].reduce(2))
+    return levels
+
+
+def show_level(image, levels: List[Image], preview_size: int = PREVIEW_SIZE) -> None:
+    """
+    Display the visible area of the image with the most reduced level still as detailed as the screen.
+    The displayed area keeps the coordinates of the full resolution image, so the clicks give
+    full resolution pixels.
+    :param image: matplotlib AxesImage displaying the image
+    :param levels: Levels of the image (see build_pyramid)
+    :param preview_size: Largest side of the displayed area
+    :return: None
+    """
+    width, height = levels[0].size
+    x_min, x_max = sorted(image.axes.get_xlim())
+    y_min, y_max = sorted(image.axes.get_ylim())
+    x_min, y_min = max(int(x_min), 0), max(int(y_min), 0)
+    x_max, y_max = min(int(x_max) + 1, width), min(int(y_max) + 1, height)
+    if x_min >= x_max or y_min >= y_max:
+        return
+    level = 0
+    while (
+        level + 1 < len(levels)
+        and max(x_max - x_min, y_max - y_min) > preview_size * 2**level
+    ):
+        level += 1
+    scale = 2**level
+    box = (x_min // scale, y_min // scale, -(-x_max // scale), -(-y_max // scale))
+    image.set_data(levels[level].crop(box))
+    image.set_extent((box[0] * scale, box[2] * scale, box[3] * scale, box[1] * scale))
+
+
 def display(
     img_path: Path, normalise_flag: bool = False
 ) -> Tuple[Tuple[int, int], Tuple[int, int]]:
@@ -72,12 +118,20 @@ def display(
     global left_up_point
     global right_down_point
 
-    img = mpimg.imread(img_path)
+    img = Image.open(img_path).convert("RGB")
     if normalise_flag:
         img = normalise(img)
+    levels = build_pyramid(img)
 
     fig, ax = plt.subplots()
-    ax.imshow(img)
+    # The most reduced level is displayed over the full resolution coordinates
+    width, height = img.size
+    image = ax.imshow(levels[-1], extent=(0, width, height, 0))
+    ax.set_autoscale_on(False)
+    if len(levels) > 1:
+        # When zooming, the visible area is displayed with a finer level
+        ax.callbacks.connect("xlim_changed", lambda axes: show_level(image, levels))
+        ax.callbacks.connect("ylim_changed", lambda axes: show_level(image, levels))
     ax.text(
         -100,
         -50,
@@ -0,0 +1,335 @@
+import argparse
+import time
+from pathlib import Path
+from typing import Dict, Tuple
+import numpy as np
+import torch
+from PIL import Image
+from metrics import span
+from models import get_spec, load_model
+from part_extraction import crop, load_image
+from utils import normalise
+
+# Colour of each class in the overlay image
+CLASS_COLOURS = {
+    "good": (0, 200, 0),
+    "porous": (230, 0, 0),
+    "bulging": (0, 90, 255),
+    "edges": (255, 200, 0),
+    "powder": (160, 160, 160),
+}
+# Opacity of the probability map on the overlay image
+OVERLAY_ALPHA = 0.45
+
+
+def check_fully_convolutional(model) -> None:
+    """
+    Check that a model can be run as a fully convolutional network: a features network followed by
+    a classifier ending with a global pooling (ex: torchvision SqueezeNet).
+    :param model: the pretrained model
+    :return: None
+    """
+    if not (
+        isinstance(getattr(model, "features", None), torch.nn.Module)
+        and isinstance(getattr(model, "classifier", None), torch.nn.Sequential)
+        and isinstance(model.classifier[-1], torch.nn.AdaptiveAvgPool2d)
+    ):
+        raise ValueError(
+            "The heat map needs a model ending with a 1x1 convolution and a global pooling "
+            "(SqueezeNet, --model v1 with the eager backend)"
+        )
+
+
+def score_map(model, batch: torch.Tensor) -> torch.Tensor:
+    """
+    Run the model without its final global pooling.
+    :param model: SqueezeNet like model (see check_fully_convolutional)
+    :param batch: Model input (N, 3, H, W) of any size
+    :return: Tensor (N, classes, h, w) of the scores of each location, before the pooling
+    """
+    with span("forward"), torch.no_grad():
+        return model.classifier[:-1](model.features(batch))
+
+
+def map_geometry(model, input_size: Tuple[int, int]) -> Tuple[Tuple[int, int], int]:
+    """
+    Size of the score map of one model input, and distance (model input pixels) between two
+    locations of the score map.
+    :param model: SqueezeNet like model
+    :param input_size: (height, width) of the model input
+    :return: ((h, w) of the score map of one input, stride)
+    """
+    height, width = input_size
+    small = score_map(model, torch.zeros(1, 3, height, width)).shape[-2:]
+    large = score_map(model, torch.zeros(1, 3, height, width + 256)).shape[-1]
+    return tuple(small), 256 // (large - small[1])
+
+
+def dense_probabilities(
+    model, region: torch.Tensor, window: Tuple[int, int]
+) -> torch.Tensor:
+    """
+    Classification of all the tiles of a region in one forward pass.
+    The scores of the locations are averaged over the size of the score map of one tile, as the global
+    pooling does for one tile, and the softmax gives the probabilities of the tile at each location.
+    Near its borders a tile sees the pixels around it instead of the zero padding of a lone crop, so
+    the probabilities are close to the ones of the crop classified alone but not equal (see --check).
+    :param model: SqueezeNet like model
+    :param region: Model input (1, 3, H, W) of the whole region
+    :param window: Size of the score map of one tile (see map_geometry)
+    :return: Tensor (classes, h, w) of the probabilities of the tile starting at each location
+    """
+    scores = score_map(model, region)
+    pooled = torch.nn.functional.avg_pool2d(scores, window, stride=1)
+    return torch.softmax(pooled, dim=1)[0]
+
+
+def prepare_region(
+    img: Path,
+    left_up: Tuple[int, int],
+    right_down: Tuple[int, int],
+    tile_size: int,
+    model_name: str = "v1",
+    normalise_flag: bool = False,
+    smooth: int = 0,
+) -> Tuple[Image.Image, torch.Tensor]:
+    """
+    Load and crop the region, and scale it so a tile of tile_size pixels is the size of a model input.
+    :param img: Path to the image
+    :param left_up: X,Y position of the left up corner
+    :param right_down: X,Y position of the right down corner
+    :param tile_size: Size (image pixels) of the crops the model classifies, ex: the size of the
+        regions cropped by part_extraction
+    :param model_name: Name of the model (see models.MODELS)
+    :param normalise_flag: Flag to normalise of not the image.
+    :param smooth: Number of times the image must be smoothed
+    :return: (PIL.Image of the region, model input (1, 3, H, W) of the scaled region)
+    """
+    from torchvision import transforms
+
+    spec = get_spec(model_name)
+    img = load_image(img, smooth)
+    if normalise_flag:
+        img = normalise(img)
+    region = crop(img, left_up, right_down).convert("RGB")
+    scale = spec.input_size[0] / tile_size
+    scaled = region.resize(
+        (round(region.width * scale), round(region.height * scale)), Image.BILINEAR
+    )
+    preprocess = transforms.Compose(
+        [transforms.ToTensor(), transforms.Normalize(mean=spec.mean, std=spec.std)]
+    )
+    return region, preprocess(scaled).unsqueeze(0)
+
+
+def heat_map(
+    model,
+    img: Path,
+    left_up: Tuple[int, int],
+    right_down: Tuple[int, int],
+    tile_size: int,
+    model_name: str = "v1",
+    normalise_flag: bool = False,
+    smooth: int = 0,
+) -> Dict:
+    """
+    Dense map of the class probabilities of a region, the network is run once on the whole region
+    instead of once per tile.
+    :param model: SqueezeNet like model (see check_fully_convolutional)
+    :param img: Path to the image
+    :param left_up: X,Y position of the left up corner
+    :param right_down: X,Y position of the right down corner
+    :param tile_size: Size (image pixels) of the tiles classified, the region must be at least this size
+    :param model_name: Name of the model (see models.MODELS)
+    :param normalise_flag: Flag to normalise of not the image.
+    :param smooth: Number of times the image must be smoothed
+    :return: dictionary with the "probabilities" array (h, w, classes), the "region" PIL.Image, the
+        model "input" and the "stride" (image pixels) between two locations of the map. The location
+        (i, j) is the tile with its left up corner at (j * stride, i * stride) in the region.
+    """
+    check_fully_convolutional(model)
+    spec = get_spec(model_name)
+    region, batch = prepare_region(
+        img, left_up, right_down, tile_size, model_name, normalise_flag, smooth
+    )
+    if min(batch.shape[-2:]) < min(spec.input_size):
+        raise ValueError(
+            f"The region must be at least {tile_size} pixels wide and high"
+        )
+    window, stride = map_geometry(model, spec.input_size)
+    probabilities = dense_probabilities(model, batch, window)
+    # The ceil mode poolings give locations whose tile ends past the input, only the tiles
+    # inside the input are kept
+    rows = (batch.shape[-2] - spec.input_size[0]) // stride + 1
+    columns = (batch.shape[-1] - spec.input_size[1]) // stride + 1
+    probabilities = probabilities[:, :rows, :columns]
+    return {
+        "probabilities": probabilities.permute(1, 2, 0).numpy(),
+        "region": region,
+        "input": batch,
+        "stride": stride * tile_size / spec.input_size[0],
+        "model_stride": stride,
+        "input_size": spec.input_size,
+    }
+
+
+def overlay(
+    region: Image.Image,
+    probabilities: np.ndarray,
+    stride: float,
+    tile_size: int,
+    classes,
+    alpha: float = OVERLAY_ALPHA,
+) -> Image.Image:
+    """
+    Colour the region with the class probabilities (see CLASS_COLOURS), each location of the map
+    colours the centre of its tile.
+    :param region: PIL.Image of the region
+    :param probabilities: array (h, w, classes) given by heat_map
+    :param stride: Distance (image pixels) between two locations of the map
+    :param tile_size: Size (image pixels) of the tiles
+    :param classes: Class names, in the order of the probabilities
+    :param alpha: Opacity of the map
+    :return: PIL.Image
+    """
+    colours = np.array([CLASS_COLOURS.get(name, (255, 255, 255)) for name in classes])
+    colour_map = Image.fromarray((probabilities @ colours).clip(0, 255).astype("uint8"))
+    height, width = probabilities.shape[:2]
+    # The map covers the centres of the tiles, half a stride around them
+    left = round(tile_size / 2 - stride / 2)
+    top = left
+    size = (round(width * stride), round(height * stride))
+    colours_layer = region.copy()
+    colours_layer.paste(colour_map.resize(size, Image.BILINEAR), (left, top))
+    return Image.blend(region, colours_layer, alpha)
+
+
+def check_sliding_window(model, result: Dict, samples: int = 32, seed: int = 0) -> Dict:
+    """
+    Compare the dense map with the classification of the tiles one by one (sliding window), on
+    random locations of the map.
+    :param model: SqueezeNet like model
+    :param result: dictionary given by heat_map
+    :param samples: Number of locations compared
+    :param seed: Seed of the random locations
+    :return: dictionary with the maximum and mean probability difference, the share of locations
+        with the same class, the time of one tile and the estimated time of the whole sliding window
+    """
+    probabilities = result["probabilities"]
+    batch = result["input"]
+    stride = result["model_stride"]
+    height, width = result["input_size"]
+    generator = np.random.default_rng(seed)
+    locations = [
+        (
+            generator.integers(probabilities.shape[0]),
+            generator.integers(probabilities.shape[1]),
+        )
+        for _ in range(samples)
+    ]
+    tiles = torch.cat(
+        [
+            batch[
+                ..., i * stride : i * stride + height, j * stride : j * stride + width
+            ]
+            for i, j in locations
+        ]
+    )
+    start = time.perf_counter()
+    with torch.no_grad():
+        expected = torch.softmax(model(tiles), dim=1).numpy()
+    tile_time = (time.perf_counter() - start) / samples
+    dense = np.stack([probabilities[i, j] for i, j in locations])
+    difference = np.abs(dense - expected)
+    return {
+        "max_difference": float(difference.max()),
+        "mean_difference": float(difference.mean()),
+        "same_class": float((dense.argmax(1) == expected.argmax(1)).mean()),
+        "tile_time": tile_time,
+        "sliding_window_time": tile_time
+        * probabilities.shape[0]
+        * probabilities.shape[1],
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Dense map of the defects of a region, the SqueezeNet being run as a fully "
+        "convolutional network."
+    )
+    parser.add_argument("-i", "--input_img", type=Path, help="Path to the image")
+    parser.add_argument(
+        "-o",
+        "--output",
+        type=Path,
+        help="Output prefix, the map is saved in .npy and the overlay in .png",
+    )
+    parser.add_argument(
+        "-l",
+        "--left_up",
+        type=int,
+        nargs="+",
+        help="Left up coordinate of the region (X,Y)",
+    )
+    parser.add_argument(
+        "-r",
+        "--right_down",
+        type=int,
+        nargs="+",
+        help="Right down coordinate of the region (X,Y)",
+    )
+    parser.add_argument(
+        "-t",
+        "--tile_size",
+        type=int,
+        default=224,
+        help="Size (pixels) of the tiles classified, ex: the size of the regions cropped for the classifier",
+    )
+    parser.add_argument(
+        "-n",
+        "--normalise",
+        action="store_true",
+        help="Flag if the image needs to be normalised",
+    )
+    parser.add_argument(
+        "-s",
+        "--smooth",
+        type=int,
+        default=0,
+        help="Number of times the image must be smoothed",
+    )
+    parser.add_argument(
+        "--check",
+        action="store_true",
+        help="Compare the map with a sliding window classification of random tiles",
+    )
+    args = parser.parse_args()
+
+    model = load_model("v1")
+    start = time.perf_counter()
+    result = heat_map(
+        model,
+        args.input_img,
+        args.left_up,
+        args.right_down,
+        args.tile_size,
+        "v1",
+        args.normalise,
+        args.smooth,
+    )
+    print(
+        f"Map of {result['probabilities'].shape[0]}x{result['probabilities'].shape[1]} tiles "
+        f"(stride {result['stride']:.1f} pixels) in {time.perf_counter() - start:.2f}s"
+    )
+    if args.output is not None:
+        args.output.parent.mkdir(parents=True, exist_ok=True)
+        np.save(args.output.with_suffix(".npy"), result["probabilities"])
+        overlay(
+            result["region"],
+            result["probabilities"],
+            result["stride"],
+            args.tile_size,
+            get_spec("v1").classes,
+        ).save(args.output.with_suffix(".png"))
+    if args.check:
+        print(check_sliding_window(model, result))
@@ -0,0 +1,235 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from pathlib import Path
+from typing import Any, Callable, Iterable, Iterator, List, Tuple
+import torch
+from PIL import Image
+from metrics import span
+from models import MultiModel
+
+# Number of images stacked in one forward pass when classifying a batch of images.
+DEFAULT_BATCH_SIZE = 32
+# Number of threads decoding and preprocessing images while the model is running (0 to disable)
+DEFAULT_DECODE_WORKERS = 2
+# Maximum number of images decoded in advance, bound the memory used by the prefetching
+DEFAULT_PREFETCH = 64
+
+
+def chunked(iterable: Iterable, size: int) -> Iterator[List]:
+    """
+    Split an iterable in lists of `size` elements without consuming it in advance,
+    so only one chunk is kept in memory at a time.
+    :param iterable: Any iterable (list, generator, ...)
+    :param size: Maximum number of elements per chunk
+    :return: Iterator of lists, the last one can be smaller than size.
+    """
+    if size < 1:
+        raise ValueError(f"The batch size must be at least 1, got {size}")
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def same_shape_runs(tensors: List[torch.Tensor]) -> Iterator[Tuple[int, int]]:
+    """
+    Give the (start, stop) indexes of the consecutive tensors sharing the same shape.
+    Images of different sizes can not be stacked together, they are put in different runs.
+    :param tensors: list of tensors
+    :return: Iterator of (start, stop) indexes
+    """
+    start = 0
+    for i in range(1, len(tensors) + 1):
+        if i == len(tensors) or tensors[i].shape != tensors[start].shape:
+            yield start, i
+            start = i
+
+
+def forward_batch(model, tensors: List[torch.Tensor]) -> torch.Tensor:
+    """
+    Stack a list of preprocessed images and run ONE forward pass on them.
+    :param model: the pretrained model
+    :param tensors: list of tensors (C, H, W) with the same shape
+    :return: Tensor of shape (N, number of classes) with the unnormalized scores.
+    """
+    input_batch = torch.stack(tensors)
+    with span("forward"), torch.no_grad():
+        output = model(input_batch)
+    return output
+
+
+def to_probabilities(model, output: torch.Tensor) -> torch.Tensor:
+    """
+    Softmax of the scores of a model, done for each model of a models.MultiModel.
+    :param model: the model that gave the scores
+    :param output: Tensor of shape (N, number of classes) with the unnormalized scores
+    :return: Tensor of the probabilities
+    """
+    if isinstance(model, MultiModel):
+        return model.probabilities(output)
+    return torch.nn.functional.softmax(output, dim=1)
+
+
+def forward_chunk(
+    model, names: List, tensors: List[torch.Tensor], change_detector=None
+) -> Iterator[Tuple[Any, torch.Tensor, torch.Tensor]]:
+    """
+    Classify a chunk of preprocessed images, with one forward pass per run of images of the same shape.
+    With a change detector, the images nearly identical to the previous layer of their region are
+    not classified, the results of that layer are given instead (see change_detection.ChangeDetector).
+    :param model: the pretrained model
+    :param names: names of the images
+    :param tensors: list of preprocessed images (C, H, W)
+    :param change_detector: Optional change_detection.ChangeDetector
+    :return: Iterator of (image name, scores, probabilities), in the same order as names
+    """
+    checks = None
+    run = list(range(len(names)))
+    if change_detector is not None:
+        # The checks are done in order, an image can reuse an anchor of the same chunk
+        checks = [change_detector.check(n, t) for n, t in zip(names, tensors)]
+        if not change_detector.validate:
+            run = [i for i in run if not checks[i][1]]
+
+    results = {}
+    run_tensors = [tensors[i] for i in run]
+    for start, stop in same_shape_runs(run_tensors):
+        output = forward_batch(model, run_tensors[start:stop])
+        probabilities = to_probabilities(model, output)
+        for i in range(stop - start):
+            results[run[start + i]] = output[i], probabilities[i]
+
+    for i, name in enumerate(names):
+        if checks is not None:
+            anchor, reused = checks[i]
+            # An anchor is always before the images reusing its results
+            if not reused:
+                anchor["result"] = results[i]
+            elif change_detector.validate:
+                change_detector.record_drift(results[i], anchor["result"])
+            else:
+                results[i] = anchor["result"]
+        yield (name, *results[i])
+
+
+def load_and_preprocess(
+    image_path: Path, preprocess: Callable, loader: Callable = Image.open
+) -> List[Tuple[Any, torch.Tensor]]:
+    """
+    Decode an image and transform it into the model input.
+    The loader can give several images at once as a dictionary {name: PIL.Image}
+    (ex: all the parts of a layer image), each of them is then preprocessed.
+    :param image_path: path to one image
+    :param preprocess: transformation from a PIL.Image to the model input tensor
+    :param loader: function giving the PIL.Image (or dictionary of PIL.Image) of image_path
+    :return: list of (name, preprocessed tensor), the name of a single image is image_path
+    """
+    images = loader(image_path)
+    with span("preprocess"):
+        if isinstance(images, dict):
+            return [(name, preprocess(image)) for name, image in images.items()]
+        return [(image_path, preprocess(images))]
+
+
+def prefetch_images(
+    images_path: Iterable[Path],
+    preprocess: Callable,
+    workers: int = DEFAULT_DECODE_WORKERS,
+    prefetch: int = DEFAULT_PREFETCH,
+    loader: Callable = Image.open,
+) -> Iterator[Tuple[Path, torch.Tensor]]:
+    """
+    Decode and preprocess images in a pool of threads while the consumer (the model) works.
+    At most `prefetch` images are being decoded or waiting to be consumed, and the images
+    are given back in the same order as images_path.
+    :param images_path: iterable of path of images
+    :param preprocess: transformation from a PIL.Image to the model input tensor
+    :param workers: number of decoding threads, with 0 images are decoded when requested
+    :param prefetch: maximum number of images decoded in advance
+    :param loader: function giving the PIL.Image (or dictionary of PIL.Image) of an image path
+    :return: Iterator of (image name, preprocessed tensor)
+    """
+    if workers < 1:
+        for image_path in images_path:
+            yield from load_and_preprocess(image_path, preprocess, loader)
+        return
+
+    prefetch = max(prefetch, 1)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = deque()
+        for image_path in images_path:
+            pending.append(
+                pool.submit(load_and_preprocess, image_path, preprocess, loader)
+            )
+            if len(pending) >= prefetch:
+                yield from pending.popleft().result()
+        while pending:
+            yield from pending.popleft().result()
+
+
+def predict_batches(
+    model,
+    images_path: Iterable[Path],
+    preprocess: Callable,
+    batch_size: int = DEFAULT_BATCH_SIZE,
+    workers: int = DEFAULT_DECODE_WORKERS,
+    prefetch: int = DEFAULT_PREFETCH,
+    loader: Callable = Image.open,
+    change_detector=None,
+) -> Iterator[Tuple[Path, torch.Tensor, torch.Tensor]]:
+    """
+    Classify images by mini-batches. Images are decoded by a pool of threads while the model
+    classifies the current batch, and at most batch_size + prefetch images are kept in memory
+    whatever the number of files.
+    :param model: the pretrained model
+    :param images_path: iterable of path of images
+    :param preprocess: transformation from a PIL.Image to the model input tensor
+    :param batch_size: maximum number of images per forward pass
+    :param workers: number of decoding threads (0 to decode in the main thread)
+    :param prefetch: maximum number of images decoded in advance
+    :param loader: function giving the PIL.Image (or dictionary of PIL.Image) of an image path,
+        by default the file is decoded
+    :param change_detector: Optional change_detection.ChangeDetector, the images nearly identical
+        to the previous layer of their region are not classified
+    :return: Iterator of (image name, scores, probabilities), in the same order as images_path
+    """
+    images = prefetch_images(images_path, preprocess, workers, prefetch, loader)
+    for chunk in chunked(images, batch_size):
+        names = [name for name, _ in chunk]
+        tensors = [tensor for _, tensor in chunk]
+        yield from forward_chunk(model, names, tensors, change_detector)
+
+
+def predict_store(
+    model,
+    store,
+    preprocess_batch: Callable,
+    batch_size: int = DEFAULT_BATCH_SIZE,
+    change_detector=None,
+) -> Iterator[Tuple[Any, torch.Tensor, torch.Tensor]]:
+    """
+    Classify the preprocessed crops of a store by mini-batches, nothing is decoded: each batch
+    is a slice of the memory mapped crops.
+    :param model: the pretrained model
+    :param store: tensor_store.TensorStore
+    :param preprocess_batch: transformation from a uint8 array (N, H, W, 3) to the model input
+        (see models.get_batch_preprocess)
+    :param batch_size: maximum number of crops per forward pass
+    :param change_detector: Optional change_detection.ChangeDetector, the crops nearly identical
+        to the previous layer of their region are not classified
+    :return: Iterator of (crop name, scores, probabilities), in the order of the store
+    """
+    for names, crops in store.batches(batch_size):
+        with span("preprocess"):
+            input_batch = preprocess_batch(crops)
+        if change_detector is not None:
+            yield from forward_chunk(model, names, list(input_batch), change_detector)
+            continue
+        with span("forward"), torch.no_grad():
+            output = model(input_batch)
+        probabilities = to_probabilities(model, output)
+        for i, name in enumerate(names):
+            yield name, output[i], probabilities[i]
@@ -0,0 +1,189 @@
+import json
+import os
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager, nullcontext
+from pathlib import Path
+from typing import Dict
+
+# Upper bounds (s) of the buckets of the latency histograms, as in Prometheus
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Prefix of the exported metrics names
+PREFIX = "elo"
+
+# The metrics are only recorded once enabled, a disabled span is a shared empty context
+_ENABLED = False
+_NULL_SPAN = nullcontext()
+_LOCK = threading.Lock()
+_COUNTERS = {}
+_HISTOGRAMS = {}
+# 0: only the progress messages, 1: result of each image, 2: scores and probabilities tensors
+_VERBOSITY = 0
+
+
+def enable(enabled: bool = True) -> None:
+    """
+    Start (or stop) recording the spans, counters and histograms of this process.
+    :param enabled: True to record the metrics
+    :return: None
+    """
+    global _ENABLED
+    _ENABLED = enabled
+
+
+def reset() -> None:
+    """
+    Remove all the recorded metrics.
+    :return: None
+    """
+    with _LOCK:
+        _COUNTERS.clear()
+        _HISTOGRAMS.clear()
+
+
+def set_verbosity(level: int) -> None:
+    """
+    Set the level of the debug messages printed (see debug).
+    :param level: 0: none, 1: model load time and result of each image, 2: also the scores and
+        probabilities tensors
+    :return: None
+    """
+    global _VERBOSITY
+    _VERBOSITY = level
+
+
+def debug(level: int, *values) -> None:
+    """
+    Print values if the verbosity is at least level.
+    :param level: Verbosity level needed to print the values
+    :param values: Values to print
+    :return: None
+    """
+    if _VERBOSITY >= level:
+        print(*values)
+
+
+def count(name: str, value: int = 1) -> None:
+    """
+    Increment a counter (ex: images, failures, cache_hits).
+    :param name: Name of the counter
+    :param value: Increment
+    :return: None
+    """
+    if not _ENABLED:
+        return
+    with _LOCK:
+        _COUNTERS[name] = _COUNTERS.get(name, 0) + value
+
+
+def observe(name: str, seconds: float) -> None:
+    """
+    Add a duration to the latency histogram of a stage.
+    :param name: Name of the stage
+    :param seconds: Duration of the stage
+    :return: None
+    """
+    if not _ENABLED:
+        return
+    with _LOCK:
+        histogram = _HISTOGRAMS.get(name)
+        if histogram is None:
+            histogram = _HISTOGRAMS[name] = {
+                "buckets": [0] * (len(BUCKETS) + 1),
+                "count": 0,
+                "sum": 0.0,
+                "max": 0.0,
+            }
+        histogram["buckets"][bisect_left(BUCKETS, seconds)] += 1
+        histogram["count"] += 1
+        histogram["sum"] += seconds
+        histogram["max"] = max(histogram["max"], seconds)
+
+
+@contextmanager
+def _timed_span(name: str):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start)
+
+
+def span(name: str):
+    """
+    Measure the duration of a stage of the pipeline, use it as a context manager:
+    with span("forward"): ...
+    When the metrics are disabled nothing is measured.
+    :param name: Name of the stage
+    :return: context manager
+    """
+    if not _ENABLED:
+        return _NULL_SPAN
+    return _timed_span(name)
+
+
+def summary() -> Dict:
+    """
+    Give the recorded metrics.
+    :return: dictionary with the counters and, for each stage, the number of calls, the total,
+        mean and maximum durations (s) and the histogram {bucket upper bound: calls}
+    """
+    with _LOCK:
+        stages = {}
+        for name, histogram in _HISTOGRAMS.items():
+            stages[name] = {
+                "count": histogram["count"],
+                "total": histogram["sum"],
+                "mean": histogram["sum"] / histogram["count"],
+                "max": histogram["max"],
+                "histogram": dict(
+                    zip(
+                        [str(bound) for bound in BUCKETS] + ["+Inf"],
+                        histogram["buckets"],
+                    )
+                ),
+            }
+        return {"counters": dict(_COUNTERS), "stages": stages}
+
+
+def to_prometheus() -> str:
+    """
+    Format the recorded metrics in the Prometheus text format.
+    :return: str
+    """
+    metrics = summary()
+    lines = []
+    for name, value in sorted(metrics["counters"].items()):
+        lines.append(f"# TYPE {PREFIX}_{name}_total counter")
+        lines.append(f"{PREFIX}_{name}_total {value}")
+    if metrics["stages"]:
+        lines.append(f"# TYPE {PREFIX}_stage_seconds histogram")
+    for name, stage in sorted(metrics["stages"].items()):
+        cumulative = 0
+        for bound, calls in stage["histogram"].items():
+            cumulative += calls
+            lines.append(
+                f'{PREFIX}_stage_seconds_bucket{{stage="{name}",le="{bound}"}} {cumulative}'
+            )
+        lines.append(f'{PREFIX}_stage_seconds_sum{{stage="{name}"}} {stage["total"]}')
+        lines.append(f'{PREFIX}_stage_seconds_count{{stage="{name}"}} {stage["count"]}')
+    return "\n".join(lines) + "\n"
+
+
+def export(output_path: Path) -> None:
+    """
+    Save the recorded metrics, as a json summary for a .json file, in the Prometheus text
+    format otherwise (ex: .prom, read by the node exporter textfile collector).
+    The file is replaced at once, so it can be read at any time.
+    :param output_path: Path of the metrics file
+    :return: None
+    """
+    output_path = Path(output_path)
+    if output_path.suffix == ".json":
+        content = json.dumps(summary(), indent=2)
+    else:
+        content = to_prometheus()
+    temporary = output_path.with_name(output_path.name + ".tmp")
+    temporary.write_text(content)
+    os.replace(temporary, output_path)
@@ -0,0 +1,378 @@
+import time
+from pathlib import Path
+from typing import Callable, Dict, List, Tuple, Union
+import numpy as np
+import torch
+from PIL import Image
+from backend import DEFAULT_BACKEND, load_backend
+from metrics import debug, observe
+
+# Normalisation of the ImageNet pretrained models
+IMAGENET_MEAN = [0.485, 0.456, 0.406]
+IMAGENET_STD = [0.229, 0.224, 0.225]
+
+
+class ModelSpec:
+    """
+    Description of a classification model: how to build it, how to prepare its input images and
+    the order of its classes. The framework of a model is only imported when the model is built.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        checkpoint: str,
+        classes: List[str],
+        input_size: Tuple[int, int],
+        build: Callable,
+        resize: Union[int, Tuple[int, int]] = None,
+        mean: List[float] = IMAGENET_MEAN,
+        std: List[float] = IMAGENET_STD,
+    ):
+        """
+        :param name: Name used to select the model (ex: --model v1)
+        :param checkpoint: Path to the weights of the model
+        :param classes: Class names, in the order of the model outputs
+        :param input_size: (height, width) of the model inputs
+        :param build: Function building the model in eval mode, called with (checkpoint, spec)
+        :param resize: Size given to transforms.Resize (int: size of the smaller edge), input_size by default
+        :param mean: Mean of each channel used to normalise the inputs
+        :param std: Standard deviation of each channel used to normalise the inputs
+        """
+        self.name = name
+        self.checkpoint = checkpoint
+        self.classes = classes
+        self.input_size = input_size
+        self.build = build
+        self.resize = input_size if resize is None else resize
+        self.mean = mean
+        self.std = std
+
+
+def build_squeezenet(checkpoint: Path, spec: ModelSpec) -> torch.nn.Module:
+    """
+    Build the squeezenet architecture and load the pre trained weights.
+    :param checkpoint: Path to the weights of the model
+    :param spec: ModelSpec of the model
+    :return: torchvision.models.squeezenet.SqueezeNet in eval mode
+    """
+    from torchvision import models
+
+    # Create model, the classifier last layer is a Conv2d(512, 3, kernel_size=(1, 1))
+    model = models.squeezenet1_0(num_classes=len(spec.classes))
+    model.num_classes = len(spec.classes)
+    # Load pre trained weights
+    model.load_state_dict(torch.load(checkpoint, map_location=torch.device("cpu")))
+    model.eval()
+
+    return model
+
+
+def build_flash_classifier(checkpoint: Path, spec: ModelSpec) -> torch.nn.Module:
+    """
+    Load a saved pytorch lightning model from a path.
+    The model is put in eval mode and gradient is deactivated.
+    :param checkpoint: path where is saved the model
+    :param spec: ModelSpec of the model
+    :return: ImageClassifier model with loaded weitgh.
+    """
+    # lightning-flash takes seconds to import, it is only imported for this model
+    from flash.image import ImageClassifier
+
+    model = ImageClassifier.load_from_checkpoint(checkpoint)
+
+    for p in model.parameters():
+        p.requires_grad = False
+    model.eval()
+
+    return model
+
+
+# Models available, selected by name
+MODELS: Dict[str, ModelSpec] = {
+    "v1": ModelSpec(
+        name="v1",
+        checkpoint="SqueezeNet_pretrain_epoch-38.pt",
+        classes=["good", "porous", "bulging"],
+        input_size=(224, 224),
+        build=build_squeezenet,
+        resize=224,
+    ),
+    "v2": ModelSpec(
+        name="v2",
+        checkpoint="image_classification_model.pt",
+        classes=["bulging", "edges", "good", "porous", "powder"],
+        input_size=(196, 196),
+        build=build_flash_classifier,
+    ),
+}
+DEFAULT_MODEL = "v1"
+
+# Models already loaded in this process, indexed by (name, checkpoint, ready_model, backend)
+_MODEL_CACHE = {}
+
+
+def get_spec(name: str) -> ModelSpec:
+    """
+    Give the description of a registered model.
+    :param name: Name of the model (see MODELS)
+    :return: ModelSpec
+    """
+    if name not in MODELS:
+        raise ValueError(f"Unknown model {name}, expected one of {list(MODELS)}")
+    return MODELS[name]
+
+
+def model_version(name: str) -> str:
+    """
+    Version of a registered model stored with its results: its name and the name of its checkpoint.
+    :param name: Name of the model (see MODELS)
+    :return: str, ex: v1:SqueezeNet_pretrain_epoch-38
+    """
+    return f"{name}:{Path(get_spec(name).checkpoint).stem}"
+
+
+def build_model(name: str = DEFAULT_MODEL, checkpoint: Path = None) -> torch.nn.Module:
+    """
+    Build a registered model in eval mode, as trained (eager PyTorch).
+    :param name: Name of the model (see MODELS)
+    :param checkpoint: Path to the weights, the checkpoint of the model by default
+    :return: the model
+    """
+    spec = get_spec(name)
+    return spec.build(checkpoint or spec.checkpoint, spec)
+
+
+def load_model(
+    name: str = DEFAULT_MODEL,
+    checkpoint: Path = None,
+    ready_model: Path = None,
+    backend: str = DEFAULT_BACKEND,
+):
+    """
+    Load a registered model for an inference backend. The model is kept in a process level cache,
+    so loading it again returns the already loaded model.
+    :param name: Name of the model (see MODELS)
+    :param checkpoint: Path to the weights, the checkpoint of the model by default
+    :param ready_model: Optional path to a serialized "ready to run" TorchScript model.
+        If it exists it is loaded instead of the checkpoint, otherwise it is created from the checkpoint.
+        With the int8 backend, path of the quantised model created by quantise.py (next to the
+        checkpoint by default).
+    :param backend: Inference backend (see backend.BACKENDS), the frozen backends do not use ready_model
+    :return: the model to call on a batch of images
+    """
+    spec = get_spec(name)
+    checkpoint = checkpoint or spec.checkpoint
+    cache_key = (
+        name,
+        str(checkpoint),
+        None if ready_model is None else str(ready_model),
+        backend,
+    )
+    if cache_key in _MODEL_CACHE:
+        return _MODEL_CACHE[cache_key]
+
+    start = time.perf_counter()
+    if backend != "eager":
+        model = load_backend(
+            lambda: spec.build(checkpoint, spec),
+            checkpoint,
+            spec.input_size,
+            backend,
+            quantised=ready_model if backend == "int8" else None,
+        )
+    elif ready_model is not None and Path(ready_model).is_file():
+        model = torch.jit.load(str(ready_model), map_location=torch.device("cpu"))
+        model.eval()
+    else:
+        model = spec.build(checkpoint, spec)
+        if ready_model is not None:
+            export_ready_model(model, ready_model)
+    load_time = time.perf_counter() - start
+    observe("model_load", load_time)
+    debug(1, f"Model loaded in {load_time:.3f}s")
+
+    _MODEL_CACHE[cache_key] = model
+    return model
+
+
+def export_ready_model(model, ready_model) -> None:
+    """
+    Serialize an eval mode model with TorchScript, it can then be loaded without building the architecture.
+    :param model: the pretrained model
+    :param ready_model: Path where to save the TorchScript model
+    :return: None
+    """
+    ready_model = Path(ready_model)
+    ready_model.parent.mkdir(parents=True, exist_ok=True)
+    torch.jit.save(torch.jit.script(model), str(ready_model))
+
+
+def get_preprocess(name: str = DEFAULT_MODEL):
+    """
+    Transformations applied on an image before being given to a model.
+    :param name: Name of the model (see MODELS), None to only convert the image to a tensor
+        (input of a MultiModel)
+    :return: torchvision.transforms.Compose
+    """
+    from torchvision import transforms
+
+    if name is None:
+        return transforms.ToTensor()
+    spec = get_spec(name)
+    return transforms.Compose(
+        [
+            transforms.Resize(spec.resize),
+            transforms.ToTensor(),
+            transforms.Normalize(mean=spec.mean, std=spec.std),
+        ]
+    )
+
+
+def resized_shape(height: int, width: int, resize: Union[int, Tuple[int, int]]):
+    """
+    Size of an image after transforms.Resize(resize).
+    :param height: Height of the image
+    :param width: Width of the image
+    :param resize: Size given to transforms.Resize (int: size of the smaller edge)
+    :return: (height, width)
+    """
+    if not isinstance(resize, int):
+        return tuple(resize)
+    if height <= width:
+        return resize, int(resize * width / height)
+    return int(resize * height / width), resize
+
+
+def crops_to_batch(crops: np.ndarray) -> torch.Tensor:
+    """
+    Convert a batch of uint8 crops to a float tensor, as transforms.ToTensor does for one image.
+    :param crops: uint8 array (N, H, W, 3)
+    :return: Tensor (N, 3, H, W) with values in [0, 1]
+    """
+    return torch.from_numpy(crops).permute(0, 3, 1, 2).contiguous().float() / 255
+
+
+def get_model_input(name: str = DEFAULT_MODEL) -> Callable:
+    """
+    Resize and Normalize transformations of get_preprocess applied on a batch of tensors, the model
+    input is the same as the one of get_preprocess. The images to resize are converted back to 8 bits
+    PIL images (exactly, their values being multiples of 1 / 255) and resized by PIL, the images
+    already at the size of the model are only normalised.
+    :param name: Name of the model (see MODELS)
+    :return: function from a batch (N, 3, H, W) with values in [0, 1] to the model input tensor
+    """
+    from torchvision import transforms
+
+    spec = get_spec(name)
+    preprocess = get_preprocess(name)
+    normalize = transforms.Normalize(mean=spec.mean, std=spec.std)
+
+    def to_input(batch: torch.Tensor) -> torch.Tensor:
+        size = resized_shape(*batch.shape[-2:], spec.resize)
+        if size == tuple(batch.shape[-2:]):
+            return normalize(batch)
+        images = (batch * 255).round().to(torch.uint8).permute(0, 2, 3, 1).numpy()
+        return torch.stack([preprocess(Image.fromarray(image)) for image in images])
+
+    return to_input
+
+
+def get_batch_preprocess(name: str = DEFAULT_MODEL) -> Callable:
+    """
+    Transformations of get_preprocess applied at once on a batch of uint8 crops (ex: the crops
+    of a tensor_store.TensorStore). The values are the same as get_preprocess (see get_model_input).
+    :param name: Name of the model (see MODELS)
+    :return: function from a uint8 array (N, H, W, 3) to the model input tensor (N, 3, H, W)
+    """
+    to_input = get_model_input(name)
+    return lambda crops: to_input(crops_to_batch(crops))
+
+
+class MultiModel:
+    """
+    Several models classifying the same batches: the images are decoded and converted to tensors
+    once, and each model gets them resized and normalised by the get_preprocess of its spec (see
+    get_model_input), so the columns of a model are the ones of the model run alone.
+    The outputs of the models are concatenated, the class names are prefixed by the model name
+    (ex: v1_good, v2_good). With ensemble, the mean probability of the classes shared by all the
+    models is added (ex: ensemble_good).
+    """
+
+    def __init__(self, names: List[str], models: List, ensemble: bool = False):
+        """
+        :param names: Names of the models (see MODELS)
+        :param models: Loaded models, in the order of names
+        :param ensemble: If True, the probabilities of the classes shared by all the models are averaged
+        """
+        # The columns of a model given twice would overwrite each other, and count twice in the ensemble
+        duplicates = sorted({name for name in names if names.count(name) > 1})
+        if duplicates:
+            raise ValueError(f"The models {duplicates} are given more than once")
+        self.names = names
+        self.models = models
+        self.inputs = [get_model_input(name) for name in names]
+        self.class_counts = [len(get_spec(name).classes) for name in names]
+        self.classes = [
+            f"{name}_{class_name}"
+            for name in names
+            for class_name in get_spec(name).classes
+        ]
+        # Columns of the probabilities of each class shared by all the models
+        self.ensemble_columns = {}
+        if ensemble:
+            for class_name in get_spec(names[0]).classes:
+                if all(class_name in get_spec(name).classes for name in names):
+                    self.ensemble_columns[class_name] = [
+                        self.classes.index(f"{name}_{class_name}") for name in names
+                    ]
+            self.classes += [
+                f"ensemble_{class_name}" for class_name in self.ensemble_columns
+            ]
+
+    def __call__(self, batch: torch.Tensor) -> torch.Tensor:
+        """
+        Run all the models on a batch.
+        :param batch: Tensor (N, 3, H, W) with values in [0, 1] (transforms.ToTensor)
+        :return: Tensor (N, number of classes of all the models) with the unnormalized scores
+        """
+        return torch.cat(
+            [
+                model(to_input(batch))
+                for model, to_input in zip(self.models, self.inputs)
+            ],
+            dim=1,
+        )
+
+    def probabilities(self, output: torch.Tensor) -> torch.Tensor:
+        """
+        Softmax of the outputs of each model, followed by the ensemble probabilities.
+        :param output: Tensor given by __call__
+        :return: Tensor (N, len(classes))
+        """
+        probabilities = torch.cat(
+            [
+                torch.nn.functional.softmax(scores, dim=1)
+                for scores in torch.split(output, self.class_counts, dim=1)
+            ],
+            dim=1,
+        )
+        ensemble = [
+            probabilities[:, columns].mean(dim=1, keepdim=True)
+            for columns in self.ensemble_columns.values()
+        ]
+        return torch.cat([probabilities] + ensemble, dim=1)
+
+
+def load_models(
+    names: List[str], backend: str = DEFAULT_BACKEND, ensemble: bool = False
+) -> MultiModel:
+    """
+    Load several registered models classifying the same batches (see MultiModel).
+    :param names: Names of the models (see MODELS)
+    :param backend: Inference backend (see backend.BACKENDS)
+    :param ensemble: If True, the probabilities of the classes shared by all the models are averaged
+    :return: MultiModel
+    """
+    models = [load_model(name, backend=backend) for name in names]
+    return MultiModel(list(names), models, ensemble)
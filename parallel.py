@@ -0,0 +1,215 @@
+import argparse
+import multiprocessing
+import os
+import queue
+import time
+from pathlib import Path
+from typing import Callable, Iterable, Iterator, List, Tuple
+import torch
+from PIL import Image
+from inference import DEFAULT_BATCH_SIZE, chunked, predict_batches
+
+# Number of chunks of images waiting or being classified per worker, bound the memory used
+CHUNKS_PER_WORKER = 2
+# Time (s) between two checks that the workers are still running
+POLL_INTERVAL = 1.0
+
+
+def available_cores() -> List[int]:
+    """
+    Cores this process can run on.
+    :return: list of core indexes
+    """
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+def core_slices(workers: int, cores: List[int] = None) -> List[List[int]]:
+    """
+    Split the cores in one slice per worker, with more workers than cores a core is shared.
+    :param workers: Number of workers
+    :param cores: Cores to split, the available cores by default
+    :return: list of workers lists of cores
+    """
+    cores = cores or available_cores()
+    size = max(1, len(cores) // workers)
+    return [
+        [cores[(i * size + j) % len(cores)] for j in range(size)]
+        for i in range(workers)
+    ]
+
+
+def _worker(
+    model,
+    preprocess: Callable,
+    loader: Callable,
+    batch_size: int,
+    cores: List[int],
+    tasks,
+    results,
+) -> None:
+    """
+    Classify the chunks of images of the tasks queue, run in a forked process: the model and the
+    loader are the ones of the parent process, the weights are shared and not loaded again.
+    :param model: the pretrained model
+    :param preprocess: transformation from a PIL.Image to the model input tensor
+    :param loader: function giving the PIL.Image (or dictionary of PIL.Image) of an image path
+    :param batch_size: maximum number of images per forward pass
+    :param cores: Cores the worker runs on, with as many torch threads
+    :param tasks: Queue of (chunk index, list of images), None to stop
+    :param results: Queue of (chunk index, list of (name, scores, probabilities), error message)
+    :return: None
+    """
+    if hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cores)
+    torch.set_num_threads(len(cores))
+    while True:
+        task = tasks.get()
+        if task is None:
+            return
+        index, images = task
+        try:
+            rows = [
+                (name, output.numpy(), probabilities.numpy())
+                for name, output, probabilities in predict_batches(
+                    model, images, preprocess, batch_size, workers=0, loader=loader
+                )
+            ]
+            results.put((index, rows, None))
+        except Exception as error:
+            results.put((index, None, f"{type(error).__name__}: {error}"))
+
+
+def predict_parallel(
+    model,
+    images_path: Iterable[Path],
+    preprocess: Callable,
+    batch_size: int = DEFAULT_BATCH_SIZE,
+    workers: int = 2,
+    loader: Callable = Image.open,
+) -> Iterator[Tuple[Path, torch.Tensor, torch.Tensor]]:
+    """
+    Classify images with several processes, each one decoding and classifying chunks of batch_size
+    images on its own slice of cores (see core_slices).
+    The workers are forked once the model is loaded, so its weights are shared (copy on write) instead
+    of being loaded by each worker. The results are given back in the order of images_path.
+    The stages run in the workers are not measured by the metrics.
+    :param model: the pretrained model
+    :param images_path: iterable of path of images
+    :param preprocess: transformation from a PIL.Image to the model input tensor
+    :param batch_size: maximum number of images per forward pass
+    :param workers: number of inference processes
+    :param loader: function giving the PIL.Image (or dictionary of PIL.Image) of an image path
+    :return: Iterator of (image name, scores, probabilities), in the same order as images_path
+    """
+    if "fork" not in multiprocessing.get_all_start_methods():
+        # The model can not be shared without fork (Windows), the images are classified here
+        print("Parallel inference needs fork, the images are classified in one process")
+        yield from predict_batches(
+            model, images_path, preprocess, batch_size, loader=loader
+        )
+        return
+
+    context = multiprocessing.get_context("fork")
+    tasks = context.Queue()
+    results = context.Queue()
+    processes = [
+        context.Process(
+            target=_worker,
+            args=(model, preprocess, loader, batch_size, cores, tasks, results),
+            daemon=True,
+        )
+        for cores in core_slices(workers)
+    ]
+    for process in processes:
+        process.start()
+
+    done = {}
+    next_index = 0
+
+    def receive():
+        # Wait for one chunk, without blocking forever if a worker died
+        while True:
+            try:
+                index, rows, error = results.get(timeout=POLL_INTERVAL)
+                break
+            except queue.Empty:
+                if not all(process.is_alive() for process in processes):
+                    raise RuntimeError("An inference worker stopped unexpectedly")
+        if error is not None:
+            raise RuntimeError(f"Inference worker failed: {error}")
+        done[index] = rows
+
+    def ready():
+        # Give the results of the chunks received, in order
+        nonlocal next_index
+        while next_index in done:
+            for name, output, probabilities in done.pop(next_index):
+                yield name, torch.from_numpy(output), torch.from_numpy(probabilities)
+            next_index += 1
+
+    try:
+        sent = 0
+        for chunk in chunked(images_path, batch_size):
+            tasks.put((sent, chunk))
+            sent += 1
+            while sent - next_index >= CHUNKS_PER_WORKER * workers:
+                receive()
+                yield from ready()
+        while next_index < sent:
+            receive()
+            yield from ready()
+    finally:
+        for _ in processes:
+            tasks.put(None)
+        for process in processes:
+            process.join(timeout=10)
+            if process.is_alive():
+                process.terminate()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Measure the throughput of the parallel inference for several numbers of workers."
+    )
+    parser.add_argument(
+        "-i", "--input_folder", type=Path, help="Folder of images to classify"
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        nargs="+",
+        default=[1, 2, 4],
+        help="Numbers of inference workers measured",
+    )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=DEFAULT_BATCH_SIZE,
+        help="Images per forward pass",
+    )
+    parser.add_argument(
+        "--model",
+        default="v1",
+        help="Name of the model (see models.MODELS), v1: SqueezeNet, v2: ImageClassifier",
+    )
+    args = parser.parse_args()
+
+    # Imported here, models takes time to import
+    from discovery import scan_images
+    from models import get_preprocess, load_model
+
+    model = load_model(args.model)
+    preprocess = get_preprocess(args.model)
+    images = list(scan_images(args.input_folder))
+    print(f"{len(available_cores())} cores, {len(images)} images")
+    print(f"{'workers':<10}{'images/s':>12}{'speed up':>12}")
+    reference = None
+    for workers in args.workers:
+        start = time.perf_counter()
+        for _ in predict_parallel(model, images, preprocess, args.batch_size, workers):
+            pass
+        speed = len(images) / (time.perf_counter() - start)
+        reference = reference or speed
+        print(f"{workers:<10}{speed:>12.1f}{speed / reference:>12.2f}")
@@ -1,9 +1,21 @@
 import argparse
+import csv
+import json
 from pathlib import Path
-from typing import Tuple
+from typing import Dict, List, Tuple
+import numpy as np
 from PIL import Image
-from PIL import ImageFilter
-from utils import normalise
+from metrics import span
+from utils import SMOOTH_MARGIN, image_extrema, normalise
+from utils import smooth as fused_smooth
+
+# A JPEG image can be decoded at 1/2, 1/4 or 1/8 of its resolution (DCT scaling)
+DECODE_SCALES = (8, 4, 2)
+# With roi_first, the extrema of the smoothed image are computed on the image reduced this number of times
+DEFAULT_EXTREMA_SCALE = 4
+# Maximum pixel difference (out of 255) measured between the roi_first and whole image processing with
+# normalisation, smoothing and DEFAULT_EXTREMA_SCALE (see check_roi_first and tests/test_part_extraction.py)
+ROI_FIRST_TOLERANCE = 4
 
 
 def load_image(img: Path, smooth: int) -> Image:
@@ -13,15 +25,154 @@ def load_image(img: Path, smooth: int) -> Image:
     :param smooth: (int) Number of time images are smooth, allow to reduce the effect of compresion artefact.
     :return: PIL.Image
     """
-    img = Image.open(img)
-    img = img.convert("RGB")
+    with span("decode"):
+        img = Image.open(img)
+        img = img.convert("RGB")
 
-    for i in range(smooth):
-        img = img.filter(ImageFilter.SMOOTH_MORE)
+    img = smooth_image(img, smooth)
 
     return img
 
 
+def decode_scale(
+    boxes: List[Tuple[Tuple[int, int], Tuple[int, int]]], decode_size: int
+) -> int:
+    """
+    Largest reduction of the image keeping every cropped region at least decode_size pixels wide and high.
+    :param boxes: list of (left_up, right_down) of the regions to crop
+    :param decode_size: Minimum size of a region, ex: the input size of the model
+    :return: 8, 4, 2 or 1 (no reduction)
+    """
+    smallest = min(
+        min(right_down[0] - left_up[0], right_down[1] - left_up[1])
+        for left_up, right_down in boxes
+    )
+    for scale in DECODE_SCALES:
+        if smallest >= decode_size * scale:
+            return scale
+    return 1
+
+
+def load_scaled(
+    img: Path,
+    smooth: int,
+    boxes: List[Tuple[Tuple[int, int], Tuple[int, int]]],
+    decode_size: int = None,
+) -> Tuple[Image, List[Tuple[Tuple[int, int], Tuple[int, int]]]]:
+    """
+    Load an image at a reduced resolution when the regions to crop are much larger than the
+    model input, as they are then reduced to it anyway.
+    A JPEG image is directly decoded at the reduced resolution (PIL draft), which is faster
+    and uses less memory. Other images are decoded, then reduced (PIL reduce).
+    :param img: Path to the image to load
+    :param smooth: Number of time the full resolution image would be smoothed, the reduced image is
+        smoothed smooth / scale ** 2 times to give the same blur
+    :param boxes: list of (left_up, right_down) of the regions to crop, in the full resolution pixels
+    :param decode_size: Minimum size of the regions once reduced, None to always load the full resolution
+    :return: (PIL.Image, boxes in the pixels of the loaded image)
+    """
+    scale = 1 if decode_size is None else decode_scale(boxes, decode_size)
+    if scale == 1:
+        return load_image(img, smooth), boxes
+
+    with span("decode"):
+        img = Image.open(img)
+        width, height = img.size
+        img.draft("RGB", (-(-width // scale), -(-height // scale)))
+        img = img.convert("RGB")
+        if img.size == (width, height):
+            # Not a JPEG, the draft mode is not supported
+            img = img.reduce(scale)
+    factor_x = width / img.width
+    factor_y = height / img.height
+    boxes = [
+        (
+            (round(left_up[0] / factor_x), round(left_up[1] / factor_y)),
+            (round(right_down[0] / factor_x), round(right_down[1] / factor_y)),
+        )
+        for left_up, right_down in boxes
+    ]
+    # The reduction already averages the pixels, a smoothing iteration spreads over scale ** 2
+    # more pixels of the full resolution image
+    return smooth_image(img, round(smooth / scale**2)), boxes
+
+
+def smooth_image(img: Image, smooth: int) -> Image:
+    """
+    Smooth an image multiple times with ImageFilter.SMOOTH_MORE, all the iterations are done
+    in one operator (see utils.smooth).
+    :param img: PIL.Image in RGB to smooth
+    :param smooth: Number of time the image is smoothed
+    :return: PIL.Image
+    """
+    if smooth < 1:
+        return img
+    with span("smooth"):
+        return Image.fromarray(fused_smooth(np.asarray(img), smooth))
+
+
+def smoothed_extrema(
+    img: Image, smooth: int, scale: int = DEFAULT_EXTREMA_SCALE
+) -> List[Tuple[int, int]]:
+    """
+    Extrema of each channel of the smoothed image, used by roi_first to normalise the regions like the
+    whole image. Without smoothing, the extrema of the image are exact. Otherwise the whole image would
+    have to be smoothed, so it is reduced by scale and smoothed smooth / scale ** 2 times (as load_scaled
+    does), an approximation computed once per layer image. With scale = 1 the whole image is smoothed.
+    :param img: PIL.Image in RGB, not smoothed
+    :param smooth: Number of times the whole image would be smoothed
+    :param scale: Reduction factor of the image used to compute the extrema of the smoothed image
+    :return: list of (min, max) for the 3 channels
+    """
+    if smooth > 0 and scale > 1:
+        img = img.reduce(scale)
+        smooth = round(smooth / scale**2)
+    return image_extrema(smooth_image(img, smooth))
+
+
+def region_first(
+    img: Image,
+    left_up: Tuple[int, int],
+    right_down: Tuple[int, int],
+    smooth: int,
+    extrema=None,
+) -> Image:
+    """
+    Crop the region, then smooth and normalise only the region instead of the whole image.
+    The region is first cropped with a margin large enough for the smoothing kernel, so the
+    smoothed region is the same as if the whole image was smoothed.
+    :param img: PIL.Image in RGB, not smoothed
+    :param left_up: Pixel position of the left up corner of the region.
+    :param right_down: Pixel position of the right corner of the region.
+    :param smooth: Number of times the region must be smoothed
+    :param extrema: If not None, (min, max) of each channel of the whole image used to normalise
+        the region (see utils.image_extrema), the region is not normalised otherwise.
+    :return: PIL.Image of the region
+    """
+    width, height = img.size
+    margin = SMOOTH_MARGIN * smooth
+    box = (
+        max(left_up[0] - margin, 0),
+        max(left_up[1] - margin, 0),
+        min(right_down[0] + margin, width),
+        min(right_down[1] + margin, height),
+    )
+    region = smooth_image(img.crop(box), smooth)
+    # Remove the margin
+    region = region.crop(
+        (
+            left_up[0] - box[0],
+            left_up[1] - box[1],
+            right_down[0] - box[0],
+            right_down[1] - box[1],
+        )
+    )
+    if extrema is not None:
+        with span("normalise"):
+            region = normalise(region, extrema)
+    return region
+
+
 def crop(img: Image, left_up: Tuple[int, int], right_down: Tuple[int, int]) -> Image:
     """
     Crop the image.
@@ -38,8 +189,23 @@ def crop(img: Image, left_up: Tuple[int, int], right_down: Tuple[int, int]) -> I
         raise f"The height is bigger than the original height {height}"
 
     # Crop the image
-    img = img.crop((*left_up, *right_down))
+    with span("crop"):
+        img = img.crop((*left_up, *right_down))
+
+    return img
 
+
+def resize(img: Image) -> Image:
+    """
+    Do the last processing to give the image to the classifier.
+    :param img: PIL.Image. Cropped image
+    :return: PIL.Image in RGB of 224 by 224 pixels
+    """
+    with span("resize"):
+        # Convert the image to RGB
+        img = img.convert("RGB")
+        # Squeeze net need an image size of  224 by 224
+        img = img.resize((224, 224))
     return img
 
 
@@ -50,13 +216,132 @@ def save(img: Image, output_img: Path) -> None:
     :param output_img: Path to where to save the image and precise it's name.
     :return: None
     """
-    # Convert the image to RGB
-    img = img.convert("RGB")
-    # Squeeze net need an image size of  224 by 224
-    img = img.resize((224, 224))
+    img = resize(img)
     # If the destination do not exist, create it.
     output_img.parent.mkdir(parents=True, exist_ok=True)
-    img.save(output_img)
+    with span("save"):
+        img.save(output_img)
+
+
+def extract_part(
+    img: Path,
+    left_up: Tuple[int, int],
+    right_down: Tuple[int, int],
+    normalise_flag: bool = False,
+    smooth: int = 0,
+    roi_first: bool = False,
+    extrema_scale: int = DEFAULT_EXTREMA_SCALE,
+    decode_size: int = None,
+) -> Image:
+    """
+    Load the image, crop it and resize it for the classifier, without saving it.
+    :param img: Path to the image
+    :param left_up: X,Y position of the left up corner
+    :param right_down: X,Y position of the right down corner
+    :param normalise_flag: Flag to normalise of not the images.
+    :param smooth: Number of times images must be smoothed
+    :param roi_first: If True, only the cropped region is smoothed and normalised (see region_first)
+    :param extrema_scale: With roi_first, reduction factor of the image used to compute the
+        normalisation extrema of the smoothed image (see smoothed_extrema)
+    :param decode_size: If not None, the image is loaded at a reduced resolution when the region
+        stays larger than decode_size pixels (see load_scaled)
+    :return: PIL.Image in RGB of 224 by 224 pixels
+    """
+    if roi_first:
+        img, [(left_up, right_down)] = load_scaled(
+            img, 0, [(left_up, right_down)], decode_size
+        )
+        with span("extrema"):
+            extrema = (
+                smoothed_extrema(img, smooth, extrema_scale) if normalise_flag else None
+            )
+        return resize(region_first(img, left_up, right_down, smooth, extrema))
+
+    # Load the image specified as input
+    img, [(left_up, right_down)] = load_scaled(
+        img, smooth, [(left_up, right_down)], decode_size
+    )
+    if normalise_flag:
+        with span("normalise"):
+            img = normalise(img)
+    # Crop the image
+    img = crop(img=img, left_up=left_up, right_down=right_down)
+    return resize(img)
+
+
+def load_regions(
+    regions_file: Path,
+) -> Dict[str, Tuple[Tuple[int, int], Tuple[int, int]]]:
+    """
+    Load the named regions (parts) to extract from the layer images of a build.
+    Two formats are supported:
+     - json: {"part_name": {"left_up": [X, Y], "right_down": [X, Y]}, ...}
+     - csv: with the columns part,left_x,left_y,right_x,right_y
+    :param regions_file: Path to the .json or .csv file
+    :return: dictionary {part name: (left_up, right_down)}
+    """
+    regions_file = Path(regions_file)
+    regions = {}
+    if regions_file.suffix == ".json":
+        with open(regions_file, "r") as f:
+            for name, region in json.load(f).items():
+                regions[name] = (tuple(region["left_up"]), tuple(region["right_down"]))
+    elif regions_file.suffix == ".csv":
+        with open(regions_file, newline="") as f:
+            for row in csv.DictReader(f):
+                regions[row["part"]] = (
+                    (int(row["left_x"]), int(row["left_y"])),
+                    (int(row["right_x"]), int(row["right_y"])),
+                )
+    else:
+        raise ValueError(f"Regions must be a .json or .csv file, got {regions_file}")
+    return regions
+
+
+def extract_parts(
+    img: Path,
+    regions: Dict[str, Tuple[Tuple[int, int], Tuple[int, int]]],
+    normalise_flag: bool = False,
+    smooth: int = 0,
+    roi_first: bool = False,
+    extrema_scale: int = DEFAULT_EXTREMA_SCALE,
+    decode_size: int = None,
+) -> Dict[str, Image]:
+    """
+    Load the image once and extract all the parts of the layer, ready for the classifier.
+    :param img: Path to the image
+    :param regions: dictionary {part name: (left_up, right_down)}
+    :param normalise_flag: Flag to normalise of not the images.
+    :param smooth: Number of times images must be smoothed
+    :param roi_first: If True, only the parts are smoothed and normalised (see region_first)
+    :param extrema_scale: With roi_first, reduction factor of the image used to compute the
+        normalisation extrema (computed once per image)
+    :param decode_size: If not None, the image is loaded at a reduced resolution when all the parts
+        stay larger than decode_size pixels (see load_scaled)
+    :return: dictionary {part name: PIL.Image in RGB of 224 by 224 pixels}
+    """
+    img, boxes = load_scaled(
+        img, 0 if roi_first else smooth, list(regions.values()), decode_size
+    )
+    regions = dict(zip(regions, boxes))
+    if roi_first:
+        with span("extrema"):
+            extrema = (
+                smoothed_extrema(img, smooth, extrema_scale) if normalise_flag else None
+            )
+        return {
+            name: resize(region_first(img, left_up, right_down, smooth, extrema))
+            for name, (left_up, right_down) in regions.items()
+        }
+
+    # The image is loaded, smoothed and normalised only once for all the parts
+    if normalise_flag:
+        with span("normalise"):
+            img = normalise(img)
+    return {
+        name: resize(crop(img=img, left_up=left_up, right_down=right_down))
+        for name, (left_up, right_down) in regions.items()
+    }
 
 
 def part_extraction(
@@ -66,6 +351,9 @@ def part_extraction(
     output_img: Path,
     normalise_flag: bool = False,
     smooth: int = 0,
+    roi_first: bool = False,
+    extrema_scale: int = DEFAULT_EXTREMA_SCALE,
+    decode_size: int = None,
 ):
     """
     Load the image, crop it and save it.
@@ -75,18 +363,105 @@ def part_extraction(
     :param output_img: Path to save the image (with file name + extension)
     :param normalise_flag: Flag to normalise of not the images.
     :param smooth: Number of times images must be smoothed
+    :param roi_first: If True, only the cropped region is smoothed and normalised
+    :param extrema_scale: With roi_first, reduction factor of the image used to compute the
+        normalisation extrema
+    :param decode_size: If not None, the image is loaded at a reduced resolution when the region
+        stays larger than decode_size pixels (see load_scaled)
     :return:
     """
-    # Load the image specified as input
-    img = load_image(img, smooth)
-    if normalise_flag:
-        img = normalise(img)
-    # Crop the image
-    img = crop(img=img, left_up=left_up, right_down=right_down)
+    img = extract_part(
+        img,
+        left_up,
+        right_down,
+        normalise_flag,
+        smooth,
+        roi_first,
+        extrema_scale,
+        decode_size,
+    )
     # Save the cropped image
     save(img, output_img)
 
 
+def check_roi_first(
+    img: Path,
+    left_up: Tuple[int, int],
+    right_down: Tuple[int, int],
+    normalise_flag: bool = False,
+    smooth: int = 0,
+    extrema_scale: int = DEFAULT_EXTREMA_SCALE,
+) -> Dict[str, float]:
+    """
+    Parity check of the roi_first processing against the whole image processing.
+    Both images are identical without normalisation or smoothing, and with extrema_scale = 1. With
+    normalisation, smoothing and a larger extrema_scale, the extrema of the smoothed image are computed
+    on a reduced image and the pixel values can differ slightly (see ROI_FIRST_TOLERANCE).
+    :param img: Path to the image
+    :param left_up: X,Y position of the left up corner
+    :param right_down: X,Y position of the right down corner
+    :param normalise_flag: Flag to normalise of not the images.
+    :param smooth: Number of times images must be smoothed
+    :param extrema_scale: Reduction factor of the image used to compute the normalisation extrema
+    :return: dictionary with the maximum and mean absolute pixel difference
+    """
+    reference = np.asarray(
+        extract_part(img, left_up, right_down, normalise_flag, smooth), dtype="int16"
+    )
+    roi_first = np.asarray(
+        extract_part(
+            img, left_up, right_down, normalise_flag, smooth, True, extrema_scale
+        ),
+        dtype="int16",
+    )
+    difference = np.abs(reference - roi_first)
+    return {
+        "max_difference": float(difference.max()),
+        "mean_difference": float(difference.mean()),
+    }
+
+
+def check_reduced_decode(
+    img: Path,
+    left_up: Tuple[int, int],
+    right_down: Tuple[int, int],
+    normalise_flag: bool = False,
+    smooth: int = 0,
+    decode_size: int = 224,
+) -> Dict[str, float]:
+    """
+    Parity check of the reduced resolution decoding against the full resolution decoding,
+    the images given to the classifier are compared.
+    :param img: Path to the image
+    :param left_up: X,Y position of the left up corner
+    :param right_down: X,Y position of the right down corner
+    :param normalise_flag: Flag to normalise of not the images.
+    :param smooth: Number of times images must be smoothed
+    :param decode_size: Minimum size of the region once reduced (input size of the model)
+    :return: dictionary with the reduction used and the maximum and mean absolute pixel difference
+    """
+    reference = np.asarray(
+        extract_part(img, left_up, right_down, normalise_flag, smooth), dtype="int16"
+    )
+    reduced = np.asarray(
+        extract_part(
+            img,
+            left_up,
+            right_down,
+            normalise_flag,
+            smooth,
+            decode_size=decode_size,
+        ),
+        dtype="int16",
+    )
+    difference = np.abs(reference - reduced)
+    return {
+        "scale": decode_scale([(left_up, right_down)], decode_size),
+        "max_difference": float(difference.max()),
+        "mean_difference": float(difference.mean()),
+    }
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(
         description="Crop ELO image to extract the part ELO image"
@@ -115,13 +490,76 @@ if __name__ == "__main__":
         action="store_true",
         help="Flag if the images need to be normalised",
     )
+    parser.add_argument(
+        "-s",
+        "--smooth",
+        type=int,
+        default=0,
+        help="Number of times images must be smoothed",
+    )
+    parser.add_argument(
+        "--roi_first",
+        action="store_true",
+        help="Only smooth and normalise the cropped region instead of the whole image",
+    )
+    parser.add_argument(
+        "--extrema_scale",
+        type=int,
+        default=DEFAULT_EXTREMA_SCALE,
+        help="With --roi_first and --smooth, reduction factor of the image used to compute the "
+        "normalisation extrema (1 to smooth the whole image for the exact extrema)",
+    )
+    parser.add_argument(
+        "--check_roi_first",
+        action="store_true",
+        help="Compare the --roi_first processing with the whole image processing, nothing is saved",
+    )
+    parser.add_argument(
+        "--decode_size",
+        type=int,
+        default=None,
+        help="Decode the image at a reduced resolution when the region stays larger than this size (ex: 224)",
+    )
+    parser.add_argument(
+        "--check_reduced_decode",
+        action="store_true",
+        help="Compare the reduced resolution decoding (--decode_size, 224 by default) with the full "
+        "resolution decoding, nothing is saved",
+    )
 
     args = parser.parse_args()
 
-    part_extraction(
-        img=args.input_img,
-        left_up=args.left_up,
-        right_down=args.right_down,
-        output_img=args.output_img,
-        normalise_flag=args.normalise,
-    )
+    if args.check_roi_first:
+        print(
+            check_roi_first(
+                img=args.input_img,
+                left_up=args.left_up,
+                right_down=args.right_down,
+                normalise_flag=args.normalise,
+                smooth=args.smooth,
+                extrema_scale=args.extrema_scale,
+            )
+        )
+    elif args.check_reduced_decode:
+        print(
+            check_reduced_decode(
+                img=args.input_img,
+                left_up=args.left_up,
+                right_down=args.right_down,
+                normalise_flag=args.normalise,
+                smooth=args.smooth,
+                decode_size=args.decode_size or 224,
+            )
+        )
+    else:
+        part_extraction(
+            img=args.input_img,
+            left_up=args.left_up,
+            right_down=args.right_down,
+            output_img=args.output_img,
+            normalise_flag=args.normalise,
+            smooth=args.smooth,
+            roi_first=args.roi_first,
+            extrema_scale=args.extrema_scale,
+            decode_size=args.decode_size,
+        )
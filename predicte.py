@@ -1,118 +1,398 @@
 from pathlib import Path
 import torch
-from torch import nn
 from PIL import Image
-from torchvision import transforms
 import argparse
-from csv import writer
 from tqdm import tqdm
+from backend import BACKENDS, DEFAULT_BACKEND, set_threads
+from discovery import scan_images
+import metrics
+from metrics import count, debug, span
+import models
+from models import (
+    DEFAULT_MODEL,
+    MODELS,
+    MultiModel,
+    get_spec,
+    load_model,
+    load_models,
+    model_version,
+)
+from results import ResultSink, open_sink
+from inference import (
+    DEFAULT_BATCH_SIZE,
+    DEFAULT_DECODE_WORKERS,
+    DEFAULT_PREFETCH,
+    predict_batches,
+    predict_store,
+)
+from parallel import predict_parallel
+from tensor_store import TensorStore
 
+# Description of the V1 model (see models.MODELS), kept for the scripts using it directly
+INPUT_SIZE = MODELS["v1"].input_size[0]
+CLASSES = MODELS["v1"].classes
+MODEL_PATH = MODELS["v1"].checkpoint
 
-def create_pretrain_model():
+
+def create_pretrain_model(
+    checkpoint=None,
+    ready_model=None,
+    backend: str = DEFAULT_BACKEND,
+    model_name: str = DEFAULT_MODEL,
+):
     """
-    Create a pretrained model for ELO image classification. Base on the squeezenet architecture.
-    :return: torchvision.models.squeezenet.SqueezeNet with weights for the classification.
+    Create a pretrained model for ELO image classification, by default the V1 squeezenet.
+    The model is kept in a process level cache, so calling this function again returns the already
+    loaded model (see models.load_model).
+    :param checkpoint: Path to the weights of the model, the checkpoint of the model by default
+    :param ready_model: Optional path to a serialized "ready to run" TorchScript model.
+        If it exists it is loaded instead of the checkpoint, otherwise it is created from the checkpoint.
+        With the int8 backend, path of the quantised model created by quantise.py.
+    :param backend: Inference backend (see backend.BACKENDS), the frozen backends do not use ready_model
+    :param model_name: Name of the model (see models.MODELS)
+    :return: the model with weights for the classification.
     """
-    # Create model
-    model = torch.hub.load("pytorch/vision:v0.10.0", "squeezenet1_0", pretrained=False)
-    model.classifier[1] = nn.Conv2d(512, 3, kernel_size=(1, 1), stride=(1, 1))
-    model.num_classes = 3
-    # Load pre trained weights
-    model.load_state_dict(
-        torch.load("SqueezeNet_pretrain_epoch-38.pt", map_location=torch.device("cpu"))
-    )
-    model.eval()
+    return load_model(model_name, checkpoint, ready_model, backend)
+
 
-    return model
+def build_model(checkpoint=MODEL_PATH):
+    """
+    Build the V1 squeezenet architecture and load the pre trained weights.
+    :param checkpoint: Path to the weights of the model
+    :return: torchvision.models.squeezenet.SqueezeNet in eval mode
+    """
+    return models.build_model("v1", checkpoint)
 
 
-def batch_classify(images_path, output_path):
+def batch_classify(
+    images_path,
+    output_path,
+    batch_size: int = DEFAULT_BATCH_SIZE,
+    ready_model=None,
+    decode_workers: int = DEFAULT_DECODE_WORKERS,
+    prefetch: int = DEFAULT_PREFETCH,
+    loader=Image.open,
+    backend: str = DEFAULT_BACKEND,
+    model_name: str = DEFAULT_MODEL,
+    change_detector=None,
+    ensemble: bool = False,
+    inference_workers: int = 1,
+):
     """
-    Classify a list of images, dataloader are not use to avoid memory issues with big list of files.
-    :param images_path: list of path of images
-    :param output_path If not none, the prediction will be added to the targeted csv
+    Load the model and classify a list of images (see classify_images).
+    :param images_path: list of path of images, or a tensor_store.TensorStore of preprocessed crops
+    :param output_path If not none, the prediction will be added to the targeted results file
+        (.csv, .jsonl, .cols or .sqlite, see results.open_sink), or a results.ResultSink closed
+        once the images are classified
+    :param batch_size: Number of images classified in one forward pass
+    :param ready_model: Optional path to a serialized "ready to run" model (see create_pretrain_model)
+    :param decode_workers: Number of threads decoding images while the model is running
+    :param prefetch: Maximum number of images decoded in advance
+    :param loader: Function giving the PIL.Image to classify from an element of images_path
+    :param backend: Inference backend (see backend.BACKENDS)
+    :param model_name: Name of the model (see models.MODELS), or list of names to run several
+        models on the same decoded images (see models.MultiModel)
+    :param change_detector: Optional change_detection.ChangeDetector (see classify_images)
+    :param ensemble: With several models, add the mean probability of the classes shared by the models
+    :param inference_workers: Number of processes classifying the images (see classify_images)
     :return:
     """
     # Create the torch model
-    model = create_pretrain_model()
-    # Classify the image
+    if isinstance(model_name, str):
+        model = create_pretrain_model(
+            ready_model=ready_model, backend=backend, model_name=model_name
+        )
+    else:
+        model = load_models(model_name, backend, ensemble)
+    return classify_images(
+        model,
+        images_path,
+        output_path,
+        batch_size,
+        decode_workers,
+        prefetch,
+        loader,
+        model_name,
+        change_detector,
+        inference_workers,
+    )
+
+
+def classify_images(
+    model,
+    images_path,
+    output_path,
+    batch_size: int = DEFAULT_BATCH_SIZE,
+    decode_workers: int = DEFAULT_DECODE_WORKERS,
+    prefetch: int = DEFAULT_PREFETCH,
+    loader=Image.open,
+    model_name: str = DEFAULT_MODEL,
+    change_detector=None,
+    inference_workers: int = 1,
+):
+    """
+    Classify a list of images, dataloader are not use to avoid memory issues with big list of files.
+    Images are loaded and classified by mini-batches of batch_size images (one forward pass per batch).
+    The crops of a tensor_store.TensorStore are classified without being decoded.
+    :param model: the pretrained model
+    :param images_path: list of path of images, or a tensor_store.TensorStore of preprocessed crops
+    :param output_path If not none, the prediction will be added to the targeted results file
+        (.csv, .jsonl, .cols or .sqlite, see results.open_sink), or a results.ResultSink closed
+        once the images are classified
+    :param batch_size: Number of images classified in one forward pass
+    :param decode_workers: Number of threads decoding images while the model is running
+    :param prefetch: Maximum number of images decoded in advance
+    :param loader: Function giving the PIL.Image to classify from an element of images_path
+    :param model_name: Name of the model (see models.MODELS), gives the preprocessing and the classes.
+        Not used for a models.MultiModel, the images are only converted to tensors once for all its models
+    :param change_detector: Optional change_detection.ChangeDetector, the images nearly identical to
+        the previous layer of their region reuse its results and are marked in a "reused" column
+    :param inference_workers: Number of processes decoding and classifying the images, on their own
+        slices of cores and sharing the loaded model (see parallel.predict_parallel)
+    :return: list of the results dictionaries
+    """
+    if inference_workers > 1 and (
+        change_detector is not None or isinstance(images_path, TensorStore)
+    ):
+        raise ValueError(
+            "The parallel inference does not support the change detection and the tensor stores"
+        )
+    if isinstance(model, MultiModel):
+        # The images are only converted to tensors, each model resizes and normalises them
+        classes = model.classes
+        preprocess = models.get_preprocess(None)
+        preprocess_batch = models.crops_to_batch
+        version = "+".join(model_version(name) for name in model.names)
+    else:
+        classes = get_spec(model_name).classes
+        preprocess = get_preprocess(model_name)
+        preprocess_batch = models.get_batch_preprocess(model_name)
+        version = model_version(model_name)
+    # Classify the images
     classification_list = []
-    for image_path in tqdm(images_path):
-        classification_list.append(classify_an_image(model, image_path, output_path))
+    # The results are buffered and written by blocks
+    if isinstance(images_path, TensorStore):
+        # The batches are slices of the memory mapped crops
+        predictions = tqdm(
+            predict_store(
+                model,
+                images_path,
+                preprocess_batch,
+                batch_size,
+                change_detector,
+            ),
+            total=len(images_path),
+        )
+    elif inference_workers > 1:
+        predictions = predict_parallel(
+            model, tqdm(images_path), preprocess, batch_size, inference_workers, loader
+        )
+    else:
+        predictions = predict_batches(
+            model,
+            tqdm(images_path),
+            preprocess,
+            batch_size,
+            decode_workers,
+            prefetch,
+            loader,
+            change_detector,
+        )
+    sink = output_path
+    if not isinstance(output_path, ResultSink):
+        sink = open_sink(output_path, model=version)
+    with sink:
+        for image_path, output, probabilities in predictions:
+            reused = None
+            if change_detector is not None:
+                reused = change_detector.is_reused(image_path)
+            part = None
+            if isinstance(image_path, tuple):
+                # Part cropped from a layer image: (image path, part name)
+                image_path, part = image_path
+            debug(2, output)
+            debug(2, probabilities)
+            proba_to_text = probabilities_to_dict(
+                image_path, probabilities, part, classes
+            )
+            if reused is not None:
+                proba_to_text["reused"] = int(reused)
+                count("reused", int(reused))
+            debug(1, proba_to_text)
+            with span("write_results"):
+                sink.write(proba_to_text)
+            count("images")
+            classification_list.append(proba_to_text)
 
+    if change_detector is not None:
+        print(f"Change detection: {change_detector.summary()}")
     return classification_list
 
 
-def classify_an_image(model, image_path, output_path):
+def get_preprocess(model_name: str = DEFAULT_MODEL):
+    """
+    Transformations applied on an image before being given to the model.
+    :param model_name: Name of the model (see models.MODELS)
+    :return: torchvision.transforms.Compose
+    """
+    return models.get_preprocess(model_name)
+
+
+def probabilities_to_dict(
+    image_path, probabilities, part=None, classes=CLASSES
+) -> dict:
+    """
+    Format the classification probabilities of one image.
+    :param image_path: path to the classified image
+    :param probabilities: Tensor with the softmax of the model output
+    :param part: If not None, name of the part of the layer image that was classified
+    :param classes: Class names, in the order of the model outputs (V1 classes by default)
+    :return: dictionary with the image name and the classification probability.
+    """
+    probabilities = probabilities.numpy()
+    proba_to_text = {"image_path": str(image_path)}
+    if part is not None:
+        proba_to_text["part"] = part
+    for i, class_name in enumerate(classes):
+        proba_to_text[class_name] = round(probabilities[i], 4)
+    return proba_to_text
+
+
+def save_classification(proba_to_text: dict, output_path) -> None:
+    """
+    Add the classification of one image to a results file (.csv, .jsonl, .cols or .sqlite, see results.open_sink).
+    :param proba_to_text: dictionary with the image name and the classification probability.
+    :param output_path If not none, the prediction will be added to the targeted csv
+    :return: None
+    """
+    with open_sink(output_path) as sink:
+        sink.write(proba_to_text)
+
+
+def classify_an_image(model, image_path, output_path, model_name: str = DEFAULT_MODEL):
     """
     Load ONE image an classify it.
     :param model: the pretrained model
     :param image_path: path to one image
     :param output_path If not none, the prediction will be added to the targeted csv
+    :param model_name: Name of the model (see models.MODELS), gives the preprocessing and the classes
     :return: dictionary with the image name and the classification probability.
     """
     image_path = Path(image_path)
 
     # Load image
-    input_size = 224
-    input_image = Image.open(image_path)
-    preprocess = transforms.Compose(
-        [
-            transforms.Resize(input_size),
-            transforms.ToTensor(),
-            transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225]),
-        ]
-    )
-    input_tensor = preprocess(input_image)
+    with span("decode"):
+        input_image = Image.open(image_path)
+        input_image.load()
+    preprocess = get_preprocess(model_name)
+    with span("preprocess"):
+        input_tensor = preprocess(input_image)
     input_batch = input_tensor.unsqueeze(
         0
     )  # create a mini-batch as expected by the model
 
     # Make a prediction
-    with torch.no_grad():
+    with span("forward"), torch.no_grad():
         output = model(input_batch)
-    # Tensor of shape 1000, with confidence scores over Imagenet's 1000 classes
-    print(output[0])
+    # Tensor with the confidence scores over the classes
+    debug(2, output[0])
     # The output has unnormalized scores. To get probabilities, you can run a softmax on it.
     probabilities = torch.nn.functional.softmax(output[0], dim=0)
-    print(probabilities)
+    debug(2, probabilities)
 
-    probabilities = probabilities.numpy()
-    proba_to_text = {
-        "image_path": str(image_path),
-        "good": round(probabilities[0], 4),
-        "porous": round(probabilities[1], 4),
-        "bulging": round(probabilities[2], 4),
-    }
-    print(proba_to_text)
-
-    # If an ouput path is specified:
-    if not output_path is None:
-        output_path = Path(output_path)
-        # if the file output is not existing, create an empty one with the header
-        if not output_path.is_file():
-            with open(output_path, "w", newline="") as write_csv:
-                csv_writer = writer(write_csv)
-                csv_writer.writerow(["image_path", "good", "porous", "bulging"])
-
-        with open(output_path, "a+", newline="") as write_csv:
-            csv_writer = writer(write_csv)
-            csv_writer.writerow(
-                [
-                    proba_to_text["image_path"],
-                    proba_to_text["good"],
-                    proba_to_text["porous"],
-                    proba_to_text["bulging"],
-                ]
-            )
+    proba_to_text = probabilities_to_dict(
+        image_path, probabilities, classes=get_spec(model_name).classes
+    )
+    debug(1, proba_to_text)
+
+    with span("write_results"):
+        save_classification(proba_to_text, output_path)
+    count("images")
 
     return proba_to_text
 
 
-if __name__ == "__main__":
+def main(
+    input_img: Path = None,
+    batch_folder: Path = None,
+    output: str = None,
+    model_name: str = DEFAULT_MODEL,
+    ready_model: Path = None,
+    backend: str = DEFAULT_BACKEND,
+    batch_size: int = DEFAULT_BATCH_SIZE,
+    decode_workers: int = DEFAULT_DECODE_WORKERS,
+    prefetch: int = DEFAULT_PREFETCH,
+    threads: int = None,
+    interop_threads: int = None,
+    verbosity: int = None,
+    metrics_file: Path = None,
+) -> None:
+    """
+    Classify one image or all the .jpg and .png images of a folder.
+    :param input_img: Path to the image to classify
+    :param batch_folder: Or folder of the images to classify
+    :param output: If not none, the prediction will be added to the targeted csv
+    :param model_name: Name of the model (see models.MODELS)
+    :param ready_model: Optional path to a serialized ready to run model
+    :param backend: Inference backend (see backend.BACKENDS)
+    :param batch_size: Number of images classified in one forward pass (with batch_folder)
+    :param decode_workers: Number of threads decoding images while the model is running
+    :param prefetch: Maximum number of images decoded in advance
+    :param threads: Number of intra op threads used by torch, None to keep the default
+    :param interop_threads: Number of inter op threads used by torch, None to keep the default
+    :param verbosity: 0: no result printed, 1: the results, 2: also the scores and probabilities,
+        by default 1 for one image and 0 for a folder
+    :param metrics_file: If not None, the duration of each stage is saved in this file (see metrics.export)
+    :return: None
+    """
+    if input_img is None and batch_folder is None:
+        raise ValueError(
+            "No inputs images nor folder was given. Please specify what image(s) to classify."
+        )
+    if verbosity is None:
+        verbosity = 1 if input_img is not None else 0
+    metrics.set_verbosity(verbosity)
+    metrics.enable(metrics_file is not None)
+    set_threads(threads, interop_threads)
+    # Create the torch model
+    model = create_pretrain_model(
+        ready_model=ready_model, backend=backend, model_name=model_name
+    )
+
+    if input_img is not None:
+        # Classify the image provided
+        classify_an_image(model, input_img, output, model_name)
+    else:
+        # Classify a folder of images
+        classify_images(
+            model,
+            scan_images(batch_folder),
+            output,
+            batch_size,
+            decode_workers,
+            prefetch,
+            model_name=model_name,
+        )
+    if metrics_file is not None:
+        metrics.export(metrics_file)
+
+
+def get_parser(default_model: str = DEFAULT_MODEL) -> argparse.ArgumentParser:
+    """
+    Command line arguments of the classification of images (see main).
+    :param default_model: Model used when --model is not given
+    :return: argparse.ArgumentParser
+    """
     parser = argparse.ArgumentParser(description="Will classify one image.")
     parser.add_argument(
-        "-i", "--input_img", type=Path, help="Path to the image to load"
+        "-i", "--input_img", type=Path, help="Path to the image to load", default=None
+    )
+    parser.add_argument(
+        "-b",
+        "--batch_folder",
+        type=Path,
+        help="To classify multiple images, take the folder path",
+        default=None,
     )
     parser.add_argument(
         "-o",
@@ -120,10 +400,66 @@ if __name__ == "__main__":
         type=str,
         help="If not none, the prediction will be added to the targeted csv",
     )
-    args = parser.parse_args()
+    parser.add_argument(
+        "--model",
+        dest="model_name",
+        choices=list(MODELS),
+        default=default_model,
+        help="Classification model (v1: SqueezeNet 3 classes, v2: ImageClassifier 5 classes)",
+    )
+    parser.add_argument(
+        "--ready_model",
+        type=Path,
+        default=None,
+        help="Path of a serialized ready to run model, created from the checkpoint if missing "
+        "(with --backend int8, path of the model created by quantise.py -o)",
+    )
+    parser.add_argument(
+        "--backend",
+        choices=BACKENDS,
+        default=DEFAULT_BACKEND,
+        help="Inference backend, the optimised models are saved next to the checkpoint",
+    )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=DEFAULT_BATCH_SIZE,
+        help="Number of images classified in one forward pass (with -b)",
+    )
+    parser.add_argument(
+        "--decode_workers",
+        type=int,
+        default=DEFAULT_DECODE_WORKERS,
+        help="Number of threads decoding images while the model is running (0 to disable)",
+    )
+    parser.add_argument(
+        "--prefetch",
+        type=int,
+        default=DEFAULT_PREFETCH,
+        help="Maximum number of images decoded in advance",
+    )
+    parser.add_argument(
+        "--threads", type=int, default=None, help="Number of intra op threads"
+    )
+    parser.add_argument(
+        "--interop_threads", type=int, default=None, help="Number of inter op threads"
+    )
+    parser.add_argument(
+        "--verbosity",
+        type=int,
+        default=None,
+        help="0: no result printed, 1: print the results, 2: also print the scores and probabilities "
+        "tensors (default: 1 for one image, 0 for a folder)",
+    )
+    parser.add_argument(
+        "--metrics",
+        dest="metrics_file",
+        type=Path,
+        default=None,
+        help="Save the duration of each stage in this file (.json summary, Prometheus text format otherwise)",
+    )
+    return parser
 
-    # Create the torch model
-    model = create_pretrain_model()
 
-    # Classify the image
-    classify_an_image(model, args.input_img, args.output)
+if __name__ == "__main__":
+    main(**vars(get_parser().parse_args()))
@@ -1,44 +1,90 @@
-from pathlib import Path
-import torch
-from torch import nn
 from PIL import Image
-from torchvision import transforms
-import argparse
-from csv import writer
-from tqdm import tqdm
-from flash.image import ImageClassifier
+from backend import DEFAULT_BACKEND
+import models
+from models import load_model, MODELS
+import predicte
+from predicte import classify_images, get_parser, main, save_classification
+from inference import (
+    DEFAULT_BATCH_SIZE,
+    DEFAULT_DECODE_WORKERS,
+    DEFAULT_PREFETCH,
+)
+
+# Description of the V2 model (see models.MODELS), lightning-flash is only imported when it is built
+INPUT_SIZE = MODELS["v2"].input_size
+CLASSES = MODELS["v2"].classes
+MODEL_PATH = MODELS["v2"].checkpoint
+
+
+def create_pretrain_model(backend: str = DEFAULT_BACKEND):
+    """
+    Load the model for an inference backend (see backend.BACKENDS).
+    :param backend: Inference backend, the optimised models are saved next to the checkpoint
+    :return: ImageClassifier model with loaded weitgh (or its optimised TorchScript version).
+    """
+    return load_model("v2", backend=backend)
 
 
-def create_pretrain_model():
+def build_model(checkpoint=MODEL_PATH):
     """
     Load a saved pytorch lightning model from a path.
     The model is put in eval mode and gradient is deactivated.
-    :param path: path where is saved the model
+    :param checkpoint: path where is saved the model
     :return: ImageClassifier model with loaded weitgh.
     """
-    model = ImageClassifier.load_from_checkpoint(r"image_classification_model.pt")
-
-    for p in model.parameters():
-        p.requires_grad = False
-    model.eval()
-
-    return model
-
-
-def batch_classify(model, images_path, output_path):
+    return models.build_model("v2", checkpoint)
+
+
+def batch_classify(
+    model,
+    images_path,
+    output_path,
+    batch_size: int = DEFAULT_BATCH_SIZE,
+    decode_workers: int = DEFAULT_DECODE_WORKERS,
+    prefetch: int = DEFAULT_PREFETCH,
+    loader=Image.open,
+):
     """
-    Classify a list of images, dataloader are not use to avoid memory issues with big list of files.
+    Classify a list of images with the V2 model (see predicte.classify_images).
     :param model: the pretrained model
     :param images_path: list of path of images
-    :param output_path If not none, the prediction will be added to the targeted csv
+    :param output_path If not none, the prediction will be added to the targeted results file
+        (.csv, .jsonl or .cols, see results.open_sink)
+    :param batch_size: Number of images classified in one forward pass
+    :param decode_workers: Number of threads decoding images while the model is running
+    :param prefetch: Maximum number of images decoded in advance
+    :param loader: Function giving the PIL.Image to classify from an element of images_path
     :return:
     """
-    # Classify the image
-    classification_list = []
-    for image_path in tqdm(images_path):
-        classification_list.append(classify_an_image(model, image_path, output_path))
+    return classify_images(
+        model,
+        images_path,
+        output_path,
+        batch_size,
+        decode_workers,
+        prefetch,
+        loader,
+        "v2",
+    )
+
+
+def get_preprocess():
+    """
+    Transformations applied on an image before being given to the model.
+    :return: torchvision.transforms.Compose
+    """
+    return models.get_preprocess("v2")
 
-    return classification_list
+
+def probabilities_to_dict(image_path, probabilities, part=None) -> dict:
+    """
+    Format the classification probabilities of one image.
+    :param image_path: path to the classified image
+    :param probabilities: Tensor of shape 5 with the softmax of the model output
+    :param part: If not None, name of the part of the layer image that was classified
+    :return: dictionary with the image name and the classification probability.
+    """
+    return predicte.probabilities_to_dict(image_path, probabilities, part, CLASSES)
 
 
 def classify_an_image(model, image_path, output_path):
@@ -49,98 +95,8 @@ def classify_an_image(model, image_path, output_path):
     :param output_path If not none, the prediction will be added to the targeted csv
     :return: dictionary with the image name and the classification probability.
     """
-    image_path = Path(image_path)
-
-    # Load image
-    input_size = (196, 196)
-    input_image = Image.open(image_path)
-    preprocess = transforms.Compose(
-        [
-            transforms.Resize(input_size),
-            transforms.ToTensor(),
-            transforms.ConvertImageDtype(torch.float),
-            transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225]),
-        ]
-    )
-    input_tensor = preprocess(input_image)
-    input_batch = input_tensor.unsqueeze(
-        0
-    )  # create a mini-batch as expected by the model
-
-    # Make a prediction
-    with torch.no_grad():
-        output = model(input_batch)
-    # Tensor of shape 1000, with confidence scores over Imagenet's 1000 classes
-    print(output[0])
-    # The output has unnormalized scores. To get probabilities, you can run a softmax on it.
-    probabilities = torch.nn.functional.softmax(output[0], dim=0)
-    print(probabilities)
-
-    probabilities = probabilities.numpy()
-    proba_to_text = {
-        "image_path": str(image_path),
-        "bulging": round(probabilities[0], 4),
-        "edges": round(probabilities[1], 4),
-        "good": round(probabilities[2], 4),
-        "porous": round(probabilities[3], 4),
-        "powder": round(probabilities[4], 4),
-
-    }
-    print(proba_to_text)
-
-    # If an ouput path is specified:
-    if not output_path is None:
-        output_path = Path(output_path)
-        # if the file output is not existing, create an empty one with the header
-        if not output_path.is_file():
-            with open(output_path, "w", newline="") as write_csv:
-                csv_writer = writer(write_csv)
-                csv_writer.writerow(["image_path", "bulging", "edges", "good", "porous", "powder"])
-
-        with open(output_path, "a+", newline="") as write_csv:
-            csv_writer = writer(write_csv)
-            csv_writer.writerow(
-                [
-                    proba_to_text["image_path"],
-                    proba_to_text["bulging"],
-                    proba_to_text["edges"],
-                    proba_to_text["good"],
-                    proba_to_text["porous"],
-                    proba_to_text["powder"],
-                ]
-            )
-
-    return proba_to_text
+    return predicte.classify_an_image(model, image_path, output_path, "v2")
 
 
 if __name__ == "__main__":
-    parser = argparse.ArgumentParser(description="Will classify one image.")
-    parser.add_argument(
-        "-i", "--input_img", type=Path, help="Path to the image to load", default=None
-    )
-    parser.add_argument(
-        "-b", "--batch_folder", type=Path, help="To classify multiple images, take the folder path", default=None
-    )
-    parser.add_argument(
-        "-o",
-        "--output",
-        type=str,
-        help="If not none, the prediction will be added to the targeted csv",
-    )
-    args = parser.parse_args()
-
-    if args.input_img is None and args.batch_folder is None:
-        raise "No inputs images nor folder was given. Please specify what image(s) to classify."
-
-    # Create the torch model
-    model = create_pretrain_model()
-
-    if not args.input_img is None:
-        # Classify the image provided
-        classify_an_image(model, args.input_img, args.output)
-
-    else:
-        # Classify a folder of images
-        list_of_images = list(Path(args.batch_folder).glob("*.jpg"))
-        list_of_images.extend(list(Path(args.batch_folder).glob("*.png")))
-        batch_classify(model, list_of_images , args.output)
\ No newline at end of file
+    main(**vars(get_parser("v2").parse_args()))
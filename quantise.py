@@ -0,0 +1,322 @@
+import argparse
+import inspect
+import json
+from pathlib import Path
+from typing import Dict, List
+import torch
+from torch import nn
+from PIL import Image
+from backend import optimised_model_path, set_threads, throughput
+from predicte import CLASSES, INPUT_SIZE, MODEL_PATH, build_model, get_preprocess
+
+try:
+    # torch >= 1.13
+    from torch.ao.quantization import get_default_qconfig_mapping
+except ImportError:
+    get_default_qconfig_mapping = None
+from torch.ao.quantization import (
+    default_dynamic_qconfig,
+    get_default_qconfig,
+    quantize_dynamic,
+)
+from torch.ao.quantization.quantize_fx import convert_fx, prepare_fx
+
+# Quantisation modes:
+# - static: weights and activations in INT8, the activation ranges are calibrated on images
+# - dynamic: weights in INT8, the activations are quantised on the fly (no calibration)
+MODES = ["static", "dynamic"]
+# Number of images used for the calibration
+DEFAULT_CALIBRATION_IMAGES = 200
+
+
+def list_images(folder: Path, limit: int = None) -> List[Path]:
+    """
+    List the .jpg and .png images of a folder.
+    :param folder: Path of the folder
+    :param limit: Maximum number of images
+    :return: list of path of images, sorted by name
+    """
+    images = sorted(list(Path(folder).glob("*.jpg")) + list(Path(folder).glob("*.png")))
+    return images[:limit]
+
+
+def load_tensors(images: List[Path]) -> List[torch.Tensor]:
+    """
+    Load and preprocess images as done before the classification.
+    :param images: list of path of images
+    :return: list of model inputs (1, C, H, W)
+    """
+    preprocess = get_preprocess()
+    return [preprocess(Image.open(img).convert("RGB")).unsqueeze(0) for img in images]
+
+
+def quantise_static(
+    model: nn.Module, calibration: List[torch.Tensor], engine: str
+) -> nn.Module:
+    """
+    Quantise the weights and activations of a model in INT8 (FX graph mode, the convolutions and
+    relu are fused), the activation ranges are observed on the calibration images.
+    :param model: the float model in eval mode
+    :param calibration: list of model inputs representative of the images to classify
+    :param engine: quantised engine (see torch.backends.quantized.supported_engines)
+    :return: quantised model
+    """
+    prepared = prepare_static(model, engine)
+    with torch.no_grad():
+        for tensor in calibration:
+            prepared(tensor)
+    return convert_fx(prepared)
+
+
+def prepare_static(model: nn.Module, engine: str) -> nn.Module:
+    """
+    Insert the observers of the static quantisation (prepare_fx). The example inputs and the qconfig
+    mapping are only given to the torch versions supporting them (torch >= 1.13), the older versions
+    (ex: torch 1.10) take a qconfig dictionary.
+    :param model: the float model in eval mode
+    :param engine: quantised engine (see torch.backends.quantized.supported_engines)
+    :return: model with observers
+    """
+    if "example_inputs" not in inspect.signature(prepare_fx).parameters:
+        return prepare_fx(model, {"": get_default_qconfig(engine)})
+    if get_default_qconfig_mapping is None:
+        qconfig = {"": get_default_qconfig(engine)}
+    else:
+        qconfig = get_default_qconfig_mapping(engine)
+    example = torch.zeros(1, 3, INPUT_SIZE, INPUT_SIZE)
+    return prepare_fx(model, qconfig, example_inputs=(example,))
+
+
+def dynamic_modules():
+    """
+    Module of the dynamic quantised layers, moved to torch.ao in torch 1.13.
+    :return: module torch.ao.nn.quantized.dynamic or torch.nn.quantized.dynamic
+    """
+    try:
+        import torch.ao.nn.quantized.dynamic as dynamic
+    except ImportError:
+        # torch < 1.13
+        import torch.nn.quantized.dynamic as dynamic
+    return dynamic
+
+
+def quantise_dynamic(model: nn.Module) -> nn.Module:
+    """
+    Quantise the weights of the convolutions in INT8, the activations are quantised on the fly.
+    :param model: the float model in eval mode
+    :return: quantised model
+    """
+    dynamic = dynamic_modules()
+    if not hasattr(dynamic, "Conv2d"):
+        raise RuntimeError(
+            f"The dynamic quantisation of the convolutions is not supported by torch {torch.__version__}"
+        )
+    return quantize_dynamic(
+        model,
+        {nn.Conv2d: default_dynamic_qconfig},
+        mapping={nn.Conv2d: dynamic.Conv2d},
+    )
+
+
+def save_quantised(model: nn.Module, output: Path, engine: str) -> None:
+    """
+    Save a quantised model with TorchScript, it can then be loaded with the int8 backend.
+    :param model: quantised model
+    :param output: Path of the TorchScript file
+    :param engine: quantised engine used, saved with the model
+    :return: None
+    """
+    example = torch.zeros(1, 3, INPUT_SIZE, INPUT_SIZE)
+    with torch.no_grad():
+        traced = torch.jit.freeze(torch.jit.trace(model, example).eval())
+    Path(output).parent.mkdir(parents=True, exist_ok=True)
+    torch.jit.save(traced, str(output), _extra_files={"engine": engine})
+
+
+def compare(
+    reference: nn.Module, quantised: nn.Module, tensors: List[torch.Tensor]
+) -> Dict:
+    """
+    Compare the probabilities of the quantised model to the ones of the float model.
+    :param reference: the float model
+    :param quantised: the quantised model
+    :param tensors: list of model inputs
+    :return: dictionary with the argmax agreement and the mean and maximum drift of each class
+    """
+    with torch.no_grad():
+        expected = torch.cat([torch.softmax(reference(x), dim=1) for x in tensors])
+        probabilities = torch.cat([torch.softmax(quantised(x), dim=1) for x in tensors])
+    drift = (probabilities - expected).abs()
+    return {
+        "images": len(tensors),
+        "argmax_agreement": (probabilities.argmax(1) == expected.argmax(1))
+        .float()
+        .mean()
+        .item(),
+        "drift": {
+            class_name: {
+                "mean": drift[:, i].mean().item(),
+                "max": drift[:, i].max().item(),
+            }
+            for i, class_name in enumerate(CLASSES)
+        },
+    }
+
+
+def quantise(
+    calibration_folder: Path,
+    eval_folder: Path = None,
+    calibration_images: int = DEFAULT_CALIBRATION_IMAGES,
+    mode: str = "static",
+    engine: str = None,
+    checkpoint: Path = MODEL_PATH,
+    output: Path = None,
+    report: Path = None,
+    batch_size: int = 32,
+) -> Dict:
+    """
+    Quantise the SqueezeNet in INT8 and compare it to the float model.
+    If the static quantisation fails (ex: no calibration image or engine not supported by the CPU),
+    the dynamic quantisation is used.
+    :param calibration_folder: Folder of representative cropped images (as given to the classifier)
+    :param eval_folder: Folder of images used for the comparison, by default the calibration folder
+    :param calibration_images: Maximum number of images used for the calibration
+    :param mode: static or dynamic
+    :param engine: quantised engine, by default the engine selected by torch
+    :param checkpoint: Path to the weights of the float model
+    :param output: Path of the quantised model, by default next to the checkpoint
+        (loaded by predicte.py --backend int8, another path is given with --ready_model)
+    :param report: If not None, json file where the report is saved
+    :param batch_size: Number of images per forward pass to measure the throughput
+    :return: the report
+    """
+    engine = engine or torch.backends.quantized.engine
+    torch.backends.quantized.engine = engine
+    output = Path(output or optimised_model_path(checkpoint, "int8"))
+
+    reference = build_model(checkpoint)
+    quantised = None
+    if mode == "static":
+        try:
+            calibration = load_tensors(
+                list_images(calibration_folder, calibration_images)
+            )
+            if not calibration:
+                raise ValueError(f"No image found in {calibration_folder}")
+            quantised = quantise_static(build_model(checkpoint), calibration, engine)
+        except Exception as error:
+            print(f"Static quantisation failed ({error}), dynamic quantisation used")
+            mode = "dynamic"
+    if quantised is None:
+        quantised = quantise_dynamic(build_model(checkpoint))
+    save_quantised(quantised, output, engine)
+    print(f"Quantised model saved in {output}")
+
+    # The saved model is compared, as used for the classification
+    quantised = torch.jit.load(str(output))
+    results = {"mode": mode, "engine": engine, "model": str(output)}
+    results.update(
+        compare(
+            reference,
+            quantised,
+            load_tensors(list_images(eval_folder or calibration_folder)),
+        )
+    )
+    input_size = (INPUT_SIZE, INPUT_SIZE)
+    results["throughput"] = {
+        "float": throughput(reference, input_size, batch_size),
+        "int8": throughput(quantised, input_size, batch_size),
+    }
+    if report is not None:
+        Path(report).write_text(json.dumps(results, indent=2))
+    return results
+
+
+def print_report(results: Dict) -> None:
+    """
+    Print the comparison of the quantised and float models.
+    :param results: report given by quantise
+    :return: None
+    """
+    print(f"Mode: {results['mode']} ({results['engine']}), {results['images']} images")
+    print(f"Argmax agreement: {100 * results['argmax_agreement']:.1f}%")
+    print(f"{'class':<12}{'mean drift':>14}{'max drift':>14}")
+    for class_name, drift in results["drift"].items():
+        print(f"{class_name:<12}{drift['mean']:>14.4f}{drift['max']:>14.4f}")
+    speed = results["throughput"]
+    print(
+        f"Throughput: float {speed['float']:.1f} images/s, int8 {speed['int8']:.1f} images/s "
+        f"(x{speed['int8'] / speed['float']:.1f})"
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Quantise the SqueezeNet model in INT8 and compare it to the float model."
+    )
+    parser.add_argument(
+        "-i",
+        "--calibration_folder",
+        type=Path,
+        help="Folder of representative cropped images, as given to the classifier",
+    )
+    parser.add_argument(
+        "-e",
+        "--eval_folder",
+        type=Path,
+        default=None,
+        help="Folder of images used for the comparison (default: the calibration folder)",
+    )
+    parser.add_argument(
+        "--calibration_images",
+        type=int,
+        default=DEFAULT_CALIBRATION_IMAGES,
+        help="Maximum number of images used for the calibration",
+    )
+    parser.add_argument(
+        "--mode",
+        choices=MODES,
+        default="static",
+        help="static: calibrated INT8 weights and activations, dynamic: INT8 weights only",
+    )
+    parser.add_argument(
+        "--engine",
+        choices=torch.backends.quantized.supported_engines,
+        default=None,
+        help="Quantised engine (x86/fbgemm for Intel and AMD CPU, qnnpack for ARM)",
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
+        type=Path,
+        default=None,
+        help="Path of the quantised model (default: next to the checkpoint, used by --backend int8, "
+        "give another path to the classification with --ready_model)",
+    )
+    parser.add_argument(
+        "--report", type=Path, default=None, help="json file where the report is saved"
+    )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=32,
+        help="Images per forward pass to measure the throughput",
+    )
+    parser.add_argument(
+        "--threads", type=int, default=None, help="Number of intra op threads"
+    )
+    args = parser.parse_args()
+
+    set_threads(args.threads)
+    print_report(
+        quantise(
+            calibration_folder=args.calibration_folder,
+            eval_folder=args.eval_folder,
+            calibration_images=args.calibration_images,
+            mode=args.mode,
+            engine=args.engine,
+            output=args.output,
+            report=args.report,
+            batch_size=args.batch_size,
+        )
+    )
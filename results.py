@@ -0,0 +1,572 @@
+import csv
+import io
+import json
+import os
+import sqlite3
+import struct
+import time
+from pathlib import Path
+from typing import Dict, Iterator, List
+import numpy as np
+
+# Number of rows buffered before being written
+DEFAULT_FLUSH_EVERY = 256
+# Maximum time (s) a row stays in the buffer
+DEFAULT_FLUSH_INTERVAL = 5.0
+# Extensions of the SQLite results databases
+DATABASE_SUFFIXES = (".sqlite", ".db")
+# Columns describing a result in a database, the other columns are the ones of the rows (classes, ...)
+DATABASE_KEYS = ["build", "image_path", "part", "layer_time", "model"]
+# Time (s) a database writer waits for another one before failing
+DATABASE_TIMEOUT = 30.0
+
+
+class ResultSink:
+    """
+    Buffer the classification results (one dictionary per image) and write them by blocks.
+    The rows are written when flush_every rows are buffered, when a row is added more than
+    flush_interval seconds after the last write, and when the sink is closed (use it as a context manager).
+    Each flush is written with one write call followed by a fsync, and an incomplete block left
+    by a crash is removed when the file is opened again, so the file never ends with a truncated row.
+    This base class does not write anything (no output path), see CsvSink, JsonLinesSink, ColumnarSink
+    and SqliteSink.
+    """
+
+    def __init__(
+        self,
+        output_path: Path = None,
+        flush_every: int = DEFAULT_FLUSH_EVERY,
+        flush_interval: float = DEFAULT_FLUSH_INTERVAL,
+    ):
+        """
+        :param output_path: Path of the results file, the results are appended if it exists
+        :param flush_every: Number of rows buffered before being written
+        :param flush_interval: Maximum time (s) a row stays in the buffer
+        """
+        self.output_path = None if output_path is None else Path(output_path)
+        self.flush_every = flush_every
+        self.flush_interval = flush_interval
+        self.columns = None
+        self.rows = []
+        self.last_flush = time.monotonic()
+
+    def write(self, row: dict) -> None:
+        """
+        Add one result to the buffer.
+        :param row: dictionary with the image name and the classification probability.
+        :return: None
+        """
+        if self.columns is None:
+            self.columns = list(row.keys())
+        self.rows.append(row)
+        if (
+            len(self.rows) >= self.flush_every
+            or time.monotonic() - self.last_flush >= self.flush_interval
+        ):
+            self.flush()
+
+    def flush(self) -> None:
+        """
+        Write the buffered rows in the output file.
+        :return: None
+        """
+        if self.rows and self.output_path is not None:
+            self.output_path.parent.mkdir(parents=True, exist_ok=True)
+            exists = self.output_path.is_file() and self.output_path.stat().st_size > 0
+            if exists:
+                self.repair()
+            data = self.encode(self.rows, header=not exists)
+            with open(self.output_path, "ab") as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+        self.rows = []
+        self.last_flush = time.monotonic()
+
+    def close(self) -> None:
+        """
+        Write the remaining rows.
+        :return: None
+        """
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def encode(self, rows: List[dict], header: bool) -> bytes:
+        """
+        Encode a block of rows.
+        :param rows: list of rows
+        :param header: True if the file is new (or empty)
+        :return: bytes to append to the file
+        """
+        return b""
+
+    def repair(self) -> None:
+        """
+        Remove an incomplete block at the end of the file, left by a crash during a write.
+        :return: None
+        """
+        truncate_after_last(self.output_path, b"\n")
+
+
+class CsvSink(ResultSink):
+    """
+    Write the results in a csv file, with a header line (same format as before).
+    The results are only appended to an existing file with the same columns (in any order), its header
+    is read when the sink is opened and a ValueError is raised if the columns differ.
+    """
+
+    def __init__(
+        self,
+        output_path: Path = None,
+        flush_every: int = DEFAULT_FLUSH_EVERY,
+        flush_interval: float = DEFAULT_FLUSH_INTERVAL,
+    ):
+        """
+        :param output_path: Path of the results file, the results are appended if it exists
+        :param flush_every: Number of rows buffered before being written
+        :param flush_interval: Maximum time (s) a row stays in the buffer
+        """
+        super().__init__(output_path, flush_every, flush_interval)
+        self.header = csv_header(self.output_path)
+
+    def write(self, row: dict) -> None:
+        if self.columns is None and self.header is not None:
+            self.match_header(list(row.keys()))
+        super().write(row)
+
+    def flush(self) -> None:
+        if self.rows and self.header is None:
+            # The file can have been created by another sink since this one was opened
+            self.header = csv_header(self.output_path)
+            if self.header is not None:
+                self.match_header(self.columns)
+        super().flush()
+
+    def match_header(self, columns: List[str]) -> None:
+        """
+        Check that the rows have the columns of the existing file, they are then written in its order.
+        :param columns: Columns of the rows
+        :return: None
+        """
+        if set(columns) != set(self.header):
+            raise ValueError(
+                f"The results columns {columns} are not the ones of {self.output_path} "
+                f"{self.header}, use another output file"
+            )
+        self.columns = list(self.header)
+
+    def encode(self, rows: List[dict], header: bool) -> bytes:
+        buffer = io.StringIO()
+        csv_writer = csv.writer(buffer)
+        if header:
+            csv_writer.writerow(self.columns)
+        csv_writer.writerows([[row[column] for column in self.columns] for row in rows])
+        return buffer.getvalue().encode()
+
+
+class JsonLinesSink(ResultSink):
+    """
+    Write the results in a JSON Lines file, one JSON object per image.
+    """
+
+    def encode(self, rows: List[dict], header: bool) -> bytes:
+        lines = [json.dumps(to_builtin(row)) + "\n" for row in rows]
+        return "".join(lines).encode()
+
+
+class ColumnarSink(ResultSink):
+    """
+    Write the results in a compact binary columnar file: each flush appends one block made of
+    its size (8 bytes) and a numpy .npz archive with one array per column. Read it with read_results.
+    """
+
+    def encode(self, rows: List[dict], header: bool) -> bytes:
+        columns = {}
+        for column in self.columns:
+            values = [row[column] for row in rows]
+            if isinstance(values[0], str):
+                columns[column] = np.array(values, dtype=str)
+            else:
+                columns[column] = np.array(values, dtype="float32")
+        buffer = io.BytesIO()
+        np.savez_compressed(buffer, **columns)
+        block = buffer.getvalue()
+        return struct.pack("<Q", len(block)) + block
+
+    def repair(self) -> None:
+        size = self.output_path.stat().st_size
+        end = 0
+        for end in columnar_blocks_end(self.output_path):
+            pass
+        if end != size:
+            with open(self.output_path, "r+b") as f:
+                f.truncate(end)
+
+
+class SqliteSink(ResultSink):
+    """
+    Write the results in an indexed SQLite database (see results_db.ResultsDatabase for the queries).
+    Each result is stored with its build (folder of the image by default), part, layer time (modification
+    time of the image) and model, then one column per class, added when a model with new classes writes.
+    Each flush is one transaction, and the database is in WAL mode so it can be read while it is written.
+    The database is kept between runs: a result classified again (same build, image, part and model)
+    replaces the previous one.
+    """
+
+    def __init__(
+        self,
+        output_path: Path = None,
+        flush_every: int = DEFAULT_FLUSH_EVERY,
+        flush_interval: float = DEFAULT_FLUSH_INTERVAL,
+        model: str = None,
+        build: str = None,
+    ):
+        """
+        :param output_path: Path of the database, created if missing
+        :param flush_every: Number of rows buffered before being written
+        :param flush_interval: Maximum time (s) a row stays in the buffer
+        :param model: Model version stored with the results (see models.model_version)
+        :param build: Build stored with the results, the folder of each image if None
+        """
+        super().__init__(output_path, flush_every, flush_interval)
+        self.model = model or ""
+        self.build = build
+        self.connection = None
+        self.known_columns = None
+
+    def connect(self) -> None:
+        """
+        Open the database and create the results table and its indexes if needed.
+        :return: None
+        """
+        self.output_path.parent.mkdir(parents=True, exist_ok=True)
+        self.connection = sqlite3.connect(
+            str(self.output_path), timeout=DATABASE_TIMEOUT
+        )
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.executescript("""
+            CREATE TABLE IF NOT EXISTS results (
+                id INTEGER PRIMARY KEY,
+                build TEXT NOT NULL,
+                image_path TEXT NOT NULL,
+                part TEXT NOT NULL DEFAULT '',
+                layer_time REAL,
+                model TEXT NOT NULL DEFAULT ''
+            );
+            CREATE UNIQUE INDEX IF NOT EXISTS results_row
+                ON results (build, image_path, part, model);
+            CREATE INDEX IF NOT EXISTS results_part ON results (build, part, layer_time);
+            CREATE INDEX IF NOT EXISTS results_part_time ON results (part, layer_time);
+            CREATE INDEX IF NOT EXISTS results_model ON results (model, build);
+            """)
+        self.known_columns = database_columns(self.connection)
+
+    def flush(self) -> None:
+        if self.rows and self.output_path is not None:
+            if self.connection is None:
+                self.connect()
+            rows = [to_builtin(row) for row in self.rows]
+            columns = list(
+                dict.fromkeys(
+                    key for row in rows for key in row if key not in DATABASE_KEYS
+                )
+            )
+            # The layers of the same image are only looked at once
+            times = {}
+            values = []
+            for row in rows:
+                image_path = row["image_path"]
+                if image_path not in times:
+                    times[image_path] = layer_time(image_path)
+                build = self.build if self.build is not None else build_of(image_path)
+                values.append(
+                    (
+                        build,
+                        image_path,
+                        row.get("part") or "",
+                        times[image_path],
+                        self.model,
+                        *[row.get(column) for column in columns],
+                    )
+                )
+            with self.connection:
+                for column in columns:
+                    if column not in self.known_columns:
+                        example = next(
+                            row[column] for row in rows if row.get(column) is not None
+                        )
+                        kind = "TEXT" if isinstance(example, str) else "REAL"
+                        self.connection.execute(
+                            f"ALTER TABLE results ADD COLUMN {quote(column)} {kind}"
+                        )
+                        self.known_columns.append(column)
+                names = ", ".join(quote(name) for name in DATABASE_KEYS + columns)
+                marks = ", ".join("?" * (len(DATABASE_KEYS) + len(columns)))
+                self.connection.executemany(
+                    f"INSERT OR REPLACE INTO results ({names}) VALUES ({marks})", values
+                )
+        self.rows = []
+        self.last_flush = time.monotonic()
+
+    def close(self) -> None:
+        self.flush()
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+
+# Sink used for each extension of the output file
+SINKS = {
+    ".csv": CsvSink,
+    ".jsonl": JsonLinesSink,
+    ".cols": ColumnarSink,
+    **{suffix: SqliteSink for suffix in DATABASE_SUFFIXES},
+}
+
+
+def open_sink(
+    output_path: Path = None, model: str = None, build: str = None, **kwargs
+) -> ResultSink:
+    """
+    Create the result sink matching the extension of the output file (.csv, .jsonl, .cols, .sqlite or .db).
+    :param output_path: Path of the results file, if None the results are not saved
+    :param model: Model version stored with the results (databases only)
+    :param build: Build stored with the results, the folder of each image if None (databases only)
+    :param kwargs: flush_every and flush_interval, see ResultSink
+    :return: ResultSink
+    """
+    if output_path is None:
+        return ResultSink(None, **kwargs)
+    suffix = Path(output_path).suffix
+    if suffix not in SINKS:
+        raise ValueError(
+            f"Unknown results format {suffix}, expected one of {list(SINKS)}"
+        )
+    if suffix in DATABASE_SUFFIXES:
+        return SqliteSink(output_path, model=model, build=build, **kwargs)
+    return SINKS[suffix](output_path, **kwargs)
+
+
+def read_results(results_path: Path) -> Iterator[Dict]:
+    """
+    Read a results file written by a sink (.csv, .jsonl, .cols, .sqlite or .db).
+    The csv values are given as str, as csv.DictReader does. The rows of a database are given as they
+    were written, without the build, layer time and model (see results_db.ResultsDatabase).
+    :param results_path: Path of the results file
+    :return: Iterator of dictionaries, one per image
+    """
+    results_path = Path(results_path)
+    if results_path.suffix == ".jsonl":
+        with open(results_path, "r") as f:
+            for line in f:
+                if line.endswith("\n"):
+                    yield json.loads(line)
+    elif results_path.suffix == ".cols":
+        with open(results_path, "rb") as f:
+            start = 0
+            for end in columnar_blocks_end(results_path):
+                f.seek(start + 8)
+                block = np.load(io.BytesIO(f.read(end - start - 8)))
+                # The float32 scalars are kept, so they are printed as they were written
+                columns = {
+                    name: (
+                        block[name].tolist()
+                        if block[name].dtype.kind == "U"
+                        else list(block[name])
+                    )
+                    for name in block.files
+                }
+                for values in zip(*columns.values()):
+                    yield dict(zip(columns.keys(), values))
+                start = end
+    elif results_path.suffix in DATABASE_SUFFIXES:
+        connection = sqlite3.connect(str(results_path), timeout=DATABASE_TIMEOUT)
+        try:
+            yield from database_rows(
+                connection.execute("SELECT * FROM results ORDER BY id")
+            )
+        finally:
+            connection.close()
+    else:
+        with open(results_path, newline="") as csv_file:
+            yield from csv.DictReader(csv_file, delimiter=",")
+
+
+def results_columns(results_path: Path) -> List[str]:
+    """
+    Columns of all the rows of a results file, in the order they appear: the header of a csv file, the
+    schema of a database, the keys of all the lines of a .jsonl file and the columns of all the blocks
+    of a .cols file (without reading their values).
+    :param results_path: Path of the results file
+    :return: list of column names
+    """
+    results_path = Path(results_path)
+    columns = {}
+    if results_path.suffix == ".jsonl":
+        with open(results_path, "r") as f:
+            for line in f:
+                if line.endswith("\n"):
+                    columns.update(dict.fromkeys(json.loads(line)))
+    elif results_path.suffix == ".cols":
+        with open(results_path, "rb") as f:
+            start = 0
+            for end in columnar_blocks_end(results_path):
+                f.seek(start + 8)
+                columns.update(
+                    dict.fromkeys(np.load(io.BytesIO(f.read(end - start - 8))).files)
+                )
+                start = end
+    elif results_path.suffix in DATABASE_SUFFIXES:
+        connection = sqlite3.connect(str(results_path), timeout=DATABASE_TIMEOUT)
+        try:
+            hidden = {"id"} | set(DATABASE_KEYS)
+            columns = dict.fromkeys(["image_path", "part"])
+            columns.update(
+                dict.fromkeys(
+                    column
+                    for column in database_columns(connection)
+                    if column not in hidden
+                )
+            )
+        finally:
+            connection.close()
+    else:
+        columns = dict.fromkeys(csv_header(results_path) or [])
+    return list(columns)
+
+
+def columnar_blocks_end(results_path: Path) -> Iterator[int]:
+    """
+    Give the end position of each complete block of a columnar results file.
+    :param results_path: Path of the .cols file
+    :return: Iterator of positions in the file
+    """
+    size = Path(results_path).stat().st_size
+    with open(results_path, "rb") as f:
+        position = 0
+        while position + 8 <= size:
+            f.seek(position)
+            (length,) = struct.unpack("<Q", f.read(8))
+            if position + 8 + length > size:
+                return
+            position += 8 + length
+            yield position
+
+
+def database_columns(connection: sqlite3.Connection) -> List[str]:
+    """
+    Columns of the results table of a database.
+    :param connection: Connection to the database
+    :return: list of column names
+    """
+    return [row[1] for row in connection.execute("PRAGMA table_info(results)")]
+
+
+def database_rows(cursor: sqlite3.Cursor, keys: bool = False) -> Iterator[Dict]:
+    """
+    Give the rows of a query on the results table as the sinks received them: image name, part (if any)
+    and the columns written by the model (the NULL columns of the other models are removed).
+    :param cursor: Cursor of a SELECT of whole rows of the results table
+    :param keys: If True, the build, layer time and model are also given
+    :return: Iterator of dictionaries
+    """
+    columns = [description[0] for description in cursor.description]
+    hidden = {"id", "image_path", "part"} | (set() if keys else set(DATABASE_KEYS))
+    for values in cursor:
+        values = dict(zip(columns, values))
+        row = {"image_path": values["image_path"]}
+        if values["part"]:
+            row["part"] = values["part"]
+        for column, value in values.items():
+            if column not in hidden and value is not None:
+                row[column] = value
+        yield row
+
+
+def quote(name: str) -> str:
+    """
+    Quote a column name for a SQLite query.
+    :param name: Column name
+    :return: str
+    """
+    return '"' + name.replace('"', '""') + '"'
+
+
+def build_of(image_path: str) -> str:
+    """
+    Build of a layer image when it is not given: the folder of the image.
+    :param image_path: Path of the image
+    :return: str
+    """
+    return Path(image_path).parent.name
+
+
+def layer_time(image_path: str) -> float:
+    """
+    Time of a layer: the modification time of its image, when it was written by the camera.
+    :param image_path: Path of the image
+    :return: timestamp, None if the image is missing
+    """
+    try:
+        return os.stat(image_path).st_mtime
+    except OSError:
+        return None
+
+
+def csv_header(path: Path) -> List[str]:
+    """
+    :param path: Path of a csv results file
+    :return: list of the columns of its header, None if the file does not exist or is empty
+    """
+    if path is None or not path.is_file() or path.stat().st_size == 0:
+        return None
+    with open(path, newline="") as f:
+        return next(csv.reader(f), None)
+
+
+def truncate_after_last(path: Path, separator: bytes) -> None:
+    """
+    Truncate a file after the last separator, if it does not end with it.
+    :param path: Path of the file
+    :param separator: bytes ending each complete row
+    :return: None
+    """
+    with open(path, "r+b") as f:
+        f.seek(0, os.SEEK_END)
+        size = f.tell()
+        f.seek(size - len(separator))
+        if f.read(len(separator)) == separator:
+            return
+        # Look for the last separator from the end of the file
+        position = size
+        while position > 0:
+            start = max(position - 65536, 0)
+            f.seek(start)
+            index = f.read(position - start).rfind(separator)
+            if index >= 0:
+                f.truncate(start + index + len(separator))
+                return
+            position = start
+        f.truncate(0)
+
+
+def to_builtin(row: dict) -> dict:
+    """
+    Convert the numpy values of a row to python values (for json).
+    :param row: dictionary with the image name and the classification probability.
+    :return: dictionary with python values
+    """
+    return {
+        key: (
+            round(float(value), 4)
+            if isinstance(value, np.floating)
+            else int(value) if isinstance(value, np.integer) else value
+        )
+        for key, value in row.items()
+    }
@@ -0,0 +1,335 @@
+import argparse
+import sqlite3
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, Iterator, List, Tuple
+from results import (
+    DATABASE_KEYS,
+    DATABASE_TIMEOUT,
+    database_columns,
+    database_rows,
+    open_sink,
+    quote,
+)
+
+
+class ResultsDatabase:
+    """
+    Queries on a SQLite results database written by results.SqliteSink, ex: the layers of a part where
+    porous > 0.8, or the defect rate of each layer of a build.
+    The database is opened read only, it can be queried while a classification writes in it.
+    """
+
+    def __init__(self, database: Path):
+        """
+        :param database: Path of the .sqlite or .db results file
+        """
+        self.database = Path(database)
+        if not self.database.is_file():
+            raise FileNotFoundError(f"No results database {self.database}")
+        self.connection = sqlite3.connect(
+            f"{self.database.resolve().as_uri()}?mode=ro",
+            uri=True,
+            timeout=DATABASE_TIMEOUT,
+        )
+
+    def columns(self) -> List[str]:
+        """
+        Columns written by the models (classes, reused flag, ...).
+        :return: list of column names
+        """
+        return [
+            column
+            for column in database_columns(self.connection)
+            if column != "id" and column not in DATABASE_KEYS
+        ]
+
+    def _distinct(self, column: str, build: str = None) -> List[str]:
+        where, params = self._where(build=build)
+        return [
+            row[0]
+            for row in self.connection.execute(
+                f"SELECT DISTINCT {column} FROM results{where} ORDER BY {column}",
+                params,
+            )
+        ]
+
+    def builds(self) -> List[str]:
+        """
+        :return: list of the builds of the database
+        """
+        return self._distinct("build")
+
+    def parts(self, build: str = None) -> List[str]:
+        """
+        :param build: If not None, only the parts of this build
+        :return: list of the parts ("" for the images classified without parts)
+        """
+        return self._distinct("part", build)
+
+    def models(self) -> List[str]:
+        """
+        :return: list of the model versions of the database (see models.model_version)
+        """
+        return self._distinct("model")
+
+    def _column(self, name: str) -> str:
+        # The column names can not be query parameters, only known columns are used
+        if name not in self.columns():
+            raise ValueError(f"Unknown column {name}, expected one of {self.columns()}")
+        return quote(name)
+
+    def _where(
+        self, build: str = None, part: str = None, model: str = None, **conditions
+    ) -> Tuple[str, List]:
+        clauses = []
+        params = []
+        for column, value in (("build", build), ("part", part), ("model", model)):
+            if value is not None:
+                clauses.append(f"{column} = ?")
+                params.append(value)
+        for clause, value in conditions.values():
+            clauses.append(clause)
+            params.append(value)
+        return (" WHERE " + " AND ".join(clauses) if clauses else ""), params
+
+    def rows(
+        self,
+        build: str = None,
+        part: str = None,
+        model: str = None,
+        keys: bool = False,
+    ) -> Iterator[Dict]:
+        """
+        Results of the database, in the order they were written.
+        :param build: If not None, only the results of this build
+        :param part: If not None, only the results of this part
+        :param model: If not None, only the results of this model version
+        :param keys: If True, the build, layer time and model of each result are also given
+        :return: Iterator of dictionaries, as the rows of a results file (see results.read_results)
+        """
+        where, params = self._where(build, part, model)
+        yield from database_rows(
+            self.connection.execute(
+                f"SELECT * FROM results{where} ORDER BY id", params
+            ),
+            keys,
+        )
+
+    def layers_above(
+        self,
+        class_name: str,
+        threshold: float,
+        part: str = None,
+        build: str = None,
+        model: str = None,
+    ) -> List[Dict]:
+        """
+        Layers where the probability of a class is above a threshold, ex: porous > 0.8 for part_1.
+        :param class_name: Class column (see columns)
+        :param threshold: Minimum probability (excluded)
+        :param part: If not None, only the layers of this part
+        :param build: If not None, only the layers of this build
+        :param model: If not None, only the results of this model version
+        :return: list of dictionaries (build, image_path, part, layer_time, model and the probability),
+            in layer order
+        """
+        column = self._column(class_name)
+        where, params = self._where(
+            build, part, model, above=(f"{column} > ?", threshold)
+        )
+        cursor = self.connection.execute(
+            f"SELECT {', '.join(DATABASE_KEYS)}, {column} FROM results{where} "
+            "ORDER BY build, layer_time, image_path, part",
+            params,
+        )
+        names = DATABASE_KEYS + [class_name]
+        return [dict(zip(names, values)) for values in cursor]
+
+    def defect_rates(
+        self,
+        build: str = None,
+        part: str = None,
+        model: str = None,
+        good: str = "good",
+        threshold: float = 0.5,
+    ) -> List[Dict]:
+        """
+        Share of defective parts of each layer, a part is defective if its good probability is below
+        the threshold. The mean probability of each class of the layer is also given.
+        :param build: If not None, only the layers of this build
+        :param part: If not None, only the results of this part
+        :param model: If not None, only the results of this model version
+        :param good: Column of the good class (ex: v1_good for several models)
+        :param threshold: Good probability under which a part is defective
+        :return: list of dictionaries (build, image_path, layer_time, parts, defective, defect_rate and
+            mean_<class>), in layer order
+        """
+        good_column = self._column(good)
+        classes = [
+            column
+            for column in self.columns()
+            if column != "reused" and self._is_number(column)
+        ]
+        where, params = self._where(build, part, model)
+        means = "".join(f", AVG({quote(name)})" for name in classes)
+        cursor = self.connection.execute(
+            f"SELECT build, image_path, MIN(layer_time), COUNT(*), "
+            f"SUM({good_column} < ?){means} FROM results{where} "
+            "GROUP BY build, image_path ORDER BY build, MIN(layer_time), image_path",
+            [threshold, *params],
+        )
+        layers = []
+        for build_name, image_path, time, parts, defective, *averages in cursor:
+            layer = {
+                "build": build_name,
+                "image_path": image_path,
+                "layer_time": time,
+                "parts": parts,
+                "defective": defective,
+                "defect_rate": defective / parts,
+            }
+            layer.update(
+                {f"mean_{name}": value for name, value in zip(classes, averages)}
+            )
+            layers.append(layer)
+        return layers
+
+    def _is_number(self, column: str) -> bool:
+        for row in self.connection.execute("PRAGMA table_info(results)"):
+            if row[1] == column:
+                return row[2] == "REAL"
+        return False
+
+    def export(
+        self,
+        output_path: Path,
+        build: str = None,
+        part: str = None,
+        model: str = None,
+    ) -> int:
+        """
+        Write results of the database in a results file (.csv, .jsonl or .cols, see results.open_sink),
+        ex: to give one build to other tools or to generate its html report (utils.generate_html_report).
+        :param output_path: Path of the results file, replaced if it exists
+        :param build: If not None, only the results of this build
+        :param part: If not None, only the results of this part
+        :param model: If not None, only the results of this model version
+        :return: number of results written
+        """
+        output_path = Path(output_path)
+        if output_path.exists():
+            output_path.unlink()
+        written = 0
+        columns = None
+        # The columns of a file are the ones of its first row
+        with open_sink(output_path) as sink:
+            for row in self.rows(build, part, model):
+                if columns is None:
+                    columns = row.keys() - {"part"}
+                elif row.keys() - {"part"} != columns:
+                    raise ValueError(
+                        "The results have different columns, export one model at a time"
+                    )
+                sink.write(row)
+                written += 1
+        return written
+
+    def close(self) -> None:
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def format_time(timestamp: float) -> str:
+    """
+    :param timestamp: Layer time (see results.layer_time)
+    :return: str, date and time of the layer
+    """
+    if timestamp is None:
+        return "-"
+    return datetime.fromtimestamp(timestamp).isoformat(sep=" ", timespec="seconds")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Query and export a SQLite results database (batch.py -o results.sqlite)."
+    )
+    parser.add_argument("database", type=Path, help="Path of the results database")
+    parser.add_argument("--build", default=None, help="Only the results of this build")
+    parser.add_argument("--part", default=None, help="Only the results of this part")
+    parser.add_argument(
+        "--model", default=None, help="Only the results of this model version"
+    )
+    parser.add_argument(
+        "--above",
+        nargs=2,
+        metavar=("CLASS", "THRESHOLD"),
+        default=None,
+        help="List the layers where the probability of the class is above the threshold (ex: porous 0.8)",
+    )
+    parser.add_argument(
+        "--rates",
+        action="store_true",
+        help="Print the share of defective parts of each layer",
+    )
+    parser.add_argument(
+        "--good",
+        default="good",
+        help="With --rates, column of the good class (ex: v1_good for several models)",
+    )
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.5,
+        help="With --rates, good probability under which a part is defective",
+    )
+    parser.add_argument(
+        "--export",
+        type=Path,
+        default=None,
+        help="Write the results in this file (.csv, .jsonl or .cols)",
+    )
+    parser.add_argument(
+        "--html",
+        action="store_true",
+        help="With --export, also generate the html report of the exported results",
+    )
+    args = parser.parse_args()
+
+    with ResultsDatabase(args.database) as db:
+        if args.above is not None:
+            class_name, threshold = args.above[0], float(args.above[1])
+            for layer in db.layers_above(
+                class_name, threshold, args.part, args.build, args.model
+            ):
+                print(
+                    f"{layer['build']}\t{format_time(layer['layer_time'])}\t"
+                    f"{layer['image_path']}\t{layer['part']}\t{layer[class_name]:.4f}"
+                )
+        elif args.rates:
+            for layer in db.defect_rates(
+                args.build, args.part, args.model, args.good, args.threshold
+            ):
+                print(
+                    f"{layer['build']}\t{format_time(layer['layer_time'])}\t"
+                    f"{layer['image_path']}\t{layer['defective']}/{layer['parts']}\t"
+                    f"{layer['defect_rate']:.1%}"
+                )
+        elif args.export is None:
+            print(f"Builds: {db.builds()}")
+            print(f"Parts: {db.parts(args.build)}")
+            print(f"Models: {db.models()}")
+            print(f"Columns: {db.columns()}")
+        if args.export is not None:
+            count = db.export(args.export, args.build, args.part, args.model)
+            print(f"{count} results written in {args.export}")
+            if args.html:
+                # Imported here, only needed for the report
+                from utils import generate_html_report
+
+                generate_html_report(args.export, args.export.with_suffix(".html"))
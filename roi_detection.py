@@ -0,0 +1,439 @@
+import argparse
+import json
+from itertools import islice
+from pathlib import Path
+from typing import Dict, Iterable, List, Tuple
+import numpy as np
+from PIL import Image, ImageDraw
+from metrics import span
+from part_extraction import load_regions
+
+# Largest side (pixels) of the layers once reduced, the parts are found on these reduced images
+DETECTION_SIZE = 512
+# Number of layers accumulated to find the parts
+DEFAULT_DETECT_LAYERS = 20
+# Smallest part kept (full resolution pixels), smaller spots are noise or spatters
+MIN_PART_AREA = 400
+# Pixels (full resolution) added around each part
+ROI_MARGIN = 8
+# Distance (reduced pixels) under which two spots are merged, ex: the hatches of a part
+CLOSING = 2
+# Percentiles of the grey levels used as black and white to normalise a layer, robust to the noise
+NORMALISE_PERCENTILES = (1, 99.5)
+# Share of the part pixels of a new layer outside the cached regions before the parts are found again
+LAYOUT_TOLERANCE = 0.02
+# The detection parameters and the layers used are saved next to the regions file, with this suffix
+META_SUFFIX = ".detection.json"
+
+
+def load_layer(
+    img: Path, size: int = DETECTION_SIZE
+) -> Tuple[np.ndarray, Tuple[int, int]]:
+    """
+    Load a layer in grey levels, reduced so its largest side is about size pixels (JPEG images are
+    directly decoded at a reduced resolution), and normalised between 0 and 1.
+    :param img: Path to the image
+    :param size: Largest side of the reduced image
+    :return: (float32 array of the reduced layer, (width, height) of the full resolution image)
+    """
+    with span("decode"):
+        img = Image.open(img)
+        full_size = img.size
+        img.draft("L", (size, size))
+        img = img.convert("L")
+        factor = max(img.size) // size
+        if factor > 1:
+            img = img.reduce(factor)
+    arr = np.asarray(img, dtype="float32")
+    low, high = np.percentile(arr, NORMALISE_PERCENTILES)
+    return np.clip((arr - low) / max(high - low, 1.0), 0, 1), full_size
+
+
+def accumulate_layers(
+    images: Iterable[Path], size: int = DETECTION_SIZE
+) -> Tuple[np.ndarray, Tuple[int, int]]:
+    """
+    Maximum of the normalised layers, each part appears once melted in one of the layers, even if
+    it is not melted (or has holes) in the others.
+    :param images: Paths of the layers
+    :param size: Largest side of the reduced layers
+    :return: (float32 array of the accumulated layers, (width, height) of the full resolution images)
+    """
+    accumulated = None
+    full_size = None
+    for img in images:
+        arr, full_size = load_layer(img, size)
+        if accumulated is None:
+            accumulated = arr
+        elif arr.shape != accumulated.shape:
+            raise ValueError(f"{img} is not the size of the previous layers")
+        else:
+            np.maximum(accumulated, arr, out=accumulated)
+    if accumulated is None:
+        raise ValueError("No layer to find the parts")
+    return accumulated, full_size
+
+
+def otsu_threshold(arr: np.ndarray, bins: int = 256) -> float:
+    """
+    Threshold separating the grey levels in two classes (parts and powder) of minimal variance.
+    :param arr: Array of values between 0 and 1
+    :param bins: Number of levels tested
+    :return: float between 0 and 1
+    """
+    histogram = np.bincount(
+        np.minimum((arr.ravel() * bins).astype("int64"), bins - 1), minlength=bins
+    ).astype("float64")
+    levels = (np.arange(bins) + 0.5) / bins
+    weight = np.cumsum(histogram)
+    total = np.cumsum(histogram * levels)
+    background = weight[:-1]
+    foreground = weight[-1] - background
+    mean_background = total[:-1] / np.maximum(background, 1)
+    mean_foreground = (total[-1] - total[:-1]) / np.maximum(foreground, 1)
+    between = background * foreground * (mean_background - mean_foreground) ** 2
+    return float(np.argmax(between) + 1) / bins
+
+
+def dilate(mask: np.ndarray, radius: int) -> np.ndarray:
+    """
+    Grow a binary mask by radius pixels in each direction (square structuring element).
+    :param mask: Boolean array
+    :param radius: Number of pixels
+    :return: Boolean array
+    """
+    for axis in (0, 1):
+        grown = mask.copy()
+        for shift in range(1, radius + 1):
+            if axis == 0:
+                grown[shift:] |= mask[:-shift]
+                grown[:-shift] |= mask[shift:]
+            else:
+                grown[:, shift:] |= mask[:, :-shift]
+                grown[:, :-shift] |= mask[:, shift:]
+        mask = grown
+    return mask
+
+
+def label_components(mask: np.ndarray) -> Tuple[np.ndarray, int]:
+    """
+    Label the 4-connected components of a mask, with whole array operations: each pixel takes the
+    smallest label of its neighbours, and the labels follow the label of the pixel they point to
+    (pointer jumping), until nothing changes.
+    :param mask: Boolean array
+    :return: (int64 array of labels, -1 outside the mask, number of components)
+    """
+    background = mask.size
+    labels = np.where(mask, np.arange(mask.size).reshape(mask.shape), background)
+    while True:
+        smallest = labels.copy()
+        np.minimum(smallest[1:], labels[:-1], out=smallest[1:])
+        np.minimum(smallest[:-1], labels[1:], out=smallest[:-1])
+        np.minimum(smallest[:, 1:], labels[:, :-1], out=smallest[:, 1:])
+        np.minimum(smallest[:, :-1], labels[:, 1:], out=smallest[:, :-1])
+        smallest[~mask] = background
+        # A label is the index of a pixel of the component, its label is smaller or equal
+        jumped = np.append(smallest.ravel(), background)[smallest]
+        if np.array_equal(jumped, labels):
+            break
+        labels = jumped
+    found, labels = np.unique(labels, return_inverse=True)
+    labels = labels.reshape(mask.shape)
+    count = len(found) - int(found[-1] == background)
+    labels[~mask] = -1
+    return labels, count
+
+
+def bounding_boxes(labels: np.ndarray, count: int) -> np.ndarray:
+    """
+    Bounding box and area of each component.
+    :param labels: Labels given by label_components
+    :param count: Number of components
+    :return: int64 array (count, 5) of (left, top, right, bottom, area), right and bottom included
+    """
+    ys, xs = np.nonzero(labels >= 0)
+    component = labels[ys, xs]
+    boxes = np.empty((count, 5), dtype="int64")
+    boxes[:, 0] = boxes[:, 1] = np.iinfo("int64").max
+    boxes[:, 2] = boxes[:, 3] = -1
+    np.minimum.at(boxes[:, 0], component, xs)
+    np.minimum.at(boxes[:, 1], component, ys)
+    np.maximum.at(boxes[:, 2], component, xs)
+    np.maximum.at(boxes[:, 3], component, ys)
+    boxes[:, 4] = np.bincount(component, minlength=count)
+    return boxes
+
+
+def merge_overlapping(boxes: np.ndarray) -> np.ndarray:
+    """
+    Merge the boxes which overlap, ex: the contour and the inside of a part melted separately.
+    :param boxes: int64 array (N, 5) of (left, top, right, bottom, area) (see bounding_boxes)
+    :return: int64 array (M, 5), M <= N
+    """
+    while len(boxes) > 1:
+        overlap = (
+            (boxes[:, None, 0] <= boxes[None, :, 2])
+            & (boxes[None, :, 0] <= boxes[:, None, 2])
+            & (boxes[:, None, 1] <= boxes[None, :, 3])
+            & (boxes[None, :, 1] <= boxes[:, None, 3])
+        )
+        np.fill_diagonal(overlap, False)
+        if not overlap.any():
+            break
+        # The first box overlapping others absorbs them, the others are merged by the next iterations
+        first = int(np.nonzero(overlap.any(axis=1))[0][0])
+        group = overlap[first].copy()
+        group[first] = True
+        merged = np.concatenate(
+            [
+                boxes[group, :2].min(axis=0),
+                boxes[group, 2:4].max(axis=0),
+                [boxes[group, 4].sum()],
+            ]
+        )
+        boxes = np.vstack([boxes[~group], merged])
+    return boxes
+
+
+def find_parts(
+    accumulated: np.ndarray,
+    full_size: Tuple[int, int],
+    threshold: float = None,
+    min_area: int = MIN_PART_AREA,
+    margin: int = ROI_MARGIN,
+    closing: int = CLOSING,
+) -> Tuple[Dict[str, Tuple[Tuple[int, int], Tuple[int, int]]], float]:
+    """
+    Regions of the parts of accumulated layers.
+    :param accumulated: Accumulated layers (see accumulate_layers)
+    :param full_size: (width, height) of the full resolution images
+    :param threshold: Grey level (0-1) of the parts, found with the Otsu method if None
+    :param min_area: Smallest part kept (full resolution pixels)
+    :param margin: Pixels (full resolution) added around each part
+    :param closing: Distance (reduced pixels) under which two spots are merged
+    :return: ({part name: (left_up, right_down)} in full resolution pixels, threshold used)
+    """
+    if threshold is None:
+        threshold = otsu_threshold(accumulated)
+    mask = accumulated > threshold
+    # The spots closer than closing are labelled together, the boxes are the ones of the part pixels
+    labels, count = label_components(dilate(mask, closing))
+    labels[~mask] = -1
+    boxes = bounding_boxes(labels, count)
+    width, height = full_size
+    factor_x = width / accumulated.shape[1]
+    factor_y = height / accumulated.shape[0]
+    boxes = merge_overlapping(boxes[boxes[:, 4] * factor_x * factor_y >= min_area])
+    # The parts are named from the top left of the build plate, row by row
+    boxes = boxes[np.lexsort((boxes[:, 0], boxes[:, 1]))]
+    regions = {}
+    for i, (left, top, right, bottom, _) in enumerate(boxes.tolist()):
+        regions[f"part_{i + 1}"] = (
+            (
+                max(0, int(left * factor_x) - margin),
+                max(0, int(top * factor_y) - margin),
+            ),
+            (
+                min(width, int(np.ceil((right + 1) * factor_x)) + margin),
+                min(height, int(np.ceil((bottom + 1) * factor_y)) + margin),
+            ),
+        )
+    return regions, threshold
+
+
+def layout_changed(
+    img: Path,
+    regions: Dict[str, Tuple[Tuple[int, int], Tuple[int, int]]],
+    threshold: float,
+    size: int = DETECTION_SIZE,
+    tolerance: float = LAYOUT_TOLERANCE,
+) -> bool:
+    """
+    Check if a layer has parts outside the known regions, ex: a new build with another layout.
+    :param img: Path to the layer
+    :param regions: dictionary {part name: (left_up, right_down)}
+    :param threshold: Grey level (0-1) of the parts (see find_parts)
+    :param size: Largest side of the reduced layer
+    :param tolerance: Share of the part pixels allowed outside the regions (noise)
+    :return: bool
+    """
+    arr, (width, height) = load_layer(img, size)
+    mask = arr > threshold
+    factor_x = width / arr.shape[1]
+    factor_y = height / arr.shape[0]
+    outside = mask.copy()
+    for (left, top), (right, bottom) in regions.values():
+        outside[
+            int(top / factor_y) : int(np.ceil(bottom / factor_y)),
+            int(left / factor_x) : int(np.ceil(right / factor_x)),
+        ] = False
+    return outside.sum() > tolerance * max(mask.sum(), 1)
+
+
+def save_regions(
+    regions_file: Path,
+    regions: Dict[str, Tuple[Tuple[int, int], Tuple[int, int]]],
+    meta: Dict = None,
+) -> None:
+    """
+    Save regions in the json format of part_extraction.load_regions, and the detection parameters next
+    to it (regions_file with the META_SUFFIX).
+    :param regions_file: Path to the .json file
+    :param regions: dictionary {part name: (left_up, right_down)}
+    :param meta: Optional dictionary of the detection (parameters, layers used, threshold)
+    :return: None
+    """
+    regions_file = Path(regions_file)
+    regions_file.parent.mkdir(parents=True, exist_ok=True)
+    regions_file.write_text(
+        json.dumps(
+            {
+                name: {"left_up": list(left_up), "right_down": list(right_down)}
+                for name, (left_up, right_down) in regions.items()
+            },
+            indent=2,
+        )
+    )
+    if meta is not None:
+        meta_file(regions_file).write_text(json.dumps(meta, indent=2))
+
+
+def meta_file(regions_file: Path) -> Path:
+    """
+    Path of the detection parameters of a regions file.
+    :param regions_file: Path to the .json file of the regions
+    :return: Path
+    """
+    regions_file = Path(regions_file)
+    return regions_file.with_name(regions_file.stem + META_SUFFIX)
+
+
+def build_regions(
+    images: Iterable[Path],
+    regions_file: Path,
+    layers: int = DEFAULT_DETECT_LAYERS,
+    size: int = DETECTION_SIZE,
+    min_area: int = MIN_PART_AREA,
+    margin: int = ROI_MARGIN,
+    closing: int = CLOSING,
+) -> Dict[str, Tuple[Tuple[int, int], Tuple[int, int]]]:
+    """
+    Find the regions of the parts of a build from its first layers, or reuse the cached ones.
+    The regions are saved in regions_file and reused without decoding any image while the first
+    layers are the same. With other layers (ex: a new build in the same folder), one layer is checked
+    and the parts are only found again if it has parts outside the cached regions (see layout_changed).
+    :param images: Paths of the layers, in order (only the first ones are read)
+    :param regions_file: .json file of the regions, the cache of the detection
+    :param layers: Number of layers accumulated to find the parts
+    :param size: Largest side of the reduced layers
+    :param min_area: Smallest part kept (full resolution pixels)
+    :param margin: Pixels (full resolution) added around each part
+    :param closing: Distance (reduced pixels) under which two spots are merged
+    :return: dictionary {part name: (left_up, right_down)}
+    """
+    regions_file = Path(regions_file)
+    sample = list(islice(images, layers))
+    params = dict(size=size, min_area=min_area, margin=margin, closing=closing)
+    names = [str(img) for img in sample]
+    if regions_file.exists() and meta_file(regions_file).exists():
+        meta = json.loads(meta_file(regions_file).read_text())
+        regions = load_regions(regions_file)
+        if meta.get("params") == params:
+            if meta.get("layers") == names:
+                print(f"{len(regions)} parts of {regions_file} reused")
+                return regions
+            if sample and not layout_changed(
+                sample[-1], regions, meta["threshold"], size
+            ):
+                print(f"Same parts as in {regions_file}")
+                return regions
+            print("The layout changed, the parts are found again")
+
+    with span("roi_detection"):
+        accumulated, full_size = accumulate_layers(sample, size)
+        regions, threshold = find_parts(
+            accumulated, full_size, None, min_area, margin, closing
+        )
+    if not regions:
+        raise ValueError(f"No part found in the {len(sample)} first layers")
+    save_regions(
+        regions_file,
+        regions,
+        {"params": params, "layers": names, "threshold": threshold},
+    )
+    print(
+        f"{len(regions)} parts found in {len(sample)} layers, saved in {regions_file}"
+    )
+    return regions
+
+
+def draw_regions(
+    img: Path,
+    regions: Dict[str, Tuple[Tuple[int, int], Tuple[int, int]]],
+    output_img: Path,
+) -> None:
+    """
+    Save a layer with the regions drawn on it, to check the detection.
+    :param img: Path to the layer
+    :param regions: dictionary {part name: (left_up, right_down)}
+    :param output_img: Path of the image saved
+    :return: None
+    """
+    img = Image.open(img).convert("RGB")
+    draw = ImageDraw.Draw(img)
+    for name, (left_up, right_down) in regions.items():
+        draw.rectangle((*left_up, *right_down), outline=(255, 0, 0), width=3)
+        draw.text((left_up[0] + 4, left_up[1] + 4), name, fill=(255, 0, 0))
+    img.save(output_img)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Find the regions of the parts of a build, to replace the manual crop."
+    )
+    parser.add_argument(
+        "-i", "--input_folder", type=Path, help="Folder of the layer images"
+    )
+    parser.add_argument(
+        "-o",
+        "--regions",
+        type=Path,
+        default=Path("regions.json"),
+        help="Regions file (.json) saved, usable with batch.py --regions",
+    )
+    parser.add_argument(
+        "--layers",
+        type=int,
+        default=DEFAULT_DETECT_LAYERS,
+        help="Number of layers accumulated to find the parts",
+    )
+    parser.add_argument(
+        "--min_area",
+        type=int,
+        default=MIN_PART_AREA,
+        help="Smallest part kept (pixels)",
+    )
+    parser.add_argument(
+        "--margin",
+        type=int,
+        default=ROI_MARGIN,
+        help="Pixels added around each part",
+    )
+    parser.add_argument(
+        "--preview",
+        type=Path,
+        default=None,
+        help="Save the last layer used with the regions drawn on it",
+    )
+    args = parser.parse_args()
+
+    from discovery import scan_images
+
+    layers: List[Path] = list(islice(scan_images(args.input_folder), args.layers))
+    found = build_regions(
+        layers, args.regions, args.layers, min_area=args.min_area, margin=args.margin
+    )
+    for name, (left_up, right_down) in found.items():
+        print(f"{name}: {left_up} {right_down}")
+    if args.preview is not None:
+        draw_regions(layers[-1], found, args.preview)
@@ -0,0 +1,441 @@
+import argparse
+import base64
+import io
+import json
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import List, Tuple
+from urllib.parse import parse_qs, urlparse
+from urllib.request import Request, urlopen
+import torch
+from PIL import Image
+from backend import BACKENDS, DEFAULT_BACKEND, set_threads
+from inference import forward_batch, same_shape_runs
+from part_extraction import DEFAULT_EXTREMA_SCALE, extract_part
+from predicte import (
+    INPUT_SIZE,
+    create_pretrain_model,
+    get_preprocess,
+    probabilities_to_dict,
+)
+from results import to_builtin
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8000
+# Maximum number of images classified in one forward pass
+DEFAULT_MAX_BATCH_SIZE = 16
+# Maximum time (ms) a request waits for other requests to fill a batch
+DEFAULT_MAX_WAIT_MS = 5.0
+
+
+class MicroBatcher:
+    """
+    Group the images of concurrent requests in mini-batches, classified by one thread.
+    A batch is run when max_batch_size images are waiting, or max_wait seconds after its first image.
+    """
+
+    def __init__(
+        self,
+        model,
+        max_batch_size: int = DEFAULT_MAX_BATCH_SIZE,
+        max_wait: float = DEFAULT_MAX_WAIT_MS / 1000,
+    ):
+        """
+        :param model: the pretrained model
+        :param max_batch_size: Maximum number of images classified in one forward pass
+        :param max_wait: Maximum time (s) an image waits for other images to fill a batch
+        """
+        self.model = model
+        self.max_batch_size = max(max_batch_size, 1)
+        self.max_wait = max_wait
+        self.queue = queue.Queue()
+        self.batches = 0
+        self.images = 0
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def submit(self, tensor: torch.Tensor) -> Future:
+        """
+        Add a preprocessed image to the next batch.
+        :param tensor: model input (C, H, W)
+        :return: Future of (scores, probabilities)
+        """
+        future = Future()
+        self.queue.put((tensor, future))
+        return future
+
+    def next_batch(self) -> List[Tuple[torch.Tensor, Future]]:
+        """
+        Wait for the first image, then for the other images of the batch.
+        :return: list of (tensor, future), empty when the batcher is closed
+        """
+        first = self.queue.get()
+        if first is None:
+            return []
+        batch = [first]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            try:
+                if timeout > 0:
+                    item = self.queue.get(timeout=timeout)
+                else:
+                    # Deadline reached, only the images already waiting are added
+                    item = self.queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is None:
+                # Closed, the batch is still classified
+                self.queue.put(None)
+                break
+            batch.append(item)
+        return batch
+
+    def run(self) -> None:
+        """
+        Classify the batches until the batcher is closed.
+        :return: None
+        """
+        while True:
+            batch = self.next_batch()
+            if not batch:
+                return
+            tensors = [tensor for tensor, _ in batch]
+            futures = [future for _, future in batch]
+            for start, stop in same_shape_runs(tensors):
+                try:
+                    self.classify(tensors[start:stop], futures[start:stop])
+                except Exception:
+                    # The images are classified alone, only the failing requests get the error
+                    for tensor, future in zip(tensors[start:stop], futures[start:stop]):
+                        try:
+                            self.classify([tensor], [future])
+                        except Exception as error:
+                            future.set_exception(error)
+            self.batches += 1
+            self.images += len(batch)
+
+    def classify(self, tensors: List[torch.Tensor], futures: List[Future]) -> None:
+        """
+        Classify images of the same shape in one forward pass and give the results to their futures.
+        :param tensors: model inputs (C, H, W)
+        :param futures: Future of each image
+        :return: None
+        """
+        output = forward_batch(self.model, tensors)
+        probabilities = torch.nn.functional.softmax(output, dim=1)
+        for i, future in enumerate(futures):
+            future.set_result((output[i], probabilities[i]))
+
+    def close(self) -> None:
+        """
+        Stop the classification thread once the waiting images are classified.
+        :return: None
+        """
+        self.queue.put(None)
+        self.thread.join()
+
+
+def load_request_image(request: dict) -> Tuple[str, Image.Image]:
+    """
+    Give the image to classify of a request, cropped if a crop box is given.
+    :param request: dictionary with either "image_path" (path of an image readable by the server) or
+        "image" (image file, base64 encoded in json), and optionally "name", "left_up", "right_down",
+        "normalise", "smooth", "roi_first" and "extrema_scale" (see part_extraction.extract_part)
+    :return: (image name, PIL.Image)
+    """
+    if "image_path" in request:
+        source = Path(request["image_path"])
+        name = request.get("name", str(source))
+    elif "image" in request:
+        data = request["image"]
+        if isinstance(data, str):
+            data = base64.b64decode(data)
+        source = io.BytesIO(data)
+        name = request.get("name", "image")
+    else:
+        raise ValueError('The request must contain "image_path" or "image"')
+
+    if request.get("left_up") is not None and request.get("right_down") is not None:
+        # Only the header is read to check the crop box
+        with Image.open(source) as img:
+            check_crop_box(request["left_up"], request["right_down"], img.size)
+        if isinstance(source, io.BytesIO):
+            source.seek(0)
+        img = extract_part(
+            source,
+            tuple(request["left_up"]),
+            tuple(request["right_down"]),
+            bool(request.get("normalise", False)),
+            int(request.get("smooth", 0)),
+            bool(request.get("roi_first", False)),
+            int(request.get("extrema_scale", DEFAULT_EXTREMA_SCALE)),
+        )
+    else:
+        # Converted as in the batch path: greyscale and RGBA images are given in RGB, and a
+        # truncated file fails here
+        img = Image.open(source).convert("RGB")
+    return name, img
+
+
+def check_crop_box(left_up, right_down, size: Tuple[int, int]) -> None:
+    """
+    Check that a crop box is inside the image.
+    :param left_up: X,Y position of the left up corner
+    :param right_down: X,Y position of the right down corner
+    :param size: (width, height) of the image
+    :return: None
+    """
+    check_corners(left_up, right_down)
+    width, height = size
+    if right_down[0] > width or right_down[1] > height:
+        raise ValueError(
+            f"The crop box {tuple(left_up)} {tuple(right_down)} is outside the "
+            f"{width}x{height} image"
+        )
+
+
+def check_corners(left_up, right_down) -> None:
+    """
+    Check that the corners of a crop box are two X,Y positions, the left up one before the right down one.
+    :param left_up: X,Y position of the left up corner
+    :param right_down: X,Y position of the right down corner
+    :return: None
+    """
+    for corner in (left_up, right_down):
+        if len(corner) != 2 or any(
+            not isinstance(value, int) or value < 0 for value in corner
+        ):
+            raise ValueError(f"A corner must be 2 positive integers X,Y, got {corner}")
+    if left_up[0] >= right_down[0] or left_up[1] >= right_down[1]:
+        raise ValueError(
+            f"The left up corner {tuple(left_up)} must be above and left of the right down "
+            f"corner {tuple(right_down)}"
+        )
+
+
+class ClassificationHandler(BaseHTTPRequestHandler):
+    """
+    HTTP requests of the classification server:
+    - POST /classify: json request (or list of requests, see load_request_image), or the raw image
+      file with the name and crop box in the query string (?left_up=934,540&right_down=986,596&normalise=1).
+      The response is the probabilities dictionary of each image, as saved in the csv.
+    - GET /health: number of images and batches classified.
+    """
+
+    def do_GET(self):
+        if urlparse(self.path).path != "/health":
+            self.send_json({"error": "not found"}, 404)
+            return
+        batcher = self.server.batcher
+        self.send_json(
+            {"status": "ok", "images": batcher.images, "batches": batcher.batches}
+        )
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        if url.path != "/classify":
+            self.send_json({"error": "not found"}, 404)
+            return
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        try:
+            if self.headers.get("Content-Type", "").startswith("application/json"):
+                requests = json.loads(body)
+            else:
+                requests = query_to_request(url.query, body)
+            single = isinstance(requests, dict)
+            if single:
+                requests = [requests]
+            images = [load_request_image(request) for request in requests]
+            # Each image is preprocessed before being submitted, an invalid image can not fail
+            # the batch of the other requests
+            preprocess = self.server.preprocess
+            tensors = [preprocess(img) for _, img in images]
+        except Exception as error:
+            self.send_json({"error": f"{type(error).__name__}: {error}"}, 400)
+            return
+
+        # All the images are submitted before waiting, so they can be in the same batch
+        futures = [self.server.batcher.submit(tensor) for tensor in tensors]
+        try:
+            results = [
+                to_builtin(probabilities_to_dict(name, future.result()[1]))
+                for (name, _), future in zip(images, futures)
+            ]
+        except Exception as error:
+            self.send_json({"error": f"{type(error).__name__}: {error}"}, 500)
+            return
+        self.send_json(results[0] if single else results)
+
+    def send_json(self, data, status: int = 200) -> None:
+        """
+        Send a json response.
+        :param data: json serializable data
+        :param status: HTTP status code
+        :return: None
+        """
+        content = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+
+def query_to_request(query: str, body: bytes) -> dict:
+    """
+    Build a request from a raw image file and the parameters of the query string.
+    :param query: query string of the url
+    :param body: image file
+    :return: dictionary (see load_request_image)
+    """
+    parameters = {key: values[-1] for key, values in parse_qs(query).items()}
+    request = {"image": body}
+    if "name" in parameters:
+        request["name"] = parameters["name"]
+    for key in ("left_up", "right_down"):
+        if key in parameters:
+            request[key] = [int(value) for value in parameters[key].split(",")]
+    if "left_up" in request and "right_down" in request:
+        check_corners(request["left_up"], request["right_down"])
+    for key in ("normalise", "roi_first"):
+        if key in parameters:
+            request[key] = parameters[key].lower() in ("1", "true", "yes")
+    for key in ("smooth", "extrema_scale"):
+        if key in parameters:
+            request[key] = int(parameters[key])
+    return request
+
+
+def create_server(
+    host: str = DEFAULT_HOST,
+    port: int = DEFAULT_PORT,
+    max_batch_size: int = DEFAULT_MAX_BATCH_SIZE,
+    max_wait_ms: float = DEFAULT_MAX_WAIT_MS,
+    ready_model: Path = None,
+    verbose: bool = False,
+    backend: str = DEFAULT_BACKEND,
+) -> ThreadingHTTPServer:
+    """
+    Load the model and create the classification server (started with serve_forever).
+    :param host: Address of the server, only the local computer can connect with 127.0.0.1
+    :param port: Port of the server (0 for any free port)
+    :param max_batch_size: Maximum number of images classified in one forward pass
+    :param max_wait_ms: Maximum time (ms) an image waits for other images to fill a batch
+    :param ready_model: Optional path to a serialized ready to run model
+    :param verbose: If True, each request is printed
+    :param backend: Inference backend (see backend.BACKENDS)
+    :return: ThreadingHTTPServer
+    """
+    model = create_pretrain_model(ready_model=ready_model, backend=backend)
+    # Run the model once, so the first request is not slowed down
+    with torch.no_grad():
+        model(torch.zeros(1, 3, INPUT_SIZE, INPUT_SIZE))
+
+    server = ThreadingHTTPServer((host, port), ClassificationHandler)
+    server.daemon_threads = True
+    server.batcher = MicroBatcher(model, max_batch_size, max_wait_ms / 1000)
+    server.preprocess = get_preprocess()
+    server.verbose = verbose
+    return server
+
+
+def classify_remote(
+    url: str, image_path: Path = None, image: bytes = None, **parameters
+) -> dict:
+    """
+    Classify an image with a running server, ex: from the dashboard.
+    :param url: Address of the server, ex: http://127.0.0.1:8000
+    :param image_path: Path of an image readable by the server
+    :param image: Or the content of the image file
+    :param parameters: name, left_up, right_down, normalise, smooth, roi_first, extrema_scale
+    :return: dictionary with the image name and the classification probability.
+    """
+    request = dict(parameters)
+    if image_path is not None:
+        request["image_path"] = str(image_path)
+    if image is not None:
+        request["image"] = base64.b64encode(image).decode()
+    http_request = Request(
+        url.rstrip("/") + "/classify",
+        data=json.dumps(request).encode(),
+        headers={"Content-Type": "application/json"},
+    )
+    with urlopen(http_request) as response:
+        return json.loads(response.read())
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Local classification server, the model is loaded once and the images of "
+        "concurrent requests are classified by mini-batches."
+    )
+    parser.add_argument(
+        "--host",
+        type=str,
+        default=DEFAULT_HOST,
+        help="Address of the server (127.0.0.1: only reachable from this computer)",
+    )
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT, help="Port")
+    parser.add_argument(
+        "--max_batch_size",
+        type=int,
+        default=DEFAULT_MAX_BATCH_SIZE,
+        help="Maximum number of images classified in one forward pass",
+    )
+    parser.add_argument(
+        "--max_wait_ms",
+        type=float,
+        default=DEFAULT_MAX_WAIT_MS,
+        help="Maximum time (ms) an image waits for other images to fill a batch",
+    )
+    parser.add_argument(
+        "--ready_model",
+        type=Path,
+        default=None,
+        help="Path of a serialized ready to run model, created from the checkpoint if missing "
+        "(with --backend int8, path of the model created by quantise.py -o)",
+    )
+    parser.add_argument(
+        "--backend",
+        choices=BACKENDS,
+        default=DEFAULT_BACKEND,
+        help="Inference backend, the optimised models are saved next to the checkpoint",
+    )
+    parser.add_argument(
+        "--threads", type=int, default=None, help="Number of intra op threads"
+    )
+    parser.add_argument(
+        "--interop_threads", type=int, default=None, help="Number of inter op threads"
+    )
+    parser.add_argument(
+        "-v", "--verbose", action="store_true", help="Print each request"
+    )
+    args = parser.parse_args()
+
+    set_threads(args.threads, args.interop_threads)
+    server = create_server(
+        args.host,
+        args.port,
+        args.max_batch_size,
+        args.max_wait_ms,
+        args.ready_model,
+        args.verbose,
+        args.backend,
+    )
+    print(f"Classification server on http://{args.host}:{server.server_port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        server.batcher.close()
@@ -0,0 +1,221 @@
+import json
+import threading
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Tuple
+import numpy as np
+from PIL import Image
+
+# Files of a store folder:
+# - crops.u8: the crops, uint8 arrays of shape (H, W, 3) written one after the other
+# - index.jsonl: one line per crop, its name in the results and the image and region it comes from
+# - store.json: size of the crops and preprocessing parameters (normalisation, smoothing, ...)
+CROPS_FILE = "crops.u8"
+INDEX_FILE = "index.jsonl"
+META_FILE = "store.json"
+
+
+class TensorStoreWriter:
+    """
+    Save the preprocessed crops given to the classifier, so they can be classified again
+    (new checkpoint, other model) without decoding and cropping the images again.
+    The crops and the index are appended as they come, a store stopped during a run keeps
+    the crops written before. An existing store in the folder is replaced.
+    The images given by ordered are written in their order, even if they are decoded by several threads,
+    so the layers of a region stay consecutive (see change_detection).
+    """
+
+    def __init__(
+        self,
+        folder: Path,
+        params: Dict[str, Any] = None,
+        crop_size: Tuple[int, int] = (224, 224),
+    ):
+        """
+        :param folder: Folder of the store, created if needed
+        :param params: Preprocessing parameters of the crops, saved in store.json
+        :param crop_size: (height, width) of the crops
+        """
+        self.folder = Path(folder)
+        self.folder.mkdir(parents=True, exist_ok=True)
+        self.crop_size = tuple(crop_size)
+        meta = {"crop_size": list(self.crop_size), "params": params or {}}
+        (self.folder / META_FILE).write_text(json.dumps(meta, indent=2, default=str))
+        self._crops = open(self.folder / CROPS_FILE, "wb")
+        self._index = open(self.folder / INDEX_FILE, "w")
+        # The crops are added by the decoding threads
+        self._lock = threading.Lock()
+        self.count = 0
+        # Position of the images given by ordered, and crops waiting for the previous images
+        self._positions = {}
+        self._next_position = 0
+        self._to_write = 0
+        self._waiting = {}
+
+    def ordered(self, images_path: Iterable) -> Iterator:
+        """
+        Give the images to classify, recording their order so their crops are written in this order.
+        :param images_path: iterable of path of images
+        :return: Iterator of the same paths
+        """
+        for image_path in images_path:
+            with self._lock:
+                self._positions[image_path] = self._next_position
+                self._next_position += 1
+            yield image_path
+
+    def add_image(self, image_path: Any, crops: List[Tuple]) -> None:
+        """
+        Append the crops of an image, after the crops of the images given before it by ordered.
+        :param image_path: Path of the image the crops come from
+        :param crops: list of (name, PIL.Image, source, roi) (see add), empty if the image failed
+        :return: None
+        """
+        with self._lock:
+            position = self._positions.pop(image_path, None)
+            if position is None:
+                for crop in crops:
+                    self._write(*crop)
+                return
+            self._waiting[position] = crops
+            while self._to_write in self._waiting:
+                for crop in self._waiting.pop(self._to_write):
+                    self._write(*crop)
+                self._to_write += 1
+
+    def add(
+        self, name: Any, img: Image, source: Path = None, roi: Tuple = None
+    ) -> None:
+        """
+        Append a crop to the store.
+        :param name: Name of the crop in the results, a path or (path, part name)
+        :param img: PIL.Image of crop_size, converted to RGB if needed
+        :param source: Path of the image the crop comes from
+        :param roi: (left_up, right_down) of the crop in the source image
+        :return: None
+        """
+        with self._lock:
+            self._write(name, img, source, roi)
+
+    def _write(self, name: Any, img: Image, source: Path, roi: Tuple) -> None:
+        arr = np.asarray(img.convert("RGB"), dtype="uint8")
+        if arr.shape[:2] != self.crop_size:
+            raise ValueError(
+                f"Crop of shape {arr.shape[:2]} given to a store of {self.crop_size} crops"
+            )
+        image_path, part = name if isinstance(name, tuple) else (name, None)
+        row = {"image_path": str(image_path), "part": part}
+        if source is not None:
+            row["source"] = str(source)
+        if roi is not None:
+            row["left_up"], row["right_down"] = [list(corner) for corner in roi]
+        self._crops.write(arr.tobytes())
+        # The index line is written after its crop, an interrupted write leaves no row without crop
+        self._crops.flush()
+        self._index.write(json.dumps(row) + "\n")
+        self._index.flush()
+        self.count += 1
+
+    def close(self) -> None:
+        """
+        Close the files of the store, the crops still waiting for a previous image are written.
+        :return: None
+        """
+        with self._lock:
+            for position in sorted(self._waiting):
+                for crop in self._waiting.pop(position):
+                    self._write(*crop)
+        self._crops.close()
+        self._index.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class TensorStore:
+    """
+    Memory mapped store of preprocessed crops (see TensorStoreWriter), the crops are read
+    from the disk when a batch needs them, without copy.
+    """
+
+    def __init__(self, folder: Path):
+        """
+        :param folder: Folder of the store
+        """
+        self.folder = Path(folder)
+        meta = json.loads((self.folder / META_FILE).read_text())
+        self.crop_size = tuple(meta["crop_size"])
+        self.params = meta["params"]
+        with open(self.folder / INDEX_FILE) as index:
+            self.rows = [json.loads(line) for line in index if line.endswith("\n")]
+        crop_bytes = self.crop_size[0] * self.crop_size[1] * 3
+        crops_file = self.folder / CROPS_FILE
+        count = min(len(self.rows), crops_file.stat().st_size // crop_bytes)
+        self.rows = self.rows[:count]
+        # Copy on write: the batches can be given to torch as they are, the file is never modified
+        self.crops = (
+            np.memmap(
+                crops_file, dtype="uint8", mode="c", shape=(count, *self.crop_size, 3)
+            )
+            if count
+            else np.empty((0, *self.crop_size, 3), dtype="uint8")
+        )
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    def name(self, i: int):
+        """
+        Name of a crop in the results.
+        :param i: Row of the crop
+        :return: image path, or (image path, part name) for a part of a layer image
+        """
+        row = self.rows[i]
+        if row.get("part") is None:
+            return row["image_path"]
+        return row["image_path"], row["part"]
+
+    def batches(self, batch_size: int) -> Iterator[Tuple[List, np.ndarray]]:
+        """
+        Slice the store in batches of crops, the arrays are views of the memory mapped file.
+        :param batch_size: Maximum number of crops per batch
+        :return: Iterator of (names of the crops, uint8 array of shape (N, H, W, 3))
+        """
+        if batch_size < 1:
+            raise ValueError(f"The batch size must be at least 1, got {batch_size}")
+        for start in range(0, len(self), batch_size):
+            stop = min(start + batch_size, len(self))
+            yield [self.name(i) for i in range(start, stop)], self.crops[start:stop]
+
+
+def storing_loader(
+    loader: Callable, writer: TensorStoreWriter, roi_of: Callable = None
+) -> Callable:
+    """
+    Wrap a loader of batch_classify so each image it gives to the classifier is also saved in a store
+    (in the order of writer.ordered).
+    :param loader: Function giving the PIL.Image (or dictionary {name: PIL.Image}) of an image path
+    :param writer: Store where the images are saved
+    :param roi_of: Optional function giving the (left_up, right_down) of a part name (None for one crop)
+    :return: loader giving the same images
+    """
+
+    def load(image_path):
+        try:
+            images = loader(image_path)
+        except Exception:
+            # The next images are not kept waiting for this one
+            writer.add_image(image_path, [])
+            raise
+        named = images if isinstance(images, dict) else {image_path: images}
+        crops = []
+        for name, img in named.items():
+            part = name[1] if isinstance(name, tuple) else None
+            roi = None if roi_of is None else roi_of(part)
+            crops.append((name, img, image_path, roi))
+        writer.add_image(image_path, crops)
+        return images
+
+    return load
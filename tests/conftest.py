@@ -0,0 +1,10 @@
+import sys
+from pathlib import Path
+
+# The modules are scripts at the root of the repository
+ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(ROOT))
+
+LAYER = ROOT / "imgs" / "img_to_normalise" / "14-25-41.jpg"
+POWDER_BED = ROOT / "imgs" / "demo_full_powder_bed.png"
+LAYER_2 = ROOT / "imgs" / "img_to_normalise" / "14-48-52.jpg"
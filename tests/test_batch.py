@@ -0,0 +1,72 @@
+import json
+import shutil
+import pytest
+from PIL import Image
+from conftest import LAYER
+from batch import main
+
+LAYERS = 8
+REGIONS = {
+    "a": {"left_up": [20, 20], "right_down": [220, 220]},
+    "b": {"left_up": [150, 100], "right_down": [380, 330]},
+}
+
+
+@pytest.fixture(scope="module")
+def layers(tmp_path_factory):
+    # Different regions of a layer image, so each one has its own results
+    folder = tmp_path_factory.mktemp("layers")
+    image = Image.open(LAYER)
+    for i in range(LAYERS):
+        left, top = 100 * i, 60 * i
+        image.crop((left, top, left + 400, top + 400)).save(folder / f"layer_{i}.png")
+    return folder
+
+
+def classify(input_folder, output_csv, regions=None, **kwargs):
+    main(
+        input_folder,
+        output_csv,
+        crop=regions is not None,
+        processing_folder=None,
+        left_up=None,
+        right_down=None,
+        normalise=True,
+        html=False,
+        smooth=0,
+        batch_size=3,
+        fused=True,
+        regions=regions,
+        **kwargs,
+    )
+
+
+@pytest.mark.parametrize("with_regions", [False, True])
+def test_resumed_run_with_cache_matches_cold_run(layers, tmp_path, with_regions):
+    regions = None
+    if with_regions:
+        regions = tmp_path / "regions.json"
+        regions.write_text(json.dumps(REGIONS))
+    cold = tmp_path / "cold.csv"
+    classify(layers, cold, regions)
+
+    # Some layers are already in the cache, under other names
+    cached = tmp_path / "cached"
+    cached.mkdir()
+    for i in (1, 2, 5, 7):
+        shutil.copy(layers / f"layer_{i}.png", cached / f"copy_{i}.png")
+    cache = tmp_path / "cache.sqlite"
+    classify(cached, tmp_path / "cached.csv", regions, cache=cache)
+
+    # A run stopped after the first layer, then resumed
+    lines = cold.read_text().splitlines(keepends=True)
+    rows_per_layer = len(REGIONS) if with_regions else 1
+    resumed = tmp_path / "resumed.csv"
+    resumed.write_text("".join(lines[: 1 + rows_per_layer]))
+    classify(layers, resumed, regions, cache=cache, resume=True)
+    assert resumed.read_text() == cold.read_text()
+
+    # All the layers are now in the cache
+    again = tmp_path / "again.csv"
+    classify(layers, again, regions, cache=cache)
+    assert again.read_text() == cold.read_text()
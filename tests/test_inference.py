@@ -0,0 +1,94 @@
+import random
+import threading
+import time
+from functools import partial
+import pytest
+import torch
+from conftest import LAYER, LAYER_2
+from inference import predict_batches, prefetch_images
+from models import get_preprocess, load_model
+from part_extraction import extract_part, extract_parts
+
+IMAGES = [LAYER, LAYER_2, LAYER_2, LAYER, LAYER_2]
+REGIONS = {"a": ((292, 713), (590, 1012)), "b": ((934, 540), (986, 596))}
+
+
+def crop_loader(normalise, smooth, roi_first):
+    return partial(
+        extract_part,
+        left_up=(292, 713),
+        right_down=(590, 1012),
+        normalise_flag=normalise,
+        smooth=smooth,
+        roi_first=roi_first,
+    )
+
+
+def assert_same_images(sequential, prefetched):
+    assert [name for name, _ in prefetched] == [name for name, _ in sequential]
+    for (_, expected), (_, tensor) in zip(sequential, prefetched):
+        assert torch.equal(expected, tensor)
+
+
+@pytest.mark.parametrize("normalise", [False, True])
+@pytest.mark.parametrize("smooth", [0, 3])
+@pytest.mark.parametrize("roi_first", [False, True])
+def test_prefetch_matches_sequential(normalise, smooth, roi_first):
+    loader = crop_loader(normalise, smooth, roi_first)
+    preprocess = get_preprocess("v1")
+    sequential = list(prefetch_images(IMAGES, preprocess, 0, loader=loader))
+    prefetched = list(prefetch_images(IMAGES, preprocess, 4, 2, loader))
+    assert_same_images(sequential, prefetched)
+
+
+@pytest.mark.parametrize("smooth", [0, 3])
+def test_prefetch_parts_match_sequential(smooth):
+    loader = partial(extract_parts, regions=REGIONS, normalise_flag=True, smooth=smooth)
+    preprocess = get_preprocess("v1")
+    sequential = list(prefetch_images(IMAGES, preprocess, 0, loader=loader))
+    prefetched = list(prefetch_images(IMAGES, preprocess, 3, 4, loader))
+    assert len(sequential) == len(IMAGES) * len(REGIONS)
+    assert_same_images(sequential, prefetched)
+
+
+def test_prefetched_predictions_match_sequential():
+    model = load_model("v1")
+    loader = crop_loader(True, 3, True)
+    preprocess = get_preprocess("v1")
+    sequential = list(predict_batches(model, IMAGES, preprocess, 2, 0, loader=loader))
+    prefetched = list(predict_batches(model, IMAGES, preprocess, 2, 4, 3, loader))
+    assert [name for name, _, _ in prefetched] == IMAGES
+    for (_, _, expected), (_, _, probabilities) in zip(sequential, prefetched):
+        assert torch.equal(expected, probabilities)
+
+
+def test_prefetch_keeps_the_order():
+    # The images are decoded in a random time, so they are finished out of order
+    delays = random.Random(0)
+    lock = threading.Lock()
+
+    def loader(index):
+        with lock:
+            delay = delays.uniform(0, 0.01)
+        time.sleep(delay)
+        return index
+
+    outputs = prefetch_images(range(40), lambda index: index, 8, 16, loader)
+    assert [name for name, _ in outputs] == list(range(40))
+
+
+@pytest.mark.parametrize("prefetch", [1, 3, 8])
+def test_prefetch_depth_is_bounded(prefetch):
+    read = []
+
+    def images():
+        for index in range(30):
+            read.append(index)
+            yield index
+
+    consumed = 0
+    for name, _ in prefetch_images(images(), lambda index: index, 4, prefetch, int):
+        consumed += 1
+        # At most prefetch images are read ahead of the consumer
+        assert len(read) - consumed < prefetch
+    assert consumed == 30
@@ -0,0 +1,100 @@
+import socket
+import numpy as np
+import pytest
+import torch
+from PIL import Image
+import metrics
+import models
+from conftest import LAYER
+from models import get_batch_preprocess, get_preprocess, load_model
+
+
+@pytest.fixture
+def offline(monkeypatch):
+    # No network access and no torch.hub: the model must be built from the local checkpoint
+    def blocked(*args, **kwargs):
+        raise AssertionError("network access during the model construction")
+
+    monkeypatch.setattr(socket, "socket", blocked)
+    monkeypatch.setattr(torch.hub, "load", blocked)
+    monkeypatch.setattr(torch.hub, "load_state_dict_from_url", blocked)
+    monkeypatch.setattr(models, "_MODEL_CACHE", {})
+
+
+@pytest.fixture
+def recorded_metrics():
+    metrics.reset()
+    metrics.enable()
+    yield metrics
+    metrics.enable(False)
+    metrics.reset()
+
+
+def test_model_is_built_and_cached_offline(offline, recorded_metrics):
+    model = load_model("v1")
+    assert not model.training
+    assert load_model("v1") is model
+    assert len(models._MODEL_CACHE) == 1
+    # The cold start time is reported once, the cached model is not loaded again
+    assert recorded_metrics.summary()["stages"]["model_load"]["count"] == 1
+
+
+def test_model_load_time_is_printed_only_when_verbose(offline, capsys, monkeypatch):
+    monkeypatch.setattr(metrics, "_VERBOSITY", 0)
+    load_model("v1")
+    assert capsys.readouterr().out == ""
+
+    models._MODEL_CACHE.clear()
+    metrics.set_verbosity(1)
+    load_model("v1")
+    assert capsys.readouterr().out.startswith("Model loaded in ")
+
+
+def test_ready_model_is_loaded_offline(offline, tmp_path):
+    ready_model = tmp_path / "ready.pt"
+    built = load_model("v1", ready_model=ready_model)
+    assert ready_model.is_file()
+
+    # A new process: the serialized model is loaded without building the architecture
+    models._MODEL_CACHE.clear()
+    loaded = load_model("v1", ready_model=ready_model)
+    assert isinstance(loaded, torch.jit.ScriptModule)
+    assert load_model("v1", ready_model=ready_model) is loaded
+    batch = torch.rand(2, 3, 224, 224)
+    with torch.no_grad():
+        assert torch.allclose(built(batch), loaded(batch), atol=1e-5)
+
+
+@pytest.mark.parametrize("name", ["v1", "v2"])
+@pytest.mark.parametrize(
+    "box", [(0, 0, 224, 224), (0, 0, 300, 300), (100, 50, 580, 400), (10, 10, 206, 206)]
+)
+def test_batch_preprocess_matches_single_image(name, box):
+    crop = Image.open(LAYER).convert("RGB").crop(box)
+    expected = get_preprocess(name)(crop)
+    batch = get_batch_preprocess(name)(np.array(crop)[np.newaxis])
+    assert torch.equal(batch[0], expected)
+
+
+def test_multi_model_columns_match_single_model():
+    from inference import predict_batches
+    from models import MultiModel, get_spec
+
+    class Stub(torch.nn.Module):
+        # Stands for the v2 model (lightning-flash), checks the size of its input
+        def forward(self, batch):
+            assert batch.shape[-2:] == get_spec("v2").input_size
+            return torch.zeros(len(batch), len(get_spec("v2").classes))
+
+    image = Image.open(LAYER).convert("RGB")
+    crops = {
+        box: image.crop(box)
+        for box in [(0, 0, 300, 300), (100, 50, 400, 350), (500, 500, 724, 724)]
+    }
+    v1 = load_model("v1")
+    multi = MultiModel(["v1", "v2"], [v1, Stub()])
+    single = predict_batches(v1, crops, get_preprocess("v1"), 2, loader=crops.get)
+    several = predict_batches(multi, crops, get_preprocess(None), 2, loader=crops.get)
+    classes = len(get_spec("v1").classes)
+    for (_, _, expected), (_, _, probabilities) in zip(single, several):
+        assert torch.equal(probabilities[:classes], expected)
@@ -0,0 +1,65 @@
+import numpy as np
+import pytest
+from PIL import Image
+import part_extraction
+from conftest import LAYER, POWDER_BED
+from part_extraction import ROI_FIRST_TOLERANCE, check_roi_first, extract_parts
+
+# (image, left_up, right_down)
+REGIONS = [
+    (LAYER, (292, 713), (590, 1012)),
+    (LAYER, (934, 540), (986, 596)),
+    (POWDER_BED, (284, 702), (600, 1019)),
+]
+PARTS = {"a": ((292, 713), (590, 1012)), "b": ((934, 540), (986, 596))}
+
+
+@pytest.mark.parametrize("img, left_up, right_down", REGIONS)
+@pytest.mark.parametrize("normalise", [False, True])
+@pytest.mark.parametrize("smooth", [0, 3, 10])
+def test_roi_first_matches_whole_image(img, left_up, right_down, normalise, smooth):
+    difference = check_roi_first(img, left_up, right_down, normalise, smooth)
+    if normalise and smooth > 0:
+        # The extrema of the smoothed image are computed on a reduced image
+        assert difference["max_difference"] <= ROI_FIRST_TOLERANCE
+        assert difference["mean_difference"] < 1
+    else:
+        assert difference["max_difference"] == 0
+
+
+@pytest.mark.parametrize("img, left_up, right_down", REGIONS)
+@pytest.mark.parametrize("smooth", [3, 10])
+def test_roi_first_exact_extrema(img, left_up, right_down, smooth):
+    difference = check_roi_first(img, left_up, right_down, True, smooth, 1)
+    assert difference["max_difference"] == 0
+
+
+@pytest.mark.parametrize("smooth", [0, 3])
+def test_roi_first_parts_match_whole_image(smooth):
+    reference = extract_parts(LAYER, PARTS, True, smooth)
+    roi_first = extract_parts(LAYER, PARTS, True, smooth, roi_first=True)
+    for name in PARTS:
+        difference = np.abs(
+            np.asarray(reference[name], dtype="int16")
+            - np.asarray(roi_first[name], dtype="int16")
+        )
+        assert difference.max() <= ROI_FIRST_TOLERANCE
+
+
+def test_roi_first_does_not_smooth_the_whole_image(monkeypatch):
+    sizes = []
+    smooth_image = part_extraction.smooth_image
+
+    def recording_smooth_image(img, smooth):
+        if smooth > 0:
+            sizes.append(img.size)
+        return smooth_image(img, smooth)
+
+    monkeypatch.setattr(part_extraction, "smooth_image", recording_smooth_image)
+    part_extraction.extract_part(LAYER, *PARTS["a"], True, 10, roi_first=True)
+    extract_parts(LAYER, PARTS, True, 10, roi_first=True)
+    full_size = Image.open(LAYER).size
+    assert sizes
+    assert all(
+        width < full_size[0] and height < full_size[1] for width, height in sizes
+    )
@@ -0,0 +1,65 @@
+import sys
+import pytest
+import torch
+from PIL import Image
+import quantise
+from backend import load_quantised
+from conftest import LAYER
+from predicte import MODEL_PATH, build_model, get_preprocess
+
+
+@pytest.fixture(scope="module")
+def tensors():
+    image = Image.open(LAYER).convert("RGB")
+    preprocess = get_preprocess()
+    return [
+        preprocess(image.crop((x, y, x + 300, y + 300))).unsqueeze(0)
+        for x, y in [(0, 0), (292, 713), (600, 400), (900, 900), (1100, 200)]
+    ]
+
+
+def check_parity(quantised, tensors, max_drift=0.1):
+    results = quantise.compare(build_model(), quantised, tensors)
+    assert results["argmax_agreement"] >= 0.8
+    assert all(drift["mean"] < max_drift for drift in results["drift"].values())
+
+
+def test_static_quantisation(tensors):
+    engine = torch.backends.quantized.engine
+    check_parity(quantise.quantise_static(build_model(), tensors, engine), tensors)
+
+
+def test_static_quantisation_without_example_inputs(tensors, monkeypatch):
+    # torch < 1.13: prepare_fx(model, qconfig_dict)
+    prepare_fx = quantise.prepare_fx
+    calls = []
+
+    def legacy_prepare_fx(model, qconfig_dict):
+        calls.append(qconfig_dict)
+        example = torch.zeros(1, 3, quantise.INPUT_SIZE, quantise.INPUT_SIZE)
+        return prepare_fx(model, qconfig_dict, example_inputs=(example,))
+
+    monkeypatch.setattr(quantise, "prepare_fx", legacy_prepare_fx)
+    engine = torch.backends.quantized.engine
+    check_parity(quantise.quantise_static(build_model(), tensors, engine), tensors)
+    assert list(calls[0]) == [""]
+
+
+@pytest.mark.parametrize("legacy", [False, True])
+def test_dynamic_quantisation(tensors, monkeypatch, legacy):
+    if legacy:
+        # torch < 1.13: the dynamic layers are in torch.nn.quantized.dynamic
+        monkeypatch.setitem(sys.modules, "torch.ao.nn.quantized.dynamic", None)
+    dynamic = quantise.dynamic_modules()
+    quantised = quantise.quantise_dynamic(build_model())
+    assert any(isinstance(module, dynamic.Conv2d) for module in quantised.modules())
+    # Only the weights are quantised, the drift is larger than with the static quantisation
+    check_parity(quantised, tensors, max_drift=0.25)
+
+
+def test_quantised_model_at_custom_path(tensors, tmp_path):
+    output = tmp_path / "models" / "squeezenet.int8.ts"
+    engine = torch.backends.quantized.engine
+    quantised = quantise.quantise_static(build_model(), tensors, engine)
+    quantise.save_quantised(quantised, output, engine)
+    check_parity(load_quantised(MODEL_PATH, output), tensors)
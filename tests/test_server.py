@@ -0,0 +1,93 @@
+import io
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from urllib.request import Request, urlopen
+import pytest
+from PIL import Image
+from conftest import LAYER
+from server import classify_remote, create_server
+
+BATCH_SIZE = 4
+CROP = {"left_up": [934, 540], "right_down": [1158, 764]}
+
+
+@pytest.fixture(scope="module")
+def server():
+    server = create_server(port=0, max_batch_size=BATCH_SIZE)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+    server.batcher.close()
+    thread.join()
+
+
+def url(server, path: str) -> str:
+    return f"http://127.0.0.1:{server.server_port}{path}"
+
+
+def health(server) -> dict:
+    with urlopen(url(server, "/health")) as response:
+        assert response.status == 200
+        return json.loads(response.read())
+
+
+def crop_bytes(left_up, right_down) -> bytes:
+    with Image.open(LAYER) as img:
+        crop = img.convert("RGB").crop((*left_up, *right_down))
+    data = io.BytesIO()
+    crop.save(data, format="PNG")
+    return data.getvalue()
+
+
+def test_health(server):
+    assert health(server)["status"] == "ok"
+
+
+def test_classify_json_and_raw_image(server):
+    from_path = classify_remote(url(server, ""), image_path=LAYER, name="layer", **CROP)
+    assert from_path["image_path"] == "layer"
+
+    # The same crop sent as a raw image file, the crop box is applied by the client
+    image = crop_bytes(**CROP)
+    request = Request(
+        url(server, "/classify?name=layer"),
+        data=image,
+        headers={"Content-Type": "image/png"},
+    )
+    with urlopen(request) as response:
+        raw = json.loads(response.read())
+    assert raw.keys() == from_path.keys()
+    for key, value in from_path.items():
+        if isinstance(value, float):
+            assert raw[key] == pytest.approx(value, abs=1e-5)
+        else:
+            assert raw[key] == value
+
+
+def test_concurrent_requests_are_classified_in_one_batch(server, monkeypatch):
+    # Long enough for the concurrent requests to arrive, the batch is run once it is full
+    monkeypatch.setattr(server.batcher, "max_wait", 5.0)
+    batch_sizes = []
+    classify_batch = server.batcher.classify
+
+    def recorded_classify(tensors, futures):
+        batch_sizes.append(len(tensors))
+        classify_batch(tensors, futures)
+
+    monkeypatch.setattr(server.batcher, "classify", recorded_classify)
+    boxes = [([934 + 10 * i, 540], [1158 + 10 * i, 764]) for i in range(BATCH_SIZE)]
+
+    def classify(box):
+        left_up, right_down = box
+        return classify_remote(
+            url(server, ""), image_path=LAYER, left_up=left_up, right_down=right_down
+        )
+
+    with ThreadPoolExecutor(BATCH_SIZE) as pool:
+        results = list(pool.map(classify, boxes))
+    assert len(results) == BATCH_SIZE
+    # The batch is full before max_wait, the requests are coalesced in one forward pass
+    assert batch_sizes == [BATCH_SIZE]
@@ -0,0 +1,25 @@
+import numpy as np
+import pytest
+from PIL import Image
+from conftest import LAYER, POWDER_BED
+from utils import normalise, normalise_batch
+
+
+@pytest.fixture(scope="module")
+def crops():
+    crops = []
+    for path in (LAYER, POWDER_BED):
+        img = Image.open(path).convert("RGB")
+        crops += [img.crop((i, 2 * i, i + 224, 2 * i + 224)) for i in range(0, 400, 50)]
+    # A flat crop, its channels are not modified
+    crops.append(Image.new("RGB", (224, 224), (12, 200, 0)))
+    return crops
+
+
+@pytest.mark.parametrize("extrema", [None, [(10, 200), (30, 30), (0, 255)]])
+def test_normalise_batch_matches_normalise(crops, extrema):
+    batch = np.stack([np.asarray(crop) for crop in crops])
+    expected = np.stack([np.asarray(normalise(crop, extrema)) for crop in crops])
+    normalised = normalise_batch(batch, extrema)
+    assert normalised.dtype == np.uint8
+    assert np.array_equal(normalised, expected)
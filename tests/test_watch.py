@@ -0,0 +1,61 @@
+import shutil
+import pytest
+import torch
+from PIL import Image
+import watch
+from conftest import LAYER
+from models import get_spec
+from results import read_results
+
+
+@pytest.fixture
+def layers(tmp_path):
+    folder = tmp_path / "layers"
+    folder.mkdir()
+    image = Image.open(LAYER).convert("RGB")
+    for i in range(2):
+        image.crop((100 * i, 0, 100 * i + 300, 300)).save(folder / f"layer_{i}.png")
+    return folder
+
+
+def test_image_moved_once_classified(layers, tmp_path, monkeypatch):
+    # The images are moved away (ex: archived by the machine) while they are classified
+    archive = tmp_path / "archive"
+    archive.mkdir()
+    classify_files = watch.classify_files
+
+    def classify_and_move(model, images, *args):
+        rows = classify_files(model, images, *args)
+        for img in images:
+            shutil.move(str(img), str(archive / img.name))
+        return rows
+
+    monkeypatch.setattr(watch, "classify_files", classify_and_move)
+    output = tmp_path / "results.csv"
+    stats = watch.watch(layers, output, poll_interval=0.01, max_images=2)
+    assert len(stats.latencies) == 2
+    assert all(latency >= 0 for latency in stats.latencies)
+    assert len(list(read_results(output))) == 2
+    assert len(list(archive.iterdir())) == 2
+
+
+def test_model_is_selected_by_name(layers, tmp_path, monkeypatch):
+    spec = get_spec("v2")
+
+    class Stub(torch.nn.Module):
+        # Stands for the v2 model (lightning-flash), checks the size of its input
+        def forward(self, batch):
+            assert batch.shape[-2:] == spec.input_size
+            return torch.zeros(len(batch), len(spec.classes))
+
+    def create_pretrain_model(model_name, **kwargs):
+        assert model_name == "v2"
+        return Stub()
+
+    monkeypatch.setattr(watch, "create_pretrain_model", create_pretrain_model)
+    output = tmp_path / "results.csv"
+    watch.watch(layers, output, poll_interval=0.01, max_images=2, model_name="v2")
+    rows = list(read_results(output))
+    assert len(rows) == 2
+    for class_name in spec.classes:
+        assert float(rows[0][class_name]) == pytest.approx(1 / len(spec.classes))
@@ -1,36 +1,202 @@
+import hashlib
+import html
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 from PIL import Image
 from pathlib import Path
-import csv
 from string import Template
 import operator
+from results import read_results, results_columns
+from typing import Iterable, Iterator, List, Tuple
 
+# ImageFilter.SMOOTH_MORE is a 5x5 kernel, each pass use the pixels up to 2 pixels away
+SMOOTH_MARGIN = 2
+# Folder of the html report templates
+TEMPLATE_FOLDER = Path(__file__).parent / "template"
+# Maximum width and height (pixels) of the images displayed in the html report
+THUMBNAIL_SIZE = 150
+# Number of images per page of the html report
+REPORT_PAGE_SIZE = 1000
+# Maximum number of thumbnails created in advance while the report is written
+THUMBNAIL_PREFETCH = 256
 
-def normalise(arr: Image) -> Image:
+
+def normalise(arr: Image, extrema: List[Tuple[int, int]] = None) -> Image:
     """
     From https://stackoverflow.com/questions/7422204/intensity-normalization-of-image-using-pythonpil-speed-issues
     Linear normalization
     http://en.wikipedia.org/wiki/Normalization_%28image_processing%29
+    8 bits RGB images are rescaled through a lookup table (see normalise_lut), without float copies of the image.
+    :param arr: Image to normalise
+    :param extrema: Optional (min, max) of each channel to use instead of the ones of arr,
+        allow to normalise a crop with the statistics of the whole image (see image_extrema).
     """
-    arr = np.array(arr)
+    if isinstance(arr, Image.Image) and arr.mode == "RGB":
+        if extrema is None:
+            extrema = arr.getextrema()
+        return arr.point(normalise_lut(extrema).ravel().tolist())
+
+    arr = np.asarray(arr)
+    if arr.dtype == np.uint8 and arr.ndim == 3:
+        return normalise(Image.fromarray(arr[..., :3]), extrema)
+
+    # Float images (ex: loaded by matplotlib)
     arr = arr.astype("float")
     # Do not touch the alpha channel
     for i in range(3):
-        minval = arr[..., i].min()
-        maxval = arr[..., i].max()
+        if extrema is None:
+            minval = arr[..., i].min()
+            maxval = arr[..., i].max()
+        else:
+            minval, maxval = extrema[i]
         if minval != maxval:
             arr[..., i] -= minval
             arr[..., i] *= 255.0 / (maxval - minval)
 
+    if extrema is not None:
+        # Values of the crop can be outside of approximated extrema
+        arr = np.clip(arr, 0, 255)
     arr = Image.fromarray(arr.astype("uint8"), "RGB")
     return arr
 
 
-def generate_html_report(input_csv: Path, output_path: Path) -> None:
+def normalise_lut(extrema) -> np.ndarray:
+    """
+    Lookup tables of the linear normalization of 8 bits channels.
+    The values are the same as the float computation of the normalization, for the 256 possible values only.
+    :param extrema: (min, max) of each channel, array like of shape (..., 3, 2)
+    :return: uint8 array of shape (..., 3, 256)
+    """
+    extrema = np.asarray(extrema, dtype="float")
+    minval = extrema[..., 0, np.newaxis]
+    maxval = extrema[..., 1, np.newaxis]
+    values = np.arange(256, dtype="float")
+    # Channels with a single value are not modified
+    same = maxval == minval
+    scale = 255.0 / np.where(same, 1.0, maxval - minval)
+    lut = np.where(same, values, (values - minval) * scale)
+    return np.clip(lut, 0, 255).astype("uint8")
+
+
+def normalise_batch(
+    arr: np.ndarray, extrema: List[Tuple[int, int]] = None
+) -> np.ndarray:
+    """
+    Normalise a stack of 8 bits RGB images (ex: crops), each image with its own extrema.
+    :param arr: uint8 array of shape (N, H, W, 3)
+    :param extrema: Optional (min, max) of each channel used for all the images
+    :return: uint8 array of shape (N, H, W, 3)
+    """
+    arr = np.asarray(arr)
+    n, height, width, channels = arr.shape
+    if extrema is None:
+        # Reductions over the rows first, the inner axis stays contiguous (much faster on uint8)
+        rows = arr.reshape(n, height, width * channels)
+        minval = rows.min(axis=1).reshape(n, width, channels).min(axis=1)
+        maxval = rows.max(axis=1).reshape(n, width, channels).max(axis=1)
+        extrema = np.stack([minval, maxval], axis=-1)
+    else:
+        extrema = np.broadcast_to(np.asarray(extrema)[:3], (n, 3, 2))
+    lut = normalise_lut(extrema).reshape(-1)
+    # Offset of the (N, 3, 256) table of each image and channel, one lookup for the whole stack
+    offsets = (np.arange(n * 3, dtype="uint32") * 256).reshape(n, 1, 1, 3)
+    return lut[arr + offsets]
+
+
+def smooth(arr: np.ndarray, iterations: int, rows: int = 256) -> np.ndarray:
+    """
+    Apply ImageFilter.SMOOTH_MORE multiple times on an 8 bits image or stack of images in one operator.
+    The 5x5 kernel is the sum of a 5x5 box, 4 times a 3x3 box and 39 times the center pixel (/100),
+    the boxes are computed with shifted sums in 16 bits integers without going back to PIL between
+    iterations. The borders are extended as PIL does, but the rounding can differ from PIL by 1 on
+    a few pixels.
+    To limit the memory used, a single image is smoothed by strips of rows (with a margin of
+    SMOOTH_MARGIN rows per iteration, so the result is the same as smoothing the whole image).
+    :param arr: uint8 array of shape (H, W, C) or (N, H, W, C)
+    :param iterations: Number of times the filter is applied
+    :param rows: Number of rows smoothed at once for a single image
+    :return: uint8 array of the same shape
+    """
+    arr = np.asarray(arr)
+    if iterations < 1:
+        return arr
+    height = arr.shape[0]
+    if arr.ndim == 4 or height <= rows:
+        return smooth_block(arr, iterations)
+
+    margin = SMOOTH_MARGIN * iterations
+    out = np.empty_like(arr)
+    for top in range(0, height, rows):
+        bottom = min(top + rows, height)
+        start = max(top - margin, 0)
+        block = smooth_block(arr[start : min(bottom + margin, height)], iterations)
+        out[top:bottom] = block[top - start : bottom - start]
+    return out
+
+
+def smooth_block(arr: np.ndarray, iterations: int) -> np.ndarray:
+    """
+    Apply ImageFilter.SMOOTH_MORE multiple times on a whole array (see smooth).
+    :param arr: uint8 array of shape (H, W, C) or (N, H, W, C)
+    :param iterations: Number of times the filter is applied
+    :return: uint8 array of the same shape
+    """
+    height, width = arr.shape[-3], arr.shape[-2]
+    pad = [(0, 0)] * (arr.ndim - 3) + [(2, 2), (2, 2), (0, 0)]
+    out = arr.astype("uint16")
+    for i in range(iterations):
+        p = np.pad(out, pad, mode="edge")
+        # Horizontal sums of 3 and 5 pixels
+        h3 = p[..., 1 : width + 1, :] + p[..., 2 : width + 2, :]
+        h3 += p[..., 3 : width + 3, :]
+        h5 = h3 + p[..., 0:width, :]
+        h5 += p[..., 4 : width + 4, :]
+        # Vertical sums of the horizontal sums
+        total = h3[..., 1 : height + 1, :, :] + h3[..., 2 : height + 2, :, :]
+        total += h3[..., 3 : height + 3, :, :]
+        total *= 4
+        for dy in range(5):
+            total += h5[..., dy : height + dy, :, :]
+        total += 39 * p[..., 2 : height + 2, 2 : width + 2, :]
+        total += 50
+        np.floor_divide(total, 100, out=out)
+    return out.astype("uint8")
+
+
+def image_extrema(img: Image, scale: int = 1) -> List[Tuple[int, int]]:
+    """
+    Minimum and maximum of each channel of an image, used to normalise a crop like the whole image.
+    :param img: PIL.Image in RGB
+    :param scale: If bigger than 1, the extrema are computed on the image reduced by this factor (faster)
+    :return: list of (min, max) for the 3 channels
+    """
+    if scale > 1:
+        img = img.reduce(scale)
+    return list(img.getextrema())[:3]
+
+
+def generate_html_report(
+    input_csv: Path,
+    output_path: Path,
+    page_size: int = REPORT_PAGE_SIZE,
+    thumbnails: bool = True,
+    workers: int = 4,
+) -> None:
     """
     Generate an html report with the classified images and there classification probabilities.
-    :param input_csv: The csv files generated by the classification
+    The rows are written as they are read, in pages of page_size rows (output_path, then
+    name_2.html, name_3.html, ...), and the images are displayed with small thumbnails created in
+    parallel and cached in a name_thumbnails folder next to the report.
+    The class columns are the ones of the results file (V1 and V2 results), read once before the rows
+    so all the pages have the same columns, the rows without a column (results of several models in a
+    .jsonl file or a database) have an empty cell.
+    :param input_csv: The csv files generated by the classification (or .jsonl, .cols results files)
     :param output_path: Path to save the html report
+    :param page_size: Number of images per page
+    :param thumbnails: If False, the images are displayed from their full size file
+    :param workers: Number of threads creating the thumbnails
     :return:
     """
     input_csv = Path(input_csv)
@@ -39,42 +205,189 @@ def generate_html_report(input_csv: Path, output_path: Path) -> None:
     # Check extension
     assert output_path.suffix == ".html", "HTML name need to end with .html"
 
-    # Load the line template:
-    with open("template/html_report_line", "r") as f:
-        template_line = Template(f.read())
+    # Load the line templates:
+    template_line = Template((TEMPLATE_FOLDER / "html_report_line").read_text())
+    template_score = Template(
+        (TEMPLATE_FOLDER / "html_report_score").read_text().rstrip("\n")
+    )
+    # Load the html template, split where the lines are written:
+    header, footer = (TEMPLATE_FOLDER / "html_report_table").read_text().split("$lines")
+    template_header, template_footer = Template(header), Template(footer)
+
+    thumbnail_folder = None
+    if thumbnails:
+        thumbnail_folder = output_path.with_name(output_path.stem + "_thumbnails")
+        thumbnail_folder.mkdir(parents=True, exist_ok=True)
 
-    # Load the html template:
-    with open("template/html_report_table", "r") as f:
-        template_table = Template(f.read())
+    # The links are relative to the report folder, the image paths to the working directory
+    prefix = os.path.relpath(os.getcwd(), os.path.abspath(output_path.parent))
+    # The class columns are all the columns except the image name, part and reuse flag
+    classes = [
+        name
+        for name in results_columns(input_csv)
+        if name not in ("image_path", "part", "reused")
+    ]
+    page = 0
+    report = None
+    try:
+        rows = with_thumbnails(read_results(input_csv), thumbnail_folder, workers)
+        for i, (row, thumbnail) in enumerate(rows):
+            if i % page_size == 0:
+                # Start a new page
+                if report is not None:
+                    close_report_page(report, template_footer, output_path, page, True)
+                page += 1
+                report = open(report_page_path(output_path, page), "w")
+                report.write(
+                    template_header.substitute(
+                        page=f"Page {page}",
+                        header="\n".join(
+                            f"    <th>{name.capitalize()} probability</th>"
+                            for name in classes
+                        ),
+                    )
+                )
 
-    # For each report generate a line in the table
-    with open(input_csv) as csv_file:
-        csv_reader = csv.DictReader(csv_file, delimiter=",")
-        lines = ""
-        for i, row in enumerate(csv_reader):
-            row["id"] = i
             # Transform all proba into float to avoid errors in the green collor attribbution
             # with extremely low value interpreted as str (ex: 1e-4 > 0.9999)
-            for key in ["good", "porous", "bulging"]:
-                row[key] = float(row[key])
-
-            row["clg"] = row["clp"] = row["clb"] = ""
+            score = {
+                name: float(row[name]) if row.get(name) not in (None, "") else None
+                for name in classes
+            }
             # Color in green the biggest value
-            score = dict((k, row[k]) for k in ("good", "porous", "bulging"))
-            best_name = max(score.items(), key=operator.itemgetter(1))[0]
-            if best_name == "good":
-                row["clg"] = "class=green"
-            elif best_name == "porous":
-                row["clp"] = "class=green"
-            elif best_name == "bulging":
-                row["clb"] = "class=green"
-
-            line = template_line.substitute(row)
-            lines = lines + line
-
-    # Merge the line in the table
-    table = template_table.substitute(lines=lines)
-
-    # Save the report in html
-    with open(output_path, "w") as out:
-        out.write(table)
+            best_name = max(
+                ((name, value) for name, value in score.items() if value is not None),
+                key=operator.itemgetter(1),
+                default=(None, None),
+            )[0]
+            image_name = str(row["image_path"])
+            if row.get("part"):
+                image_name = f"{image_name} ({row['part']})"
+            image_path = os.path.normpath(os.path.join(prefix, row["image_path"]))
+            if thumbnail is None:
+                thumbnail = image_path
+            else:
+                thumbnail = f"{thumbnail_folder.name}/{thumbnail.name}"
+            report.write(
+                template_line.substitute(
+                    id=i,
+                    image_name=html.escape(image_name),
+                    image_path=html.escape(image_path.replace(os.sep, "/")),
+                    thumbnail=html.escape(thumbnail.replace(os.sep, "/")),
+                    scores="\n".join(
+                        template_score.substitute(
+                            cl="class=green" if name == best_name else "",
+                            value="" if value is None else value,
+                        )
+                        for name, value in score.items()
+                    ),
+                )
+            )
+
+        if report is None:
+            # No results, empty report
+            page = 1
+            report = open(report_page_path(output_path, page), "w")
+            report.write(template_header.substitute(page="", header=""))
+    finally:
+        if report is not None:
+            close_report_page(report, template_footer, output_path, page, False)
+
+
+def report_page_path(output_path: Path, page: int) -> Path:
+    """
+    Path of a page of the html report.
+    :param output_path: Path of the html report (first page)
+    :param page: Number of the page, from 1
+    :return: Path
+    """
+    if page == 1:
+        return output_path
+    return output_path.with_name(f"{output_path.stem}_{page}.html")
+
+
+def close_report_page(
+    report, template_footer: Template, output_path: Path, page: int, next_page: bool
+) -> None:
+    """
+    Write the end of a page of the html report, with the links to the previous and next pages.
+    :param report: the opened file of the page
+    :param template_footer: Template of the end of the page
+    :param output_path: Path of the html report (first page)
+    :param page: Number of the page, from 1
+    :param next_page: True if there is a next page
+    :return: None
+    """
+    links = []
+    if page > 1:
+        links.append(
+            f'<a href="{report_page_path(output_path, page - 1).name}">Previous page</a>'
+        )
+    if next_page:
+        links.append(
+            f'<a href="{report_page_path(output_path, page + 1).name}">Next page</a>'
+        )
+    report.write(template_footer.substitute(navigation=" | ".join(links)))
+    report.close()
+
+
+def with_thumbnails(
+    rows: Iterable[dict], thumbnail_folder: Path = None, workers: int = 4
+) -> Iterator[Tuple[dict, Path]]:
+    """
+    Create the thumbnails of the images of the results in a pool of threads, at most
+    THUMBNAIL_PREFETCH thumbnails are created in advance.
+    :param rows: Iterable of results rows (with the image_path)
+    :param thumbnail_folder: Where the thumbnails are saved, if None no thumbnail is created
+    :param workers: Number of threads
+    :return: Iterator of (row, path of the thumbnail or None), in the same order as rows
+    """
+    if thumbnail_folder is None:
+        for row in rows:
+            yield row, None
+        return
+
+    cwd = os.getcwd()
+    with ThreadPoolExecutor(max_workers=max(workers, 1)) as pool:
+        pending = deque()
+        for row in rows:
+            image_path = os.path.join(cwd, row["image_path"])
+            pending.append(
+                (row, pool.submit(make_thumbnail, image_path, thumbnail_folder))
+            )
+            if len(pending) >= THUMBNAIL_PREFETCH:
+                row, future = pending.popleft()
+                yield row, future.result()
+        while pending:
+            row, future = pending.popleft()
+            yield row, future.result()
+
+
+def make_thumbnail(
+    image_path: Path, thumbnail_folder: Path, size: int = THUMBNAIL_SIZE
+) -> Path:
+    """
+    Create the thumbnail of an image, only if it does not exist or if the image changed.
+    :param image_path: Path of the image
+    :param thumbnail_folder: Where the thumbnails are saved
+    :param size: Maximum width and height of the thumbnail
+    :return: Path of the thumbnail, None if the image can not be read
+    """
+    image_path = Path(image_path)
+    name = hashlib.sha1(os.path.abspath(image_path).encode()).hexdigest()[:16]
+    thumbnail = Path(thumbnail_folder) / f"{name}.jpg"
+    try:
+        if (
+            thumbnail.is_file()
+            and thumbnail.stat().st_mtime >= image_path.stat().st_mtime
+        ):
+            return thumbnail
+        img = Image.open(image_path)
+        # JPEG images are directly decoded at a reduced resolution
+        img.draft("RGB", (size, size))
+        img = img.convert("RGB")
+        img.thumbnail((size, size))
+        img.save(thumbnail, quality=85)
+    except OSError:
+        return None
+    return thumbnail
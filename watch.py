@@ -0,0 +1,664 @@
+import argparse
+import json
+import os
+import signal
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from pathlib import Path
+from typing import Dict, List, Tuple
+import torch
+from PIL import Image
+from backend import BACKENDS, DEFAULT_BACKEND, set_threads
+from batch import (
+    cropped_name,
+    crop_in_memory,
+    crop_regions_in_memory,
+    expected_rows,
+    row_id,
+)
+from inference import DEFAULT_BATCH_SIZE, predict_batches
+from models import DEFAULT_MODEL, MODELS, get_spec, model_version
+from part_extraction import DEFAULT_EXTREMA_SCALE, load_regions
+from predicte import (
+    CLASSES,
+    create_pretrain_model,
+    get_preprocess,
+    probabilities_to_dict,
+)
+from results import open_sink, read_results
+
+try:
+    # Optional, only used on Linux to be notified of the new files instead of polling the folder
+    from inotify_simple import INotify, flags
+except ImportError:
+    INotify = None
+
+# Extensions of the images watched
+IMAGE_SUFFIXES = (".jpg", ".jpeg", ".png")
+# Bytes ending a complete image file, a file ending with them and with the same size on two checks
+# can be read without waiting for the settle time
+END_MARKERS = {".jpg": b"\xff\xd9", ".jpeg": b"\xff\xd9", ".png": b"IEND\xaeB`\x82"}
+# Time (s) between two checks of the folder
+DEFAULT_POLL_INTERVAL = 0.05
+# Time (s) without size change after which a file without end marker is considered complete
+DEFAULT_SETTLE = 1.0
+
+
+class FolderWatcher:
+    """
+    Detect the new images of a folder, and give them once they are completely written.
+    The folder is listed again only when its modification time changed (a file was added),
+    the files being written are then followed with a stat. With inotify_simple installed,
+    the kernel notifications are used instead of listing the folder.
+    """
+
+    def __init__(
+        self,
+        folder: Path,
+        poll_interval: float = DEFAULT_POLL_INTERVAL,
+        settle: float = DEFAULT_SETTLE,
+        use_inotify: bool = True,
+    ):
+        """
+        :param folder: Folder to watch
+        :param poll_interval: Time (s) between two checks of the folder
+        :param settle: Time (s) without size change after which a file is complete,
+            used for the files without a valid end marker
+        :param use_inotify: Use inotify if inotify_simple is installed
+        """
+        self.folder = Path(folder)
+        self.poll_interval = poll_interval
+        self.settle = settle
+        # Directory state: {name: (size, mtime_ns)} of the files already seen
+        self.index = {}
+        self.folder_mtime = None
+        # Files being written: {path: (size, time of the last size change, detection time)}
+        self.pending = {}
+        self.inotify = None
+        if use_inotify and INotify is not None:
+            self.inotify = INotify()
+            self.inotify.add_watch(
+                str(self.folder),
+                flags.CREATE | flags.MODIFY | flags.CLOSE_WRITE | flags.MOVED_TO,
+            )
+
+    def existing_files(self) -> List[Path]:
+        """
+        List the images already in the folder, they are then not reported as new.
+        :return: list of path of images, sorted by name
+        """
+        self.scan()
+        return sorted(self.folder / name for name in self.index)
+
+    def scan(self) -> List[Path]:
+        """
+        List the folder if it changed, and give the images added or modified since the last scan.
+        :return: list of path of images
+        """
+        folder_mtime = os.stat(self.folder).st_mtime_ns
+        # The folder mtime may not change for files created in the same clock tick, so a recently
+        # modified folder is always listed again
+        if folder_mtime == self.folder_mtime and time.time() - folder_mtime / 1e9 > 1.0:
+            return []
+        self.folder_mtime = folder_mtime
+
+        changed = []
+        with os.scandir(self.folder) as entries:
+            for entry in entries:
+                if not entry.is_file() or not entry.name.lower().endswith(
+                    IMAGE_SUFFIXES
+                ):
+                    continue
+                stat = entry.stat()
+                state = (stat.st_size, stat.st_mtime_ns)
+                if self.index.get(entry.name) != state:
+                    self.index[entry.name] = state
+                    changed.append(Path(entry.path))
+        return changed
+
+    def follow(self, paths: List[Path]) -> None:
+        """
+        Follow images until they are completely written, they are then given by ready_files.
+        :param paths: list of path of images
+        :return: None
+        """
+        now = time.time()
+        for path in paths:
+            if path not in self.pending:
+                self.pending[path] = (-1, now, now)
+
+    def notified(self) -> Tuple[List[Path], List[Path]]:
+        """
+        Read the inotify events.
+        :return: (images closed after writing, images created or modified)
+        """
+        closed, changed = [], []
+        for event in self.inotify.read(timeout=int(1000 * self.poll_interval)):
+            if not event.name.lower().endswith(IMAGE_SUFFIXES):
+                continue
+            path = self.folder / event.name
+            if event.mask & (flags.CLOSE_WRITE | flags.MOVED_TO):
+                closed.append(path)
+            else:
+                changed.append(path)
+        return closed, changed
+
+    def ready_files(self) -> List[Tuple[Path, float]]:
+        """
+        Wait at most poll_interval for new images, and give the ones completely written.
+        The landing time is read when the file is found complete, the file can then be moved
+        while it is classified.
+        :return: list of (path of the image, landing time: last modification of the file, or its
+            detection time if later)
+        """
+        now = time.time()
+        ready = []
+        if self.inotify is not None:
+            closed, changed = self.notified()
+            for path in closed:
+                detected = self.pending.pop(path, (0, 0, now))[2]
+                try:
+                    mtime = path.stat().st_mtime
+                except FileNotFoundError:
+                    # Removed or renamed once written
+                    continue
+                ready.append((path, max(mtime, detected)))
+        else:
+            changed = self.scan()
+        self.follow(changed)
+
+        for path, (size, last_change, detected) in list(self.pending.items()):
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                # Removed or renamed before being complete
+                del self.pending[path]
+                continue
+            new_size = stat.st_size
+            if new_size != size:
+                # Still being written
+                self.pending[path] = (new_size, now, detected)
+                continue
+            if has_end_marker(path, new_size) or now - last_change >= self.settle:
+                del self.pending[path]
+                ready.append((path, max(stat.st_mtime, detected)))
+
+        if not ready and self.inotify is None:
+            time.sleep(self.poll_interval)
+        return sorted(ready)
+
+    def close(self) -> None:
+        """
+        Stop the inotify notifications.
+        :return: None
+        """
+        if self.inotify is not None:
+            self.inotify.close()
+
+
+def has_end_marker(path: Path, size: int) -> bool:
+    """
+    Check if an image file ends like a complete file of its format (JPEG EOI or PNG IEND).
+    :param path: Path of the image
+    :param size: Size of the file
+    :return: True if the file ends with the end marker of its format
+    """
+    marker = END_MARKERS.get(path.suffix.lower())
+    if marker is None or size < len(marker):
+        return False
+    with open(path, "rb") as f:
+        f.seek(size - len(marker))
+        return f.read(len(marker)) == marker
+
+
+class LatencyStats:
+    """
+    Time between the landing of an image in the folder (its last modification) and its results row.
+    """
+
+    def __init__(self, stats_file: Path = None):
+        """
+        :param stats_file: If not None, json file updated with the statistics after each image
+        """
+        self.stats_file = None if stats_file is None else Path(stats_file)
+        self.latencies = []
+
+    def add(self, latency: float) -> None:
+        """
+        Add the latency of one image.
+        :param latency: time in s
+        :return: None
+        """
+        self.latencies.append(latency)
+
+    def summary(self) -> Dict[str, float]:
+        """
+        Statistics of the latencies.
+        :return: dictionary with the number of images and the mean, median, 95th percentile,
+            maximum and last latencies (s)
+        """
+        if not self.latencies:
+            return {"images": 0}
+        ordered = sorted(self.latencies)
+        return {
+            "images": len(ordered),
+            "mean": sum(ordered) / len(ordered),
+            "p50": ordered[len(ordered) // 2],
+            "p95": ordered[min(len(ordered) - 1, int(0.95 * len(ordered)))],
+            "max": ordered[-1],
+            "last": self.latencies[-1],
+        }
+
+    def save(self) -> None:
+        """
+        Write the statistics in the stats_file.
+        :return: None
+        """
+        if self.stats_file is not None:
+            temporary = self.stats_file.with_suffix(".tmp")
+            temporary.write_text(json.dumps(self.summary(), indent=2))
+            # Replaced at once, so a reader never sees a partial file
+            os.replace(temporary, self.stats_file)
+
+
+def watch(
+    input_folder: Path,
+    output_csv: Path,
+    crop: bool = False,
+    processing_folder: Path = None,
+    left_up=None,
+    right_down=None,
+    normalise: bool = False,
+    smooth: int = 0,
+    regions: Path = None,
+    roi_first: bool = False,
+    extrema_scale: int = DEFAULT_EXTREMA_SCALE,
+    batch_size: int = DEFAULT_BATCH_SIZE,
+    ready_model: Path = None,
+    backend: str = DEFAULT_BACKEND,
+    poll_interval: float = DEFAULT_POLL_INTERVAL,
+    settle: float = DEFAULT_SETTLE,
+    skip_existing: bool = False,
+    stats_file: Path = None,
+    max_images: int = None,
+    model_name: str = DEFAULT_MODEL,
+) -> LatencyStats:
+    """
+    Classify the images arriving in a folder until stopped (Ctrl+C), the model is loaded once.
+    Each image is cropped in memory (as with batch.py --fused) and its results are appended to the
+    output file as soon as it is classified. The images already in the output file are not
+    classified again.
+    :param input_folder: Folder where the images arrive
+    :param output_csv: Results file (.csv, .jsonl, .cols or .sqlite, see results.open_sink)
+    :param crop: Flag if the images need to be cropped
+    :param processing_folder: If not None, where the cropped images are saved (in background)
+    :param left_up: X,Y position of the left up corner
+    :param right_down: X,Y position of the right down corner
+    :param normalise: Flag to normalise of not the images.
+    :param smooth: Number of times images must be smoothed
+    :param regions: Optional .json or .csv file of named parts to extract from each image
+    :param roi_first: If True, only the cropped regions are smoothed and normalised
+    :param extrema_scale: With roi_first, reduction factor of the image used to compute the
+        normalisation extrema
+    :param batch_size: Maximum number of images classified in one forward pass
+    :param ready_model: Optional path to a serialized ready to run model
+    :param backend: Inference backend (see backend.BACKENDS)
+    :param poll_interval: Time (s) between two checks of the folder
+    :param settle: Time (s) without size change after which a file without end marker is complete
+    :param skip_existing: If True, the images already in the folder are ignored
+    :param stats_file: If not None, json file updated with the latency statistics
+    :param max_images: If not None, stop after this number of images
+    :param model_name: Name of the classification model (see models.MODELS)
+    :return: LatencyStats
+    """
+    output_csv = Path(output_csv)
+    parts = load_regions(regions) if crop and regions is not None else None
+
+    def rows_of(img: Path) -> List[Tuple[str, str]]:
+        return expected_rows(img, crop, True, processing_folder, parts)
+
+    # Load the model and run it once, so the first image is not slowed down
+    spec = get_spec(model_name)
+    model = create_pretrain_model(
+        ready_model=ready_model, backend=backend, model_name=model_name
+    )
+    with torch.no_grad():
+        model(torch.zeros(1, 3, *spec.input_size))
+    preprocess = get_preprocess(model_name)
+
+    writer = ThreadPoolExecutor(max_workers=1) if processing_folder else None
+    watcher = FolderWatcher(input_folder, poll_interval, settle)
+    stats = LatencyStats(stats_file)
+    done = set()
+    if output_csv.exists():
+        done = {row_id(row) for row in read_results(output_csv)}
+
+    # The images already in the folder are classified first (once complete), unless skipped
+    existing = watcher.existing_files()
+    if not skip_existing:
+        watcher.follow(existing)
+    print(f"Watching {input_folder}")
+    try:
+        # Each row is written (and synced) as soon as it is ready
+        with open_sink(
+            output_csv, model=model_version(model_name), flush_every=1
+        ) as sink:
+            while max_images is None or len(stats.latencies) < max_images:
+                images = [
+                    (img, landed)
+                    for img, landed in watcher.ready_files()
+                    if not set(rows_of(img)) <= done
+                ]
+                for start in range(0, len(images), batch_size):
+                    chunk = images[start : start + batch_size]
+                    rows = classify_files(
+                        model,
+                        [img for img, _ in chunk],
+                        preprocess,
+                        crop,
+                        processing_folder,
+                        left_up,
+                        right_down,
+                        normalise,
+                        smooth,
+                        parts,
+                        roi_first,
+                        extrema_scale,
+                        writer,
+                        spec.classes,
+                    )
+                    for img, landed in chunk:
+                        if img not in rows:
+                            continue
+                        for row in rows[img]:
+                            sink.write(row)
+                            done.add(row_id(row))
+                        # Landing time read when the file was complete (start of the watch for
+                        # the files already there), the file may have been moved since
+                        latency = time.time() - landed
+                        stats.add(latency)
+                        print(f"{img.name}: {1000 * latency:.0f} ms")
+                    stats.save()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        watcher.close()
+        if writer is not None:
+            writer.shutdown()
+        summary = stats.summary()
+        if summary["images"]:
+            print(
+                f"{summary['images']} images, latency mean {1000 * summary['mean']:.0f} ms, "
+                f"p95 {1000 * summary['p95']:.0f} ms, max {1000 * summary['max']:.0f} ms"
+            )
+    return stats
+
+
+def classify_files(
+    model,
+    images: List[Path],
+    preprocess,
+    crop: bool,
+    processing_folder: Path,
+    left_up,
+    right_down,
+    normalise: bool,
+    smooth: int,
+    regions: Dict[str, Tuple[Tuple[int, int], Tuple[int, int]]] = None,
+    roi_first: bool = False,
+    extrema_scale: int = DEFAULT_EXTREMA_SCALE,
+    writer: ThreadPoolExecutor = None,
+    classes: List[str] = CLASSES,
+) -> Dict[Path, List[dict]]:
+    """
+    Crop in memory and classify a list of images in one forward pass. If an image can not be
+    read (ex: corrupted file), the images are classified one by one and the failed ones are skipped.
+    :param model: the pretrained model
+    :param images: list of path of images
+    :param preprocess: transformation from a PIL.Image to the model input tensor
+    :param crop: Flag if the images need to be cropped
+    :param processing_folder: If not None, where the cropped images are saved (by writer)
+    :param left_up: X,Y position of the left up corner
+    :param right_down: X,Y position of the right down corner
+    :param normalise: Flag to normalise of not the images.
+    :param smooth: Number of times images must be smoothed
+    :param regions: dictionary {part name: (left_up, right_down)} if the parts are extracted
+    :param roi_first: If True, only the cropped regions are smoothed and normalised
+    :param extrema_scale: With roi_first, reduction factor of the image used to compute the
+        normalisation extrema
+    :param writer: Executor saving the cropped images in the background
+    :param classes: Class names, in the order of the model outputs
+    :return: dictionary {path of the image: list of rows}
+    """
+    sources = {}
+    if crop and regions is not None:
+        names = images
+        loader = partial(
+            crop_regions_in_memory,
+            regions=regions,
+            normalise=normalise,
+            smooth=smooth,
+            roi_first=roi_first,
+            extrema_scale=extrema_scale,
+            processing_folder=processing_folder,
+            writer=writer,
+        )
+        for img in images:
+            for name, part in expected_rows(
+                img, crop, True, processing_folder, regions
+            ):
+                sources[(name, part)] = img
+    elif crop:
+        if processing_folder is None:
+            names = images
+        else:
+            names = [cropped_name(img, processing_folder) for img in images]
+        loader = partial(
+            crop_in_memory,
+            sources=dict(zip(names, images)),
+            left_up=left_up,
+            right_down=right_down,
+            normalise=normalise,
+            smooth=smooth,
+            roi_first=roi_first,
+            extrema_scale=extrema_scale,
+            writer=writer,
+        )
+        sources = {(str(name), None): img for name, img in zip(names, images)}
+    else:
+        names = images
+        loader = Image.open
+        sources = {(str(img), None): img for img in images}
+
+    try:
+        results = {}
+        for name, output, probabilities in predict_batches(
+            model, names, preprocess, len(names), 0, 0, loader
+        ):
+            part = None
+            if isinstance(name, tuple):
+                name, part = name
+            row = probabilities_to_dict(name, probabilities, part, classes)
+            results.setdefault(sources[row_id(row)], []).append(row)
+        return results
+    except Exception as error:
+        if len(images) == 1:
+            print(f"Failed to classify {images[0]}: {type(error).__name__}: {error}")
+            return {}
+
+    # Find the failed image
+    results = {}
+    for img in images:
+        results.update(
+            classify_files(
+                model,
+                [img],
+                preprocess,
+                crop,
+                processing_folder,
+                left_up,
+                right_down,
+                normalise,
+                smooth,
+                regions,
+                roi_first,
+                extrema_scale,
+                writer,
+                classes,
+            )
+        )
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Classify the images arriving in a folder, layer by layer, until stopped."
+    )
+    parser.add_argument(
+        "-i",
+        "--input_folder",
+        type=Path,
+        help="Path of the folder where the images arrive",
+    )
+    parser.add_argument(
+        "-o",
+        "--output_csv",
+        type=Path,
+        help="Results file, the prediction of each image is appended as soon as it is ready",
+    )
+    parser.add_argument(
+        "-c",
+        "--crop",
+        action="store_true",
+        help="Flag if the images need to be croped",
+    )
+    parser.add_argument(
+        "-f", "--processing_folder", type=Path, help="Where to save the croped images"
+    )
+    parser.add_argument(
+        "-l",
+        "--left_up",
+        type=int,
+        nargs="+",
+        help="Left up coordinate of the image to extract (X,Y)",
+    )
+    parser.add_argument(
+        "-r",
+        "--right_down",
+        type=int,
+        nargs="+",
+        help="Right down coordinate of the image to extract (X,Y)",
+    )
+    parser.add_argument(
+        "-n",
+        "--normalise",
+        action="store_true",
+        help="Flag if the images need to be normalised",
+    )
+    parser.add_argument(
+        "-s",
+        "--smooth",
+        type=int,
+        default=0,
+        help="Number of time the image will be smoothed",
+    )
+    parser.add_argument(
+        "--regions",
+        type=Path,
+        default=None,
+        help="json or csv file of named parts to extract from each image (replace --left_up and --right_down)",
+    )
+    parser.add_argument(
+        "--roi_first",
+        action="store_true",
+        help="Only smooth and normalise the cropped regions instead of the whole images",
+    )
+    parser.add_argument(
+        "--extrema_scale",
+        type=int,
+        default=DEFAULT_EXTREMA_SCALE,
+        help="With --roi_first and --smooth, reduction factor of the images used to compute the "
+        "normalisation extrema (1 to smooth the whole images for the exact extrema)",
+    )
+    parser.add_argument(
+        "--model",
+        dest="model_name",
+        choices=list(MODELS),
+        default=DEFAULT_MODEL,
+        help="Classification model (v1: SqueezeNet 3 classes, v2: ImageClassifier 5 classes)",
+    )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=DEFAULT_BATCH_SIZE,
+        help="Maximum number of images classified in one forward pass",
+    )
+    parser.add_argument(
+        "--ready_model",
+        type=Path,
+        default=None,
+        help="Path of a serialized ready to run model, created from the checkpoint if missing "
+        "(with --backend int8, path of the model created by quantise.py -o)",
+    )
+    parser.add_argument(
+        "--backend",
+        choices=BACKENDS,
+        default=DEFAULT_BACKEND,
+        help="Inference backend, the optimised models are saved next to the checkpoint",
+    )
+    parser.add_argument(
+        "--threads", type=int, default=None, help="Number of intra op threads"
+    )
+    parser.add_argument(
+        "--interop_threads", type=int, default=None, help="Number of inter op threads"
+    )
+    parser.add_argument(
+        "--poll_interval",
+        type=float,
+        default=DEFAULT_POLL_INTERVAL,
+        help="Time (s) between two checks of the folder",
+    )
+    parser.add_argument(
+        "--settle",
+        type=float,
+        default=DEFAULT_SETTLE,
+        help="Time (s) without size change after which an image without end marker is complete",
+    )
+    parser.add_argument(
+        "--skip_existing",
+        action="store_true",
+        help="Ignore the images already in the folder when starting",
+    )
+    parser.add_argument(
+        "--stats_file",
+        type=Path,
+        default=None,
+        help="json file updated with the latency statistics",
+    )
+    args = parser.parse_args()
+
+    # Stop cleanly (results written, statistics printed) when the daemon is terminated
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    set_threads(args.threads, args.interop_threads)
+    watch(
+        input_folder=args.input_folder,
+        output_csv=args.output_csv,
+        crop=args.crop,
+        processing_folder=args.processing_folder,
+        left_up=args.left_up,
+        right_down=args.right_down,
+        normalise=args.normalise,
+        smooth=args.smooth,
+        regions=args.regions,
+        roi_first=args.roi_first,
+        extrema_scale=args.extrema_scale,
+        batch_size=args.batch_size,
+        ready_model=args.ready_model,
+        backend=args.backend,
+        poll_interval=args.poll_interval,
+        settle=args.settle,
+        skip_existing=args.skip_existing,
+        stats_file=args.stats_file,
+        model_name=args.model_name,
+    )